@@ -0,0 +1,161 @@
+"""
+Micro-benchmarks of the codecs of keiko.flags.
+
+Compares each codec with the per-call implementation it replaced, kept
+below as the reference:
+
+    $ python benchmarks/flags.py
+    $ python benchmarks/flags.py -n 200000 -o flags.json
+"""
+
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from keiko import flags  # noqa: E402
+
+
+# the codecs before the lookup tables
+def _swap_key_and_value(dictionary):
+    return dict((str(v), s) for s, v in dictionary.items())
+
+
+def reference_build_lamp_flags(states):
+    flag_list = list('XXXXXXXX')
+    for color, state in states['lamps'].items():
+        flag_list[flags._LAMP_DIGITS[color]] = str(flags._LAMP_STATES[state])
+    return ''.join(flag_list)
+
+
+def reference_parse_lamp_flags(value):
+    values = _swap_key_and_value(flags._LAMP_STATES)
+    states = dict([
+        (color, values[value[digit]])
+        for color, digit in flags._LAMP_DIGITS.items()
+    ])
+    return {'lamps': states}
+
+
+def reference_build_buzzer_flags(states):
+    flag_list = list('XXXXXXXX')
+    state = states['buzzer']
+    if state == 'off':
+        for digit in flags._BUZZER_DIGITS.values():
+            flag_list[digit] = '0'
+    else:
+        flag_list[flags._BUZZER_DIGITS[state]] = '1'
+    return ''.join(flag_list)
+
+
+def reference_parse_buzzer_flags(value):
+    for state, digit in flags._BUZZER_DIGITS.items():
+        if value[digit] == '1':
+            return {'buzzer': state}
+    return {'buzzer': 'off'}
+
+
+def reference_build_do_flags(states):
+    flag_list = list('XXXXXXXX')
+    for term, state in states['do'].items():
+        flag_list[flags._DO_DIGITS[term]] = str(flags._DO_STATES[state])
+    return ''.join(flag_list)
+
+
+def reference_parse_do_flags(value):
+    values = _swap_key_and_value(flags._DO_STATES)
+    states = dict([
+        (term, values[value[digit]])
+        for term, digit in flags._DO_DIGITS.items()
+    ])
+    return {'do': states}
+
+
+def reference_parse_di_flags(value):
+    values = _swap_key_and_value(flags._DI_STATES)
+    states = dict([
+        (term, values[value[digit]])
+        for term, digit in flags._DI_DIGITS.items()
+    ])
+    return {'di': states}
+
+
+CASES = [  # (name, argument)
+    ('build_lamp_flags', {'lamps': {'red': 'on', 'green': 'blink'}}),
+    ('parse_lamp_flags', '12300000'),
+    ('build_buzzer_flags', {'buzzer': 'intermittent'}),
+    ('parse_buzzer_flags', '00001000'),
+    ('build_do_flags', {'do': {1: 'on', 3: 'off'}}),
+    ('parse_do_flags', '10100000'),
+    ('parse_di_flags', '0101'),
+]
+
+
+_STATE = flags.parse_state('12010000', '10100000', '0101', '10310200')
+
+
+def measure(func, argument, number):
+    """Returns the nanoseconds per call of func(<argument>)."""
+    best = min(timeit.repeat(
+        lambda: func(argument), number=number, repeat=3
+    ))
+    return best / number * 1e9
+
+
+def run(number):
+    results = {}
+    for name, argument in CASES:
+        current = getattr(flags, name)
+        reference = globals()['reference_' + name]
+        assert current(argument) == reference(argument), name
+        before = measure(reference, argument, number)
+        after = measure(current, argument, number)
+        results[name] = {
+            'before_ns': before, 'after_ns': after, 'speedup': before / after
+        }
+        sys.stderr.write(
+            '{0:20} {1:8.0f} ns -> {2:6.0f} ns  x{3:.1f}\n'.format(
+                name, before, after, before / after
+            )
+        )
+    for name, func, argument in [
+        ('flags_to_bits', flags.flags_to_bits, '12301011'),
+        ('bits_to_flags', flags.bits_to_flags, 0x4a79),
+        ('parse_state', lambda replies: flags.parse_state(*replies),
+         ('12010000', '10100000', '0101', '10310200')),
+        ('DeviceState.diff', _STATE.diff, flags.DeviceState()),
+    ]:
+        after = measure(func, argument, number)
+        results[name] = {'after_ns': after}
+        sys.stderr.write('{0:20} {1:>8} -> {2:6.0f} ns\n'.format(
+            name, '', after
+        ))
+    return results
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-n', '--number',
+        type=int,
+        default=100000,
+        help='calls per measurement[100000]'
+    )
+    parser.add_argument(
+        '-o', '--output',
+        help='file to write the JSON results to'
+    )
+    args = parser.parse_args()
+
+    results = run(args.number)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,313 @@
+"""
+Benchmarks keiko end to end against the simulator.
+
+Measures commands/sec and latency percentiles of the RawClient commands,
+the Client status properties and setters, and every route of keiko.app,
+and writes the results as JSON so runs can be compared across commits:
+
+    $ python benchmarks/run.py -o before.json
+    $ git checkout my-branch
+    $ python benchmarks/run.py -o after.json
+    $ python benchmarks/run.py --compare before.json after.json
+"""
+
+import json
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import keiko  # noqa: E402
+from keiko.clients import Client  # noqa: E402
+from keiko.simulator import Simulator  # noqa: E402
+
+try:
+    import keiko.app as api
+except ImportError:  # Flask is not installed
+    api = None
+
+
+_BENCHMARKS = []
+
+
+def benchmark(name, group):
+    """Registers func(client) as the benchmark <group>.<name>."""
+    def decorator(func):
+        _BENCHMARKS.append((group + '.' + name, func))
+        return func
+    return decorator
+
+
+def percentile(samples, p):
+    index = min(len(samples) - 1, int(round(p / 100.0 * (len(samples) - 1))))
+    return samples[index]
+
+
+def measure(func, iterations, threads=1, warmup=10):
+    """Runs func() <iterations> times in each of <threads> threads.
+
+    Returns the throughput and the latency percentiles in milliseconds.
+    """
+    for _ in range(warmup):
+        func()
+    latencies = []
+    lock = threading.Lock()
+
+    def worker():
+        samples = []
+        for _ in range(iterations):
+            start = time.time()
+            func()
+            samples.append(time.time() - start)
+        with lock:
+            latencies.extend(samples)
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    start = time.time()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.time() - start
+    latencies.sort()
+    return {
+        'ops_per_sec': len(latencies) / elapsed,
+        'mean_ms': sum(latencies) / len(latencies) * 1000,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p90_ms': percentile(latencies, 90) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'max_ms': latencies[-1] * 1000,
+        'iterations': len(latencies),
+        'threads': threads
+    }
+
+
+# RawClient
+for _name, _call in [
+    ('acop_read', lambda c: c.raw.acop()),
+    ('acop_write', lambda c: c.raw.acop('1XXXXXXX')),
+    ('acop_unit2_read', lambda c: c.raw.acop(unit=2)),
+    ('rops', lambda c: c.raw.rops()),
+    ('spop_read', lambda c: c.raw.spop()),
+    ('spop_write', lambda c: c.raw.spop('00000000')),
+    ('rly1_read', lambda c: c.raw.rly1()),
+    ('ryot_read', lambda c: c.raw.ryot(1)),
+    ('rdmn', lambda c: c.raw.rdmn()),
+    ('utid', lambda c: c.raw.utid()),
+    ('vern', lambda c: c.raw.vern())
+]:
+    benchmark(_name, 'raw')(_call)
+
+
+@benchmark('pipeline_4', 'raw')
+def _pipeline(client):
+    client.raw.pipeline().acop().acop(unit=2).rops().spop().execute()
+
+
+# Client
+for _name, _call in [
+    ('lamps.status', lambda c: c.lamps.status),
+    ('lamps.red.status', lambda c: c.lamps.red.status),
+    ('lamps.red.on', lambda c: c.lamps.red.on()),
+    ('lamps.off', lambda c: c.lamps.off()),
+    ('buzzer.status', lambda c: c.buzzer.status),
+    ('buzzer.off', lambda c: c.buzzer.off()),
+    ('do.status', lambda c: c.do.status),
+    ('do.on', lambda c: c.do(1).on()),
+    ('di.status', lambda c: c.di.status),
+    ('voices.status', lambda c: c.voices.status),
+    ('voices.stop', lambda c: c.voices.stop()),
+    ('snapshot', lambda c: c.snapshot())
+]:
+    benchmark(_name, 'client')(_call)
+
+
+# keiko.app
+_ROUTES = {
+    'index': '/',
+    'get_metrics': '/metrics',
+    'get_snapshot': '/snapshot',
+    'get_all_lamps': '/lamps',
+    'get_lamp': '/lamps/red',
+    'set_lamp': '/lamps/red/on',
+    'set_all_lamps_off': '/lamps/off',
+    'get_buzzer': '/buzzer',
+    'set_buzzer': '/buzzer/on',
+    'get_all_dos': '/do',
+    'get_do': '/do/1',
+    'set_do': '/do/1/on',
+    'get_all_dis': '/di',
+    'get_di': '/di/1',
+    'get_all_voices': '/voices',
+    'get_voice': '/voices/1',
+    'set_voice': '/voices/1/play',
+    'set_all_voices_stop': '/voices/stop',
+    'get_contract': '/contract',
+    'get_model': '/model',
+    'get_productiondate': '/productiondate',
+    'get_serialnumber': '/serialnumber',
+    'get_unitid': '/unitid',
+    'get_version': '/version'
+}
+# streams, POST and fleet routes
+_UNTIMED_ROUTES = set([
+    'static', 'get_stream', 'post_batch', 'get_devices', 'get_history'
+])
+
+
+def _app_benchmarks():
+    if api is None:
+        return []
+    app = api.app
+    endpoints = set(
+        rule.endpoint for rule in app.url_map.iter_rules()
+        if not rule.endpoint.startswith('device_')  # same views
+    )
+    endpoints -= _UNTIMED_ROUTES
+    missing = endpoints - set(_ROUTES)
+    if missing:
+        sys.stderr.write('No benchmark for routes: {0}\n'.format(
+            ', '.join(sorted(missing))
+        ))
+    http = app.test_client()
+
+    def get(url):
+        response = http.get(url)
+        if response.status_code != 200:
+            raise Exception('{0} {1}'.format(url, response.status))
+    return [
+        ('app.' + endpoint, lambda client, url=url: get(url))
+        for endpoint, url in sorted(_ROUTES.items())
+        if endpoint in endpoints
+    ]
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).decode('ascii').strip()
+    except Exception:
+        return None
+
+
+def run(iterations, threads, latency, pattern=None):
+    with Simulator(latency=latency) as simulator:
+        client = Client('127.0.0.1', simulator.port, pool_size=threads)
+        if api is not None:
+            api.app.keiko = client
+        results = {}
+        for name, func in _BENCHMARKS + _app_benchmarks():
+            if pattern and pattern not in name:
+                continue
+            results[name] = measure(
+                lambda: func(client), iterations, threads
+            )
+            sys.stderr.write('{0:32} {1[ops_per_sec]:10.1f} ops/s  '
+                             'p50 {1[p50_ms]:.3f} ms  '
+                             'p99 {1[p99_ms]:.3f} ms\n'.format(
+                                 name, results[name]))
+        client.raw.close()
+    return {
+        'meta': {
+            'keiko': keiko.__version__,
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'timestamp': time.time(),
+            'iterations': iterations,
+            'threads': threads,
+            'latency': latency
+        },
+        'results': results
+    }
+
+
+def compare(before, after, threshold):
+    """Prints the change of each benchmark and returns the regressions."""
+    regressions = []
+    print('{0:32} {1:>12} {2:>12} {3:>8}'.format(
+        'benchmark', 'before ops/s', 'after ops/s', 'change'
+    ))
+    for name in sorted(after['results']):
+        if name not in before['results']:
+            continue
+        old = before['results'][name]['ops_per_sec']
+        new = after['results'][name]['ops_per_sec']
+        change = (new - old) / old
+        mark = ''
+        if change < -threshold:
+            regressions.append(name)
+            mark = ' !'
+        print('{0:32} {1:12.1f} {2:12.1f} {3:+7.1%}{4}'.format(
+            name, old, new, change, mark
+        ))
+    return regressions
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-o', '--output',
+        help='file to write the JSON results to[stdout]'
+    )
+    parser.add_argument(
+        '-n', '--iterations',
+        type=int,
+        default=500,
+        help='iterations per thread[500]'
+    )
+    parser.add_argument(
+        '-t', '--threads',
+        type=int,
+        default=1,
+        help='concurrent threads[1]'
+    )
+    parser.add_argument(
+        '--latency',
+        type=float,
+        default=0.0,
+        help='reply delay of the simulator in seconds[0.0]'
+    )
+    parser.add_argument(
+        '-k', '--pattern',
+        help='run only the benchmarks whose name contains PATTERN'
+    )
+    parser.add_argument(
+        '--compare',
+        nargs=2,
+        metavar=('BEFORE', 'AFTER'),
+        help='compare two JSON results instead of running'
+    )
+    parser.add_argument(
+        '--threshold',
+        type=float,
+        default=0.1,
+        help='slowdown reported as a regression by --compare[0.1]'
+    )
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            before = json.load(f)
+        with open(args.compare[1]) as f:
+            after = json.load(f)
+        sys.exit(1 if compare(before, after, args.threshold) else 0)
+
+    results = run(args.iterations, args.threads, args.latency, args.pattern)
+    data = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(data)
+    else:
+        print(data)
+
+
+if __name__ == '__main__':
+    main()
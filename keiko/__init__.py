@@ -8,6 +8,6 @@ keiko is Python and Web API clients for Keiko-chan.
 __version__ = '0.2.0'
 
 
-from .clients import Client
+from .clients import Client, CommandError, ReplyError, DeadlineExceeded
 
-__all__ = ['Client']
+__all__ = ['Client', 'CommandError', 'ReplyError', 'DeadlineExceeded']
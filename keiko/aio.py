@@ -0,0 +1,681 @@
+"""
+Provides asyncio client classes for Keiko-chan.
+
+The API mirrors keiko.clients, except that every command method and every
+status property returns an awaitable:
+
+    client = AsyncClient(address)
+    await client.lamps.red.on()
+    state = await client.lamps.red.status
+
+Requires Python 3.6 or later.
+"""
+
+import asyncio
+import logging
+import socket
+import time
+
+from .connection import DeadlineExceeded, _limit
+from .cache import SharedReads, StateCache
+from .metrics import REGISTRY
+from .stream import _same_state
+from .watch import EdgeDetector
+from .clients import (
+    BaseRawClient, Batch, CommandError, ReplyError, Pipeline, Snapshot,
+    _cached_replies, _desired_reads, _desired_changes,
+    LampHolder, Lamp, Buzzer, DOHolder, DO, DIHolder, DI, VoiceHolder, Voice
+)
+from .flags import (
+    parse_lamp_flags, parse_buzzer_flags, parse_do_flags, parse_di_flags,
+    parse_voice_flags
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncClient(object):
+    """Provides high level asyncio APIs to control Keiko-chan."""
+
+    def __init__(self, address, port=60000, cache_ttl=None, **options):
+        self.cache = StateCache(cache_ttl) if cache_ttl else None
+        self.raw = AsyncRawClient(address, port, cache=self.cache, **options)
+        self.lamps = AsyncLampHolder(self.raw)
+        self.buzzer = AsyncBuzzer(self.raw)
+        self.do = AsyncDOHolder(self.raw)
+        self.di = AsyncDIHolder(self.raw)
+        self.voices = AsyncVoiceHolder(self.raw)
+
+    def close(self):
+        self.raw.close()
+
+    async def snapshot(self):
+        """Returns the whole state of Keiko-chan as a Snapshot."""
+        replies = _cached_replies(self.cache)
+        missing = [read for read in Snapshot.reads if read not in replies]
+        replies.update(zip(missing, await self.raw.execute_many(missing)))
+        return Snapshot.from_replies(time.time(), replies)
+
+    def batch(self, wait=0, time=0):
+        """Returns an AsyncBatch, to be used with async with."""
+        return AsyncBatch(self.raw, wait, time)
+
+    async def apply(self, desired, wait=0, time=0):
+        """Brings Keiko-chan to the <desired> state like Client.apply()."""
+        reads = _desired_reads(desired)
+        replies = _cached_replies(self.cache)
+        missing = [read for read in reads if read not in replies]
+        if missing:
+            replies.update(zip(missing, await self.raw.execute_many(missing)))
+        batch = self.batch(wait, time)
+        changes = _desired_changes(batch, desired, replies)
+        if changes:
+            await batch.send()
+        return changes
+
+
+class AsyncBatch(Batch):
+    """Collects changes like keiko.clients.Batch; send() is a coroutine.
+
+    The status of the holders of the batch is read at once, and is
+    awaitable as that of the holders of AsyncClient.
+    """
+
+    def __init__(self, rawclient, wait=0, time=0):
+        super(AsyncBatch, self).__init__(rawclient, wait, time)
+        recorder = self.lamps.raw
+        self.lamps = AsyncLampHolder(recorder)
+        self.buzzer = AsyncBuzzer(recorder)
+        self.do = AsyncDOHolder(recorder)
+        self.voices = AsyncVoiceHolder(recorder)
+
+    def __enter__(self):
+        raise TypeError('use async with for the batch of an AsyncClient')
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        raise TypeError('use async with for the batch of an AsyncClient')
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            await self.send()
+        else:
+            self.clear()
+
+
+class AsyncLampHolder(LampHolder):
+    """Holds the lamps."""
+
+    def __init__(self, rawclient):
+        self.raw = rawclient
+        self.red = AsyncLamp(self.raw, 'red')
+        self.yellow = AsyncLamp(self.raw, 'yellow')
+        self.green = AsyncLamp(self.raw, 'green')
+
+    @property
+    def status(self):
+        """Returns all the lamps state."""
+        return self._status()
+
+    async def _status(self):
+        flags = await self.raw.acop()
+        states = parse_lamp_flags(flags)
+        return states['lamps']
+
+
+class AsyncLamp(Lamp):
+    """A client to control the lamp."""
+
+    @property
+    def status(self):
+        """Returns the lamp state."""
+        return self._status()
+
+    async def _status(self):
+        flags = await self.raw.acop()
+        states = parse_lamp_flags(flags)
+        return states['lamps'][self.color]
+
+
+class AsyncBuzzer(Buzzer):
+    """A client to control the buzzer."""
+
+    @property
+    def status(self):
+        """Returns the buzzer state."""
+        return self._status()
+
+    async def _status(self):
+        flags = await self.raw.acop()
+        states = parse_buzzer_flags(flags)
+        return states['buzzer']
+
+
+class AsyncDOHolder(DOHolder):
+    """Holds the DOs."""
+
+    def __call__(self, term):
+        return AsyncDO(self.raw, term)
+
+    @property
+    def status(self):
+        """Returns all the DOs state."""
+        return self._status()
+
+    async def _status(self):
+        flags = await self.raw.acop(unit=2)
+        states = parse_do_flags(flags)
+        return states['do']
+
+
+class AsyncDO(DO):
+    """A client to control the direct output."""
+
+    @property
+    def status(self):
+        """Returns the DO state."""
+        return self._status()
+
+    async def _status(self):
+        flags = await self.raw.acop(unit=2)
+        states = parse_do_flags(flags)
+        return states['do'][self.term]
+
+
+class AsyncDIHolder(DIHolder):
+    """Holds the DIs."""
+
+    def __call__(self, term):
+        return AsyncDI(self.raw, term)
+
+    @property
+    def status(self):
+        """Returns all the DIs state."""
+        return self._status()
+
+    async def _status(self):
+        flags = await self.raw.rops()
+        states = parse_di_flags(flags)
+        return states['di']
+
+
+class AsyncDI(DI):
+    """A client to control the direct input."""
+
+    @property
+    def status(self):
+        """Returns the DI state."""
+        return self._status()
+
+    async def _status(self):
+        flags = await self.raw.rops()
+        states = parse_di_flags(flags)
+        return states['di'][self.term]
+
+
+class AsyncVoiceHolder(VoiceHolder):
+    """Holds the voices."""
+
+    def __call__(self, number):
+        return AsyncVoice(self.raw, number)
+
+    @property
+    def status(self):
+        """Returns the voices state."""
+        return self._status()
+
+    async def _status(self):
+        flags = await self.raw.spop()
+        states = parse_voice_flags(flags)
+        return states['voice']
+
+
+class AsyncVoice(Voice):
+
+    @property
+    def status(self):
+        """Returns the voice state."""
+        return self._status()
+
+    async def _status(self):
+        flags = await self.raw.spop()
+        states = parse_voice_flags(flags)
+        state = states['voice']
+        if state == 'stop':
+            return 'stop'
+        if state['number'] == self.number:
+            return 'play'
+        else:
+            return 'stop'
+
+
+async def watch_di(rawclient, interval=0.1, max_interval=1.0, backoff=1.5,
+                   debounce=0.0):
+    """Samples ROPS and yields the DI edges as keiko.watch.DIEvent.
+
+        async for event in watch_di(client.raw):
+            print(event.term, event.edge)
+
+    Polls like keiko.watch.DIWatcher.
+    """
+    detector = EdgeDetector(debounce)
+    current_interval = interval
+    while True:
+        events = detector.feed(await rawclient.rops())
+        for event in events:
+            yield event
+        if events or detector.pending:
+            current_interval = interval
+        else:
+            current_interval = min(current_interval * backoff, max_interval)
+        await asyncio.sleep(current_interval)
+
+
+class AsyncSharedReads(SharedReads):
+    """Collapses concurrent identical reads into one task.
+
+    Like keiko.cache.SharedReads, except that func() returns an awaitable.
+    A caller that gives up after <patience> seconds gets the last value,
+    and the read goes on to refresh it for later callers.
+    """
+
+    def __init__(self, stale=5.0, patience=0.5):
+        super(AsyncSharedReads, self).__init__(stale, patience)
+        self._waiters = {}  # {task: callers awaiting it}
+
+    async def read(self, key, func):
+        """Returns (<value>, <age>) read by awaiting func().
+
+        A cancelled caller cancels the read only if no other caller is
+        awaiting it.
+        """
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._run(key, func))
+            self._calls[key] = task
+        self._waiters[task] = self._waiters.get(task, 0) + 1
+        try:
+            if self._stale(key) is not None:
+                try:
+                    return await asyncio.wait_for(
+                        asyncio.shield(task), self.patience
+                    )
+                except asyncio.TimeoutError:
+                    stale = self._stale(key)
+                    if stale is not None:
+                        return stale
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if self._waiters[task] == 1:
+                task.cancel()
+            raise
+        finally:
+            self._waiters[task] -= 1
+            if not self._waiters[task]:
+                del self._waiters[task]
+
+    async def _run(self, key, func):
+        try:
+            value = await func()
+        except Exception:
+            stale = self._stale(key)
+            if stale is None:
+                raise
+            return stale
+        finally:
+            del self._calls[key]
+        self._last[key] = (value, time.time())
+        return value, None
+
+
+class AsyncStatePoller(object):
+    """Polls AsyncClient.snapshot() in one task for any number of
+    subscribers.
+
+    Like keiko.stream.StatePoller, except that the poller is a task of the
+    event loop and the subscriptions are async iterators.
+    """
+
+    def __init__(self, client, interval=1.0, max_queue=16):
+        self.client = client
+        self.interval = interval
+        self.max_queue = max_queue
+        self.snapshot = None  # the last published snapshot
+        self._subscribers = set()
+        self._task = None
+
+    def subscribe(self, heartbeat=15.0):
+        """Returns an AsyncSubscription that receives the snapshots.
+
+        The last snapshot, if any, is received first.
+        """
+        subscription = AsyncSubscription(self, self.max_queue, heartbeat)
+        if self.snapshot is not None:
+            subscription.put(('state', self.snapshot))
+        self._subscribers.add(subscription)
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self._subscribers.discard(subscription)
+        if not self._subscribers and self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    @property
+    def subscribers(self):
+        return len(self._subscribers)
+
+    def _publish(self, event):
+        for subscription in list(self._subscribers):
+            subscription.put(event)
+
+    async def poll(self):
+        """Reads the state once and publishes it if it has changed."""
+        snapshot = await self.client.snapshot()
+        previous = self.snapshot
+        if previous is not None and _same_state(previous, snapshot):
+            return False
+        self.snapshot = snapshot
+        self._publish(('state', snapshot))
+        return True
+
+    async def _run(self):
+        while True:
+            try:
+                await self.poll()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception('Failed to poll Keiko-chan')
+                self._publish(('error', e))
+            await asyncio.sleep(self.interval)
+
+
+class AsyncSubscription(object):
+    """Iterates the events of an AsyncStatePoller with async for.
+
+    See keiko.stream.Subscription.
+    """
+
+    def __init__(self, poller, max_queue, heartbeat):
+        self.poller = poller
+        self.heartbeat = heartbeat
+        self._queue = asyncio.Queue(max_queue)
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.closed:
+            raise StopAsyncIteration
+        try:
+            return await asyncio.wait_for(self._queue.get(), self.heartbeat)
+        except asyncio.TimeoutError:
+            return ('heartbeat', None)
+
+    def put(self, event):
+        # a slow subscriber only misses the oldest states
+        if self._queue.full():
+            self._queue.get_nowait()
+        self._queue.put_nowait(event)
+
+    def close(self):
+        self.closed = True
+        self.poller.unsubscribe(self)
+
+
+class AsyncConnection(object):
+    """An asyncio TCP connection to Keiko-chan."""
+
+    def __init__(self, address, port=60000, nodelay=True, keepalive=True,
+                 connect_timeout=None, timeout=None):
+        self.address = address
+        self.port = port
+        self.nodelay = nodelay
+        self.keepalive = keepalive
+        self.connect_timeout = connect_timeout
+        self.timeout = timeout
+        self.reader = None
+        self.writer = None
+        self.last_used = 0
+
+    @property
+    def connected(self):
+        return self.writer is not None
+
+    async def connect(self, deadline=None):
+        """Connects to Keiko-chan."""
+        reader, writer = await _wait(
+            asyncio.open_connection(self.address, self.port),
+            self.connect_timeout, deadline
+        )
+        sock = writer.get_extra_info('socket')
+        if sock is not None:
+            if self.nodelay:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if self.keepalive:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self.reader, self.writer = reader, writer
+        self.last_used = time.time()
+
+    def close(self):
+        """Closes the connection."""
+        if self.writer is not None:
+            try:
+                self.writer.close()
+            finally:
+                self.reader = self.writer = None
+
+    async def send(self, data, deadline=None):
+        self.writer.write(data)
+        await _wait(self.writer.drain(), self.timeout, deadline)
+        self.last_used = time.time()
+
+    async def recv(self, deadline=None):
+        """Reads one reply terminated by CR."""
+        try:
+            reply = await _wait(
+                self.reader.readuntil(b'\r'), self.timeout, deadline
+            )
+        except asyncio.IncompleteReadError:
+            raise ConnectionError('Connection closed by Keiko-chan')
+        self.last_used = time.time()
+        return reply
+
+
+class AsyncConnectionPool(object):
+    """A pool of persistent asyncio connections to Keiko-chan.
+
+    Works like keiko.connection.ConnectionPool, but waits for a free
+    connection without blocking the event loop.
+    """
+
+    def __init__(self, address, port=60000, size=4, idle_timeout=30.0,
+                 **options):
+        self.address = address
+        self.port = port
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.options = options
+        self._idle = []
+        self._semaphore = None  # created lazily inside the running loop
+
+    async def acquire(self, deadline=None):
+        """Takes a connection from the pool, waiting for one if needed."""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.size)
+        await _wait(self._semaphore.acquire(), None, deadline)
+        while self._idle:
+            conn = self._idle.pop()
+            if time.time() - conn.last_used <= self.idle_timeout:
+                return conn
+            conn.close()
+        return AsyncConnection(self.address, self.port, **self.options)
+
+    def release(self, conn, discard=False):
+        """Returns a connection to the pool, or closes it if <discard>."""
+        if discard or not conn.connected:
+            conn.close()
+        else:
+            self._idle.append(conn)
+        self._semaphore.release()
+
+    def clear(self):
+        """Closes all the idle connections."""
+        while self._idle:
+            self._idle.pop().close()
+
+
+class AsyncRawClient(BaseRawClient):
+    """Provides low level asyncio APIs to control Keiko-chan.
+
+    Timeouts and retries work as in keiko.clients.RawClient.
+    """
+
+    def __init__(self, address, port=60000, pool_size=4, idle_timeout=30.0,
+                 nodelay=True, keepalive=True, connect_timeout=3.0,
+                 timeout=5.0, deadline=None, retries=2, backoff=0.05,
+                 max_backoff=1.0, metrics=REGISTRY, cache=None,
+                 journal=None):
+        self.address = address
+        self.port = port
+        self.cache = cache
+        self.journal = journal
+        self._init_metrics(metrics)
+        self.deadline = deadline
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.pool = AsyncConnectionPool(
+            address, port, size=pool_size, idle_timeout=idle_timeout,
+            nodelay=nodelay, keepalive=keepalive,
+            connect_timeout=connect_timeout, timeout=timeout
+        )
+
+    def close(self):
+        """Closes the idle pooled connections."""
+        self.pool.clear()
+
+    async def _send(self, command):
+        return (await self._send_many([command]))[0]
+
+    async def _send_many(self, commands):
+        data = self._build_data(commands)
+        deadline = self._deadline()
+        retries = self._retries(commands)
+        attempt = 0
+        while True:
+            try:
+                replies = await self._send_once(data, len(commands), deadline)
+            except DeadlineExceeded:
+                raise
+            except OSError:
+                delay = self._backoff(attempt, deadline)
+                if attempt >= retries or delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            return [self._strip_data(reply) for reply in replies]
+
+    async def _send_once(self, data, count, deadline):
+        while True:
+            conn = await self.pool.acquire(deadline)
+            reused = conn.connected
+            replies = []
+            try:
+                if not reused:
+                    await conn.connect(deadline)
+                await conn.send(data, deadline)
+                for _ in range(count):
+                    replies.append(await conn.recv(deadline))
+            except socket.timeout:  # the command may have been done
+                self.pool.release(conn, discard=True)
+                raise
+            except OSError:
+                self.pool.release(conn, discard=True)
+                if reused and not replies:
+                    continue  # stale connection, reconnect and try again
+                raise
+            except BaseException:
+                self.pool.release(conn, discard=True)
+                raise
+            self.pool.release(conn)
+            return replies
+
+    async def _execute(self, command):
+        if self.cache is not None:
+            cached = self.cache.get(command)
+            if cached is not None:
+                return cached
+        start = time.time()
+        generations = self._generations([command])
+        try:
+            result = self._check_result(command, await self._send(command))
+        except Exception as e:
+            self._observe([command], time.time() - start, [e], generations)
+            raise
+        self._observe([command], time.time() - start, [result], generations)
+        return result
+
+    async def execute_many(self, commands, raise_on_error=True):
+        """Sends the commands on a single connection and returns the results.
+
+        See RawClient.execute_many.
+        """
+        start = time.time()
+        generations = self._generations(commands)
+        try:
+            replies = await self._send_many(commands)
+        except Exception as e:
+            self._observe(commands, time.time() - start,
+                          [e] * len(commands), generations)
+            raise
+        results = []
+        for command, result in zip(commands, replies):
+            try:
+                results.append(self._check_result(command, result))
+            except (CommandError, ReplyError) as e:
+                results.append(e)
+        self._observe(commands, time.time() - start, results, generations)
+        if raise_on_error:
+            for result in results:
+                if isinstance(result, (CommandError, ReplyError)):
+                    raise result
+        return results
+
+    def pipeline(self):
+        """Returns an AsyncPipeline that buffers commands."""
+        return AsyncPipeline(self)
+
+
+class AsyncPipeline(Pipeline):
+    """Buffers commands and sends them at once on a single connection."""
+
+    async def execute(self, raise_on_error=True):
+        """Sends the buffered commands and returns their results."""
+        commands, self.commands = self.commands, []
+        if not commands:
+            return []
+        return await self.raw.execute_many(commands, raise_on_error)
+
+
+async def _wait(awaitable, timeout, deadline):
+    """Awaits with the timeout of socket, shortened to the deadline."""
+    try:
+        timeout = _limit(timeout, deadline)
+    except DeadlineExceeded:
+        awaitable.close()
+        raise
+    try:
+        return await asyncio.wait_for(awaitable, timeout)
+    except asyncio.TimeoutError:
+        if deadline is not None and time.time() >= deadline:
+            raise DeadlineExceeded('Deadline exceeded')
+        raise socket.timeout('timed out')
@@ -2,33 +2,150 @@
 Provides Web API server for Keiko-chan.
 """
 
-from flask import Flask, request, jsonify, abort
-
-from .clients import Client
+import functools
+import io
+import json
+import threading
+import time
+from concurrent.futures import TimeoutError as _TimeoutError
+
+from flask import (
+    Flask, Response, g, request, jsonify, abort, make_response
+)
+from werkzeug.exceptions import HTTPException
+
+from .cache import SharedReads
+from .clients import Client, CommandError
+from .fleet import FleetClient
+from .journal import Journal
+from .metrics import REGISTRY
+from .stream import StatePoller
 
 
 app = Flask(__name__)
+app.keiko = None  # the Client of /..., see main()
+app.fleet = None  # the FleetClient of /devices/<id>/...
+app.journal = None  # the Journal of /history
+app.config.setdefault('STREAM_INTERVAL', 1.0)
+app.config.setdefault('READ_STALE', 5.0)
+app.config.setdefault('READ_PATIENCE', 0.5)
+
+_pollers = {}  # {id(client): StatePoller}
+_reads = {}  # {id(client): (client, SharedReads)}
+_shared_lock = threading.Lock()
+
+_http_duration = REGISTRY.histogram(
+    'keiko_http_request_duration_seconds',
+    'Time to handle API requests, by route.',
+    ('method', 'route', 'status')
+)
 
 
 _VALID_COLORS = ['green', 'yellow', 'red']
 _VALID_TERMS = ['1', '2', '3', '4']
 
 
+@app.before_request
+def start_timer():
+    g.start = time.time()
+    g.keiko = app.keiko
+
+
+@app.after_request
+def record_duration(response):
+    start = g.get('start')
+    if start is not None:
+        rule = request.url_rule.rule if request.url_rule else 'unmatched'
+        _http_duration.observe(
+            time.time() - start, request.method, rule, response.status_code
+        )
+    return response
+
+
 @app.route('/')
 def index():
     return 'keiko.py API server'
 
 
+@app.route('/metrics')
+def get_metrics():
+    return Response(
+        REGISTRY.render(), mimetype='text/plain; version=0.0.4'
+    )
+
+
+@app.route('/snapshot')
+def get_snapshot():
+    return jsonify(snapshot=g.keiko.snapshot().to_dict())
+
+
+def _get_poller(client):
+    with _shared_lock:
+        poller = _pollers.get(id(client))
+        if poller is None or poller.client is not client:
+            poller = StatePoller(client, app.config['STREAM_INTERVAL'])
+            _pollers[id(client)] = poller
+        return poller
+
+
+@app.route('/stream')
+def get_stream():
+    subscription = _get_poller(g.keiko).subscribe()
+
+    def events():
+        try:
+            for kind, value in subscription:
+                if kind == 'state':
+                    data = json.dumps(value.to_dict(), sort_keys=True)
+                    yield 'event: state\ndata: {0}\n\n'.format(data)
+                elif kind == 'error':
+                    yield 'event: error\ndata: {0}\n\n'.format(
+                        json.dumps(str(value))
+                    )
+                else:
+                    yield ': heartbeat\n\n'
+        finally:
+            subscription.close()
+    return Response(events(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'
+    })
+
+
+def _get_reads(client):
+    with _shared_lock:
+        entry = _reads.get(id(client))
+        if entry is None or entry[0] is not client:
+            entry = (client, SharedReads(
+                app.config['READ_STALE'], app.config['READ_PATIENCE']
+            ))
+            _reads[id(client)] = entry
+        return entry[1]
+
+
+def _shared_read(name, func):
+    """Returns the JSON of {<name>: func()} read once for concurrent requests.
+
+    The last value, with its age in the Age header, is returned instead
+    when Keiko-chan is slow or unreachable.
+    """
+    value, age = _get_reads(g.keiko).read(name, func)
+    response = make_response(jsonify(**{name: value}))
+    if age is not None:
+        response.headers['Age'] = str(int(age))
+        response.headers['Warning'] = '110 - "Response is Stale"'
+    return response
+
+
 @app.route('/lamps')
 def get_all_lamps():
-    return jsonify(lamps=app.keiko.lamps.status)
+    return _shared_read('lamps', lambda: g.keiko.lamps.status)
 
 
 @app.route('/lamps/<color>')
 def get_lamp(color):
     if color not in _VALID_COLORS:
         abort(400)
-    lamp = getattr(app.keiko.lamps, color)
+    lamp = getattr(g.keiko.lamps, color)
     return jsonify(lamps={color: lamp.status})
 
 
@@ -36,7 +153,7 @@ def get_lamp(color):
 def set_lamp(color, state):
     if color not in _VALID_COLORS:
         abort(400)
-    lamp = getattr(app.keiko.lamps, color)
+    lamp = getattr(g.keiko.lamps, color)
     wait = request.args.get('wait', 0)
     time = request.args.get('time', 0)
     if state in ['on', 'blink', 'quickblink']:
@@ -51,13 +168,13 @@ def set_lamp(color, state):
 @app.route('/lamps/off')
 def set_all_lamps_off():
     wait = request.args.get('wait', 0)
-    app.keiko.lamps.off(wait)
+    g.keiko.lamps.off(wait)
     return jsonify(result='success')
 
 
 @app.route('/buzzer')
 def get_buzzer():
-    return jsonify(buzzer=app.keiko.buzzer.status)
+    return _shared_read('buzzer', lambda: g.keiko.buzzer.status)
 
 
 @app.route('/buzzer/<state>')
@@ -65,9 +182,9 @@ def set_buzzer(state):
     wait = request.args.get('wait', 0)
     time = request.args.get('time', 0)
     if state in ['on', 'continuous', 'intermittent']:
-        getattr(app.keiko.buzzer, state)(wait, time)
+        getattr(g.keiko.buzzer, state)(wait, time)
     elif state == 'off':
-        app.keiko.buzzer.off(wait)
+        g.keiko.buzzer.off(wait)
     else:
         abort(400)
     return jsonify(result='success')
@@ -75,14 +192,14 @@ def set_buzzer(state):
 
 @app.route('/do')
 def get_all_dos():
-    return jsonify(do=app.keiko.do.status)
+    return _shared_read('do', lambda: g.keiko.do.status)
 
 
 @app.route('/do/<term>')
 def get_do(term):
     if term not in _VALID_TERMS:
         abort(400)
-    do = app.keiko.do(int(term))
+    do = g.keiko.do(int(term))
     return jsonify(do={term: do.status})
 
 
@@ -90,7 +207,7 @@ def get_do(term):
 def set_do(term, state):
     if term not in _VALID_TERMS:
         abort(400)
-    do = app.keiko.do(int(term))
+    do = g.keiko.do(int(term))
     wait = request.args.get('wait', 0)
     time = request.args.get('time', 0)
     if state == 'on':
@@ -104,27 +221,27 @@ def set_do(term, state):
 
 @app.route('/di')
 def get_all_dis():
-    return jsonify(di=app.keiko.di.status)
+    return _shared_read('di', lambda: g.keiko.di.status)
 
 
 @app.route('/di/<term>')
 def get_di(term):
     if term not in _VALID_TERMS:
         abort(400)
-    di = app.keiko.di(int(term))
+    di = g.keiko.di(int(term))
     return jsonify(di={term: di.status})
 
 
 @app.route('/voices')
 def get_all_voices():
-    return jsonify(voices=app.keiko.voices.status)
+    return jsonify(voices=g.keiko.voices.status)
 
 
 @app.route('/voices/<number>')
 def get_voice(number):
     if not (number.isdigit() and 1 <= int(number) <= 20):
         abort(400)
-    voice = app.keiko.voices(int(number))
+    voice = g.keiko.voices(int(number))
     return jsonify(voices={number: voice.status})
 
 
@@ -132,7 +249,7 @@ def get_voice(number):
 def set_voice(number, state):
     if not (number.isdigit() and 1 <= int(number) <= 20):
         abort(400)
-    voice = app.keiko.voices(int(number))
+    voice = g.keiko.voices(int(number))
     times = request.args.get('times', 1)
     if state == 'play':
         voice.play(times)
@@ -145,44 +262,169 @@ def set_voice(number, state):
 
 @app.route('/voices/stop')
 def set_all_voices_stop():
-    app.keiko.voices.stop()
+    g.keiko.voices.stop()
     return jsonify(result='success')
 
 
+@app.route('/batch', methods=['POST'])
+def post_batch():
+    operations = request.get_json(silent=True)
+    if not isinstance(operations, list) or not operations:
+        abort(400)
+    batch = g.keiko.batch()
+    indexes = []
+    errors = []
+    for i, operation in enumerate(operations):
+        try:
+            indexes.append(batch.apply(operation))
+        except ValueError as e:
+            errors.append({'index': i, 'error': str(e)})
+    if errors:
+        return make_response(jsonify(result='error', errors=errors), 400)
+    replies = batch.send(raise_on_error=False)
+    return jsonify(results=[_batch_result(replies[i]) for i in indexes])
+
+
+def _batch_result(reply):
+    if not isinstance(reply, Exception):
+        return {'result': 'success'}
+    result = {'result': 'error', 'error': str(reply)}
+    if isinstance(reply, CommandError):
+        result['code'] = reply.code
+    return result
+
+
+@app.route('/history')
+def get_history():
+    if app.journal is None:
+        abort(404)
+    try:
+        start, end = [
+            float(request.args[key]) if key in request.args else None
+            for key in ('start', 'end')
+        ]
+        limit = int(request.args.get('limit', 1000))
+    except ValueError:
+        abort(400)
+    device = request.args.get('device')
+    if request.view_args.get('device') is not None:  # /devices/<id>/history
+        device = '{0}:{1}'.format(g.keiko.raw.address, g.keiko.raw.port)
+    entries = app.journal.query(start, end, device, limit)
+    return jsonify(history=[entry.to_dict() for entry in entries])
+
+
 @app.route('/contract')
 def get_contract():
     return jsonify(contract={
-        'deadline': app.keiko.raw.rdcd(),
-        'number': app.keiko.raw.rdcn()
+        'deadline': g.keiko.raw.rdcd(),
+        'number': g.keiko.raw.rdcn()
     })
 
 
 @app.route('/model')
 def get_model():
-    return jsonify(model=app.keiko.raw.rdmn())
+    return jsonify(model=g.keiko.raw.rdmn())
 
 
 @app.route('/productiondate')
 def get_productiondate():
-    return jsonify(productiondate=app.keiko.raw.rdpd())
+    return jsonify(productiondate=g.keiko.raw.rdpd())
 
 
 @app.route('/serialnumber')
 def get_serialnumber():
-    return jsonify(serialnumber=app.keiko.raw.rdsn())
+    return jsonify(serialnumber=g.keiko.raw.rdsn())
 
 
 @app.route('/unitid')
 def get_unitid():
-    return jsonify(unitid=app.keiko.raw.utid())
+    return jsonify(unitid=g.keiko.raw.utid())
 
 
 @app.route('/version')
 def get_version():
-    return jsonify(version=app.keiko.raw.vern())
+    return jsonify(version=g.keiko.raw.vern())
+
+
+@app.route('/devices')
+def get_devices():
+    if app.fleet is None:
+        abort(404)
+    return jsonify(devices=sorted(app.fleet.clients))
+
+
+def _device_view(view):
+    """Serves <view> for the device of /devices/<device>/..., or for all
+    the devices at once if <device> is *.
+    """
+    @functools.wraps(view)
+    def wrapper(device, **kwargs):
+        if app.fleet is None:
+            abort(404)
+        if device == '*':
+            if view is get_stream:
+                abort(404)  # streams do not end
+            return _fan_out(view, kwargs)
+        client = app.fleet.clients.get(device)
+        if client is None:
+            abort(404)
+        g.keiko = client
+        return view(**kwargs)
+    return wrapper
+
+
+def _fan_out(view, kwargs):
+    """Calls <view> for every device concurrently.
+
+    Returns {"devices": {<id>: <JSON>}, "errors": {<id>: <error>}}.
+    """
+    body = request.get_data()
+    environ = dict(request.environ)
+
+    def call(client):
+        # each worker gets its own request context for the client
+        with app.request_context(
+            dict(environ, **{'wsgi.input': io.BytesIO(body)})
+        ):
+            g.keiko = client
+            try:
+                response = app.make_response(view(**kwargs))
+            except HTTPException as e:
+                response = e.get_response()
+            try:  # Response.get_json() needs Werkzeug 2
+                data = json.loads(response.get_data(as_text=True))
+            except ValueError:
+                data = None
+            return response.status_code, data
+    result = app.fleet.map(call)
+    devices = {}
+    errors = {}
+    for key, (status, data) in result.items():
+        if status < 400:
+            devices[key] = data
+        else:
+            errors[key] = {'status': status, 'error': data}
+    for key, error in result.errors.items():
+        status = 504 if isinstance(error, _TimeoutError) else 502
+        errors[key] = {'status': status, 'error': str(error)}
+    if not devices and len(set(e['status'] for e in errors.values())) == 1:
+        status = next(iter(errors.values()))['status']
+    else:
+        status = 200
+    return make_response(jsonify(devices=devices, errors=errors), status)
+
 
+for _rule in list(app.url_map.iter_rules()):
+    if _rule.endpoint not in ('static', 'get_metrics', 'get_devices'):
+        app.add_url_rule(
+            '/devices/<device>' + _rule.rule.rstrip('/'),
+            'device_' + _rule.endpoint,
+            _device_view(app.view_functions[_rule.endpoint]),
+            methods=_rule.methods
+        )
 
-def main():
+
+def main(argv=None):
     import argparse
     import logging
     import os
@@ -191,13 +433,51 @@ def main():
     parser.add_argument(
         'address',
         metavar='ADDRESS',
+        nargs='?',
         help='address of Keiko-chan'
     )
     parser.add_argument(
         '--port',
+        type=int,
         default=60000,
         help='port of Keiko-chan[60000]'
     )
+    parser.add_argument(
+        '--device',
+        metavar='ID=ADDRESS',
+        action='append',
+        default=[],
+        help='Keiko-chan served at /devices/ID/..., can be repeated'
+    )
+    parser.add_argument(
+        '--pool-size',
+        type=int,
+        default=4,
+        help='concurrent connections to each Keiko-chan[4]'
+    )
+    parser.add_argument(
+        '--scheduled',
+        action='store_true',
+        help='send the commands to each Keiko-chan one at a time, '
+             'writes first'
+    )
+    parser.add_argument(
+        '--fleet-timeout',
+        type=float,
+        default=5.0,
+        help='seconds to wait for each device in /devices/*/...[5.0]'
+    )
+    parser.add_argument(
+        '--journal',
+        metavar='PATH',
+        help='file to record the states in, served at /history'
+    )
+    parser.add_argument(
+        '--journal-size',
+        type=int,
+        default=0,
+        help='records kept in a new journal, 0 for all[0]'
+    )
     parser.add_argument(
         '--server',
         default='127.0.0.1:8080',
@@ -209,7 +489,15 @@ def main():
         default=False,
         help='run API server on debug mode[False]'
     )
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    if not args.address and not args.device:
+        parser.error('ADDRESS or --device is required')
+    devices = {}
+    for device in args.device:
+        key, _, address = device.partition('=')
+        if not key or not address:
+            parser.error('--device must be ID=ADDRESS: ' + device)
+        devices[key] = address
 
     log_handler = logging.FileHandler(
         os.path.join(os.getcwd(), 'error.log')
@@ -217,7 +505,19 @@ def main():
     log_handler.setLevel(logging.ERROR)
     app.logger.addHandler(log_handler)
 
-    app.keiko = Client(args.address, args.port)
+    if args.journal:
+        app.journal = Journal(args.journal, args.journal_size)
+    if args.address:
+        app.keiko = Client(
+            args.address, args.port, pool_size=args.pool_size,
+            scheduled=args.scheduled, journal=app.journal
+        )
+    if devices:
+        app.fleet = FleetClient(
+            devices, args.port, timeout=args.fleet_timeout,
+            pool_size=args.pool_size, scheduled=args.scheduled,
+            journal=app.journal
+        )
     app.debug = args.debug
     host, port = args.server.split(':')
     app.run(host=host, port=int(port))
@@ -0,0 +1,530 @@
+"""
+Provides asyncio Web API server for Keiko-chan.
+
+Serves the routes of keiko.app as an ASGI application on top of
+AsyncClient, so that a single process can serve many concurrent requests
+without a thread per request:
+
+    $ keiko-asgi 192.168.1.2 --server 127.0.0.1:8080
+
+Any ASGI server can run App(AsyncClient(address)). main() requires
+uvicorn. Requires Python 3.6 or later.
+"""
+
+import asyncio
+import json
+import logging
+import re
+import time
+from urllib.parse import parse_qs
+
+from .aio import AsyncClient, AsyncSharedReads, AsyncStatePoller
+from .clients import CommandError
+from .metrics import REGISTRY
+
+
+logger = logging.getLogger(__name__)
+
+_http_duration = REGISTRY.histogram(
+    'keiko_http_request_duration_seconds',
+    'Time to handle API requests, by route.',
+    ('method', 'route', 'status')
+)
+
+_VALID_COLORS = ['green', 'yellow', 'red']
+_VALID_TERMS = ['1', '2', '3', '4']
+
+_ROUTES = []  # [(rule, methods, handler)]
+
+
+class HTTPError(Exception):
+    """Aborts a request with the HTTP <status>."""
+
+    def __init__(self, status):
+        super(HTTPError, self).__init__(status)
+        self.status = status
+
+
+class Request(object):
+    """A request with its query <args> and <body>."""
+
+    def __init__(self, method, args, body=b''):
+        self.method = method
+        self.args = args
+        self.body = body
+
+    def json(self):
+        """Returns the body decoded as JSON, or None."""
+        try:
+            return json.loads(self.body.decode('utf-8'))
+        except ValueError:
+            return None
+
+
+class Response(object):
+    """A response other than the JSON of a dict.
+
+    <body> is bytes, or an async iterator of bytes that is streamed until
+    it ends or the client disconnects.
+    """
+
+    def __init__(self, body, content_type, status=200, headers=()):
+        self.body = body
+        self.content_type = content_type
+        self.status = status
+        self.headers = list(headers)
+
+
+def route(rule, methods=('GET', 'HEAD')):
+    """Registers handler(app, request, **params) for <rule> of keiko.app.
+
+    The handler returns a dict to be sent as JSON, or a Response.
+    """
+    def decorator(func):
+        _ROUTES.append((rule, methods, func))
+        return func
+    return decorator
+
+
+class App(object):
+    """An ASGI application that serves the routes of keiko.app.
+
+    Concurrent reads of /lamps, /buzzer, /do and /di share one command,
+    and the last value is served with the Age header for up to <stale>
+    seconds when Keiko-chan fails or does not reply within <patience>
+    seconds. The subscribers of /stream share one poll of the state every
+    <interval> seconds.
+    """
+
+    def __init__(self, client, stale=5.0, patience=0.5, interval=1.0):
+        self.keiko = client
+        self.reads = AsyncSharedReads(stale, patience)
+        self.poller = AsyncStatePoller(client, interval)
+        self._static = {}  # {path: (rule, methods, handler)}
+        self._dynamic = []  # [(pattern, rule, methods, handler)]
+        for rule, methods, handler in _ROUTES:
+            if '<' in rule:
+                pattern = re.compile(
+                    re.sub(r'<(\w+)>', r'(?P<\1>[^/]+)', rule) + '$'
+                )
+                self._dynamic.append((pattern, rule, methods, handler))
+            else:
+                self._static[rule] = (rule, methods, handler)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._http(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.keiko.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def match(self, path):
+        """Returns (<rule>, <methods>, <handler>, <params>) of <path>, or
+        None.
+        """
+        if path in self._static:
+            return self._static[path] + ({},)
+        for pattern, rule, methods, handler in self._dynamic:
+            match = pattern.match(path)
+            if match:
+                return rule, methods, handler, match.groupdict()
+        return None
+
+    async def handle(self, method, path, query=b'', body=b''):
+        """Returns the (<rule>, <Response>) to a request."""
+        matched = self.match(path)
+        if matched is None:
+            return 'unmatched', _error(404)
+        rule, methods, handler, params = matched
+        if method not in methods:
+            return rule, _error(405)
+        args = dict(
+            (key, values[0])
+            for key, values in parse_qs(query.decode('latin-1')).items()
+        )
+        request = Request(method, args, body)
+        try:
+            result = await handler(self, request, **params)
+        except HTTPError as e:
+            return rule, _error(e.status)
+        except Exception:
+            logger.exception('Failed to handle %s', path)
+            return rule, _error(500)
+        if isinstance(result, Response):
+            return rule, result
+        return rule, _json(result)
+
+    async def _http(self, scope, receive, send):
+        start = time.time()
+        body = b''
+        if scope['method'] == 'POST':
+            body = await _read_body(receive)
+        rule, response = await self.handle(
+            scope['method'], scope['path'], scope.get('query_string', b''),
+            body
+        )
+        body = response.body
+        headers = [
+            (b'content-type', response.content_type.encode('latin-1'))
+        ]
+        if isinstance(body, bytes):
+            headers.append(
+                (b'content-length', str(len(body)).encode('latin-1'))
+            )
+        for name, value in response.headers:
+            headers.append(
+                (name.lower().encode('latin-1'), value.encode('latin-1'))
+            )
+        await send({
+            'type': 'http.response.start',
+            'status': response.status,
+            'headers': headers
+        })
+        if isinstance(body, bytes):
+            await send({
+                'type': 'http.response.body',
+                'body': body if scope['method'] != 'HEAD' else b''
+            })
+        elif scope['method'] == 'HEAD':
+            await send({'type': 'http.response.body', 'body': b''})
+        else:
+            await _stream(body, receive, send)
+        _http_duration.observe(
+            time.time() - start, scope['method'], rule, response.status
+        )
+
+    async def shared_read(self, name, func):
+        """Returns {<name>: func()} read once for concurrent requests."""
+        value, age = await self.reads.read(name, func)
+        response = _json({name: value})
+        if age is not None:
+            response.headers.append(('Age', str(int(age))))
+            response.headers.append(('Warning', '110 - "Response is Stale"'))
+        return response
+
+
+async def _read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+
+async def _stream(chunks, receive, send):
+    async def disconnect():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+    disconnected = asyncio.ensure_future(disconnect())
+    try:
+        while True:
+            chunk = asyncio.ensure_future(chunks.__anext__())
+            await asyncio.wait(
+                [chunk, disconnected], return_when=asyncio.FIRST_COMPLETED
+            )
+            if not chunk.done():  # closes the iterator
+                chunk.cancel()
+                await asyncio.wait([chunk])
+                return
+            try:
+                body = chunk.result()
+            except StopAsyncIteration:
+                break
+            await send({
+                'type': 'http.response.body', 'body': body, 'more_body': True
+            })
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        disconnected.cancel()
+
+
+def _json(data, status=200):
+    body = json.dumps(data, sort_keys=True).encode('utf-8')
+    return Response(body, 'application/json', status)
+
+
+def _error(status):
+    return _json({'error': status}, status)
+
+
+@route('/')
+async def index(app, request):
+    return Response(b'keiko.py API server', 'text/html; charset=utf-8')
+
+
+@route('/metrics')
+async def get_metrics(app, request):
+    return Response(
+        REGISTRY.render().encode('utf-8'), 'text/plain; version=0.0.4'
+    )
+
+
+@route('/stream')
+async def get_stream(app, request):
+    async def events():
+        subscription = app.poller.subscribe()  # on the first event
+        try:
+            async for kind, value in subscription:
+                if kind == 'state':
+                    data = json.dumps(value.to_dict(), sort_keys=True)
+                    event = 'event: state\ndata: {0}\n\n'.format(data)
+                elif kind == 'error':
+                    event = 'event: error\ndata: {0}\n\n'.format(
+                        json.dumps(str(value))
+                    )
+                else:
+                    event = ': heartbeat\n\n'
+                yield event.encode('utf-8')
+        finally:
+            subscription.close()
+    return Response(events(), 'text/event-stream', headers=[
+        ('Cache-Control', 'no-cache'), ('X-Accel-Buffering', 'no')
+    ])
+
+
+@route('/snapshot')
+async def get_snapshot(app, request):
+    snapshot = await app.keiko.snapshot()
+    return {'snapshot': snapshot.to_dict()}
+
+
+@route('/lamps')
+async def get_all_lamps(app, request):
+    return await app.shared_read('lamps', lambda: app.keiko.lamps.status)
+
+
+@route('/lamps/off')
+async def set_all_lamps_off(app, request):
+    await app.keiko.lamps.off(request.args.get('wait', 0))
+    return {'result': 'success'}
+
+
+@route('/lamps/<color>')
+async def get_lamp(app, request, color):
+    if color not in _VALID_COLORS:
+        raise HTTPError(400)
+    lamp = getattr(app.keiko.lamps, color)
+    return {'lamps': {color: await lamp.status}}
+
+
+@route('/lamps/<color>/<state>')
+async def set_lamp(app, request, color, state):
+    if color not in _VALID_COLORS:
+        raise HTTPError(400)
+    lamp = getattr(app.keiko.lamps, color)
+    wait = request.args.get('wait', 0)
+    time = request.args.get('time', 0)
+    if state in ['on', 'blink', 'quickblink']:
+        await getattr(lamp, state)(wait, time)
+    elif state == 'off':
+        await lamp.off(wait)
+    else:
+        raise HTTPError(400)
+    return {'result': 'success'}
+
+
+@route('/buzzer')
+async def get_buzzer(app, request):
+    return await app.shared_read('buzzer', lambda: app.keiko.buzzer.status)
+
+
+@route('/buzzer/<state>')
+async def set_buzzer(app, request, state):
+    wait = request.args.get('wait', 0)
+    time = request.args.get('time', 0)
+    if state in ['on', 'continuous', 'intermittent']:
+        await getattr(app.keiko.buzzer, state)(wait, time)
+    elif state == 'off':
+        await app.keiko.buzzer.off(wait)
+    else:
+        raise HTTPError(400)
+    return {'result': 'success'}
+
+
+@route('/do')
+async def get_all_dos(app, request):
+    return await app.shared_read('do', lambda: app.keiko.do.status)
+
+
+@route('/do/<term>')
+async def get_do(app, request, term):
+    if term not in _VALID_TERMS:
+        raise HTTPError(400)
+    do = app.keiko.do(int(term))
+    return {'do': {term: await do.status}}
+
+
+@route('/do/<term>/<state>')
+async def set_do(app, request, term, state):
+    if term not in _VALID_TERMS:
+        raise HTTPError(400)
+    do = app.keiko.do(int(term))
+    wait = request.args.get('wait', 0)
+    time = request.args.get('time', 0)
+    if state == 'on':
+        await do.on(wait, time)
+    elif state == 'off':
+        await do.off(wait)
+    else:
+        raise HTTPError(400)
+    return {'result': 'success'}
+
+
+@route('/di')
+async def get_all_dis(app, request):
+    return await app.shared_read('di', lambda: app.keiko.di.status)
+
+
+@route('/di/<term>')
+async def get_di(app, request, term):
+    if term not in _VALID_TERMS:
+        raise HTTPError(400)
+    di = app.keiko.di(int(term))
+    return {'di': {term: await di.status}}
+
+
+@route('/voices')
+async def get_all_voices(app, request):
+    return {'voices': await app.keiko.voices.status}
+
+
+@route('/voices/stop')
+async def set_all_voices_stop(app, request):
+    await app.keiko.voices.stop()
+    return {'result': 'success'}
+
+
+def _voice(app, number):
+    if not (number.isdigit() and 1 <= int(number) <= 20):
+        raise HTTPError(400)
+    return app.keiko.voices(int(number))
+
+
+@route('/voices/<number>')
+async def get_voice(app, request, number):
+    voice = _voice(app, number)
+    return {'voices': {number: await voice.status}}
+
+
+@route('/voices/<number>/<state>')
+async def set_voice(app, request, number, state):
+    voice = _voice(app, number)
+    if state == 'play':
+        times = request.args.get('times', '1')
+        if not times.isdigit():
+            raise HTTPError(400)
+        await voice.play(int(times))
+    elif state in ['repeat', 'stop']:
+        await getattr(voice, state)()
+    else:
+        raise HTTPError(400)
+    return {'result': 'success'}
+
+
+@route('/batch', methods=('POST',))
+async def post_batch(app, request):
+    operations = request.json()
+    if not isinstance(operations, list) or not operations:
+        raise HTTPError(400)
+    batch = app.keiko.batch()
+    indexes = []
+    errors = []
+    for i, operation in enumerate(operations):
+        try:
+            indexes.append(batch.apply(operation))
+        except ValueError as e:
+            errors.append({'index': i, 'error': str(e)})
+    if errors:
+        return _json({'result': 'error', 'errors': errors}, 400)
+    replies = await batch.send(raise_on_error=False)
+    return {'results': [_batch_result(replies[i]) for i in indexes]}
+
+
+def _batch_result(reply):
+    if not isinstance(reply, Exception):
+        return {'result': 'success'}
+    result = {'result': 'error', 'error': str(reply)}
+    if isinstance(reply, CommandError):
+        result['code'] = reply.code
+    return result
+
+
+@route('/contract')
+async def get_contract(app, request):
+    deadline, number = await asyncio.gather(
+        app.keiko.raw.rdcd(), app.keiko.raw.rdcn()
+    )
+    return {'contract': {'deadline': deadline, 'number': number}}
+
+
+@route('/model')
+async def get_model(app, request):
+    return {'model': await app.keiko.raw.rdmn()}
+
+
+@route('/productiondate')
+async def get_productiondate(app, request):
+    return {'productiondate': await app.keiko.raw.rdpd()}
+
+
+@route('/serialnumber')
+async def get_serialnumber(app, request):
+    return {'serialnumber': await app.keiko.raw.rdsn()}
+
+
+@route('/unitid')
+async def get_unitid(app, request):
+    return {'unitid': await app.keiko.raw.utid()}
+
+
+@route('/version')
+async def get_version(app, request):
+    return {'version': await app.keiko.raw.vern()}
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'address',
+        metavar='ADDRESS',
+        help='address of Keiko-chan'
+    )
+    parser.add_argument(
+        '--port',
+        type=int,
+        default=60000,
+        help='port of Keiko-chan[60000]'
+    )
+    parser.add_argument(
+        '--server',
+        default='127.0.0.1:8080',
+        help='address and port of API server[127.0.0.1:8080]'
+    )
+    parser.add_argument(
+        '--pool-size',
+        type=int,
+        default=4,
+        help='connections to Keiko-chan[4]'
+    )
+    args = parser.parse_args()
+
+    try:
+        import uvicorn
+    except ImportError:
+        parser.error('uvicorn is required: pip install uvicorn')
+
+    app = App(AsyncClient(args.address, args.port, pool_size=args.pool_size))
+    host, port = args.server.split(':')
+    uvicorn.run(app, host=host, port=int(port))
@@ -0,0 +1,181 @@
+"""
+Provides a cache of the state read from Keiko-chan.
+"""
+
+import re
+import threading
+import time
+
+from .flags import merge_flags
+
+
+_ACOP_WRITE = re.compile(r'(ACOP -u \d+) (\S{8}) -w (\d+) -t (\d+)$')
+_FLAGS = re.compile(r'[0-9]{8}$')
+_OTHER_WRITE = re.compile(r'(RLY[1-8] |RYOT -n \d+ |RYOF )')  # relays, DOs
+
+
+class StateCache(object):
+    """Caches the replies of the status reads for <ttl> seconds.
+
+    The replies of ACOP -u 1, ACOP -u 2 and SPOP are cached. Writes seen by
+    observe() keep the cache consistent: an ACOP write that takes effect
+    at once updates the cached flags from its reply, or merges its flags
+    into them, and any other write to the same state invalidates it.
+
+    Every write seen bumps the generation of the replies it changes. A
+    read passes the generation from before it was sent to put(), so that
+    a reply from before a write does not replace the state after it.
+    """
+
+    cacheable = frozenset(['ACOP -u 1', 'ACOP -u 2', 'SPOP'])
+
+    def __init__(self, ttl=1.0):
+        self.ttl = ttl
+        self._entries = {}  # {command: (reply, expires)}
+        self._generations = {}  # {command: writes seen}
+        self._lock = threading.Lock()
+
+    def get(self, command):
+        """Returns the cached reply to <command>, or None."""
+        entry = self._entries.get(command)
+        if entry is None or entry[1] < time.time():
+            return None
+        return entry[0]
+
+    def generation(self, command):
+        """Returns the number of writes seen to the reply to <command>."""
+        return self._generations.get(command, 0)
+
+    def put(self, command, reply, generation=None):
+        """Caches <reply> to <command>, unless a write has been seen since
+        <generation>.
+        """
+        if command in self.cacheable:
+            with self._lock:
+                if generation not in (None, self.generation(command)):
+                    return
+                self._entries[command] = (reply, time.time() + self.ttl)
+
+    def _bump(self, commands):
+        # with self._lock
+        for command in commands:
+            self._generations[command] = self.generation(command) + 1
+
+    def invalidate(self, command=None):
+        """Drops the cached reply to <command>, or all of them."""
+        with self._lock:
+            if command is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(command, None)
+
+    def observe(self, command, reply, generation=None):
+        """Updates the cache from a command and its reply.
+
+        <reply> is None if the command failed. <generation> is that of
+        <command> when it was sent, if it is a read.
+        """
+        if command in self.cacheable:
+            if reply is not None:
+                self.put(command, reply, generation)
+            return
+        match = _ACOP_WRITE.match(command)
+        if match:
+            read, flags, wait, time_ = match.groups()
+            with self._lock:
+                self._bump([read])
+                entry = self._entries.pop(read, None)
+                if reply is None or wait != '0' or time_ != '0':
+                    return  # the state is unknown until the next read
+                if _FLAGS.match(reply):  # the reply is the new state
+                    self._entries[read] = (reply, time.time() + self.ttl)
+                elif entry is not None:
+                    self._entries[read] = (merge_flags(entry[0], flags),
+                                           entry[1])
+        elif command.startswith('SPOP '):
+            with self._lock:
+                self._bump(['SPOP'])
+                self._entries.pop('SPOP', None)
+        elif command == 'ALOF' or _OTHER_WRITE.match(command):
+            with self._lock:
+                self._bump(self.cacheable)
+                self._entries.clear()
+
+
+class SharedReads(object):
+    """Collapses concurrent identical reads into one call.
+
+    Callers of read() with the same <key> share the result of the call in
+    flight. The last result of each key is kept, and is served for up to
+    <stale> seconds when a call fails, or when a caller has waited
+    <patience> seconds for a call in flight. While there is a result to
+    serve, the call runs in a thread of its own, so that it goes on to
+    refresh the result for the later callers.
+    """
+
+    def __init__(self, stale=5.0, patience=0.5):
+        self.stale = stale
+        self.patience = patience
+        self._calls = {}  # {key: _Call}
+        self._last = {}  # {key: (value, timestamp)}
+        self._lock = threading.Lock()
+
+    def read(self, key, func):
+        """Returns (<value>, <age>) read by func().
+
+        <age> is None for a new value, or the age in seconds of the last
+        value served instead.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if leader and self._stale(key) is None:
+            self._run(key, call, func)  # nothing to serve meanwhile
+        else:
+            if leader:
+                thread = threading.Thread(
+                    target=self._run, args=(key, call, func)
+                )
+                thread.daemon = True
+                thread.start()
+            if not call.done.wait(self.patience):
+                stale = self._stale(key)
+                if stale is not None:
+                    return stale
+                call.done.wait()
+        if call.error is None:
+            return call.value, None
+        stale = self._stale(key)
+        if stale is None:
+            raise call.error
+        return stale
+
+    def _run(self, key, call, func):
+        try:
+            call.value = func()
+        except Exception as e:
+            call.error = e
+        with self._lock:
+            del self._calls[key]
+            if call.error is None:
+                self._last[key] = (call.value, time.time())
+        call.done.set()
+
+    def _stale(self, key):
+        last = self._last.get(key)
+        if last is None:
+            return None
+        age = time.time() - last[1]
+        if age > self.stale:
+            return None
+        return last[0], age
+
+
+class _Call(object):
+
+    def __init__(self):
+        self.value = None
+        self.error = None
+        self.done = threading.Event()
@@ -0,0 +1,170 @@
+"""
+Provides the keiko command, which controls Keiko-chan from the shell.
+
+    $ keiko 192.168.1.2 lamps red on time=5
+    $ keiko 192.168.1.2 lamps
+    $ keiko 192.168.1.2 - < commands.txt  # one command per line
+    $ keiko 192.168.1.2  # runs the API server, see keiko.app
+
+The commands are the routes of the API server split by spaces, with the
+query as key=value. Flask is only imported to run the API server.
+"""
+
+import json
+import sys
+import time
+
+from .clients import Client
+
+
+_READS = {  # {target: valid names}
+    'lamps': ['red', 'yellow', 'green'],
+    'buzzer': [],
+    'do': ['1', '2', '3', '4'],
+    'di': ['1', '2', '3', '4'],
+    'voices': [str(number) for number in range(1, 21)],
+    'snapshot': []
+}
+
+
+def run(client, words):
+    """Runs the command of <words> and returns its result in the JSON of
+    the API server.
+
+    Raises ValueError if the command is invalid.
+    """
+    if words and words[0] == 'raw':
+        if len(words) < 2:
+            raise ValueError('raw needs a command')
+        return {'reply': client.raw.execute_many([' '.join(words[1:])])[0]}
+    parts = [word for word in words if '=' not in word]
+    options = {}
+    for word in words:
+        if '=' in word:
+            key, _, value = word.partition('=')
+            if not value.isdigit():
+                raise ValueError(key + ' must be a non-negative integer')
+            options[key] = int(value)
+    if not parts:
+        raise ValueError('no command')
+    target = parts[0]
+    if len(parts) == 1 or (len(parts) == 2 and parts[1] in
+                           _READS.get(target, [])):
+        if target not in _READS:
+            raise ValueError('unknown command: ' + ' '.join(words))
+        if options:
+            raise ValueError('reads take no options')
+        return _read(client, parts)
+    batch = client.batch()
+    options['path'] = '/' + '/'.join(parts)
+    batch.apply(options)
+    batch.send()
+    return {'result': 'success'}
+
+
+def _read(client, parts):
+    target = parts[0]
+    if target == 'snapshot':
+        return {'snapshot': client.snapshot().to_dict()}
+    if len(parts) == 1:
+        return {target: getattr(client, target).status}
+    name = parts[1]
+    if target == 'lamps':
+        return {target: {name: getattr(client.lamps, name).status}}
+    return {target: {name: getattr(client, target)(int(name)).status}}
+
+
+def stream(client, lines, output):
+    """Runs a command per line and writes a JSON line per command with its
+    result or error and the seconds it took.
+
+    Blank lines and lines starting with # are skipped. Returns the number
+    of commands that failed.
+    """
+    failed = 0
+    for line in lines:
+        words = line.split()
+        if not words or words[0].startswith('#'):
+            continue
+        start = time.time()
+        try:
+            record = {'result': run(client, words)}
+        except Exception as e:
+            record = {'error': str(e) or type(e).__name__}
+            failed += 1
+        record['command'] = ' '.join(words)
+        record['seconds'] = round(time.time() - start, 6)
+        output.write(json.dumps(record, sort_keys=True) + '\n')
+        output.flush()
+    return failed
+
+
+def main(argv=None):
+    import argparse
+
+    if argv is None:
+        argv = sys.argv[1:]
+    parser = argparse.ArgumentParser(
+        prog='keiko',
+        usage='%(prog)s [options] ADDRESS [COMMAND ...]',
+        description='Runs COMMAND, e.g. lamps red on wait=2, on Keiko-chan '
+                    'at ADDRESS, or the commands read from stdin if COMMAND '
+                    'is -. Without COMMAND, runs the API server, which also '
+                    'takes the options of keiko.app.'
+    )
+    parser.add_argument(
+        '--port',
+        type=int,
+        default=60000,
+        help='port of Keiko-chan[60000]'
+    )
+    parser.add_argument(
+        '--timeout',
+        type=float,
+        default=5.0,
+        help='seconds to wait for each reply[5.0]'
+    )
+    parser.add_argument(
+        '--timing',
+        action='store_true',
+        help='print the seconds a command took to stderr'
+    )
+    parser.add_argument('address', metavar='ADDRESS', nargs='?')
+    parser.add_argument('command', nargs=argparse.REMAINDER)
+    # the words after COMMAND are its own, e.g. raw ACOP -u 1; the options
+    # after ADDRESS alone, and the unknown ones, are those of keiko.app
+    args, unknown = parser.parse_known_args(argv)
+    command = args.command
+    if unknown or not command or (
+            command[0].startswith('-') and command != ['-']):
+        from .app import main as serve  # Flask is slow to import
+        return serve(argv)
+    address = args.address
+
+    client = Client(
+        address, args.port, pool_size=1, timeout=args.timeout,
+        metrics=None
+    )
+    try:
+        if command == ['-']:
+            failed = stream(client, sys.stdin, sys.stdout)
+        else:
+            start = time.time()
+            try:
+                result = run(client, command)
+            except Exception as e:
+                parser.exit(1, 'keiko: {0}\n'.format(
+                    str(e) or type(e).__name__
+                ))
+            print(json.dumps(result, sort_keys=True))
+            if args.timing:
+                sys.stderr.write('{0:.6f}\n'.format(time.time() - start))
+            failed = 0
+    finally:
+        client.raw.close()
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
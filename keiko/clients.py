@@ -3,29 +3,363 @@ Provides client classes for Keiko-chan.
 """
 
 import contextlib
+import random
+import re
 import socket
-import sys
+import time
 
+from .cache import StateCache
+from .connection import Connection, ConnectionPool, DeadlineExceeded
+from .metrics import REGISTRY
+from .pattern import play as play_pattern
+from .scheduler import CommandScheduler, READ, WRITE
 from .flags import (
+    merge_flags,
     build_lamp_flags, parse_lamp_flags,
     build_buzzer_flags, parse_buzzer_flags,
     build_do_flags, parse_do_flags,
     parse_di_flags,
-    build_voice_flags, parse_voice_flags
+    build_voice_flags, parse_voice_flags,
+    parse_state
 )
 
+try:
+    basestring
+except NameError:  # py3
+    basestring = str
+
 
 class Client(object):
-    """Provides high level APIs to control Keiko-chan."""
+    """Provides high level APIs to control Keiko-chan.
+
+    If <cache_ttl> is given, the status of the lamps, the buzzer, the DOs
+    and the voices is served from the last reply for <cache_ttl> seconds,
+    see keiko.cache.StateCache.
+    """
 
-    def __init__(self, address, port=60000):
-        self.raw = RawClient(address, port)
+    def __init__(self, address, port=60000, cache_ttl=None, **options):
+        self.cache = StateCache(cache_ttl) if cache_ttl else None
+        self.raw = RawClient(address, port, cache=self.cache, **options)
         self.lamps = LampHolder(self.raw)
         self.buzzer = Buzzer(self.raw)
         self.do = DOHolder(self.raw)
         self.di = DIHolder(self.raw)
         self.voices = VoiceHolder(self.raw)
 
+    def snapshot(self):
+        """Returns the whole state of Keiko-chan as a Snapshot.
+
+        The reads that are not cached are pipelined in one round trip.
+        """
+        replies = _cached_replies(self.cache)
+        missing = [read for read in Snapshot.reads if read not in replies]
+        replies.update(zip(missing, self.raw.execute_many(missing)))
+        return Snapshot.from_replies(time.time(), replies)
+
+    def batch(self, wait=0, time=0):
+        """Returns a Batch that sends the changes made through it at once.
+
+            with client.batch() as batch:
+                batch.lamps.red.on()
+                batch.buzzer.intermittent()
+                batch.do(1).on()
+        """
+        return Batch(self.raw, wait, time)
+
+    def apply(self, desired, wait=0, time=0):
+        """Brings Keiko-chan to the <desired> state with as few commands as
+        possible, and returns the changes that were sent.
+
+        <desired> has the structure of Snapshot.to_dict(), where any of the
+        lamps, buzzer, do and voice, and any lamp or DO, can be left out:
+
+            client.apply({'lamps': {'red': 'on', 'green': 'off'},
+                          'buzzer': 'off'})
+
+        The current state is read, from the cache if any, and only the
+        outputs that differ are changed: the lamps and the buzzer in one
+        ACOP command with X for the others, the DOs in another, the voice
+        with SPOP. Nothing is sent when nothing differs. The di and the
+        timestamp are ignored, so that a Snapshot.to_dict() can be given.
+        Raises ValueError if <desired> has an unknown key.
+        """
+        reads = _desired_reads(desired)
+        replies = _cached_replies(self.cache)
+        missing = [read for read in reads if read not in replies]
+        if missing:
+            replies.update(zip(missing, self.raw.execute_many(missing)))
+        batch = self.batch(wait, time)
+        changes = _desired_changes(batch, desired, replies)
+        if changes:
+            batch.send()
+        return changes
+
+    def play(self, pattern, loops=1):
+        """Plays a keiko.pattern.Pattern <loops> times, or until cancelled
+        if 0, and returns its Playback.
+
+        The patterns of all the clients share one timer thread.
+        """
+        return play_pattern(self.raw, pattern, loops)
+
+
+def _desired_reads(desired):
+    unknown = set(desired) - set(['lamps', 'buzzer', 'do', 'di', 'voice',
+                                  'timestamp'])
+    if unknown:
+        raise ValueError('unknown keys: ' + ', '.join(sorted(unknown)))
+    reads = []
+    if 'lamps' in desired or 'buzzer' in desired:
+        reads.append('ACOP -u 1')
+    if 'do' in desired:
+        reads.append('ACOP -u 2')
+    if 'voice' in desired:
+        reads.append('SPOP')
+    return reads
+
+
+def _desired_changes(batch, desired, replies):
+    """Records in <batch> the changes from <replies> to <desired>."""
+    changes = {}
+    if 'lamps' in desired:
+        current = parse_lamp_flags(replies['ACOP -u 1'])['lamps']
+        lamps = dict(
+            (color, state) for color, state in desired['lamps'].items()
+            if current.get(color) != state
+        )
+        if lamps:
+            changes['lamps'] = lamps
+            batch.add(build_lamp_flags(changes))
+    if 'buzzer' in desired:
+        current = parse_buzzer_flags(replies['ACOP -u 1'])['buzzer']
+        if desired['buzzer'] != current:
+            changes['buzzer'] = desired['buzzer']
+            batch.add(build_buzzer_flags(changes))
+    if 'do' in desired:
+        current = parse_do_flags(replies['ACOP -u 2'])['do']
+        do = dict(
+            (term, state) for term, state in desired['do'].items()
+            if current.get(term) != state
+        )
+        if do:
+            changes['do'] = do
+            batch.add(build_do_flags(changes), unit=2)
+    if 'voice' in desired:
+        current = parse_voice_flags(replies['SPOP'])['voice']
+        if desired['voice'] != current:
+            changes['voice'] = desired['voice']
+            batch.set_voice(build_voice_flags(changes))
+    return changes
+
+
+class Batch(object):
+    """Collects lamp, buzzer, DO and voice changes and sends them together.
+
+    The changes are merged into one ACOP command per unit, with the <wait>
+    and <time> of the batch, and sent with the voice change in a single
+    pipeline by send(), or on leaving the with block without an error.
+    Changes given their own wait or time get a separate ACOP command.
+    """
+
+    def __init__(self, rawclient, wait=0, time=0):
+        self.raw = rawclient
+        self.wait = wait
+        self.time = time
+        self._acops = []  # [[unit, wait, time, flags]]
+        self._voice = None
+        recorder = _BatchRecorder(self)
+        self.lamps = LampHolder(recorder)
+        self.buzzer = Buzzer(recorder)
+        self.do = DOHolder(recorder)
+        self.voices = VoiceHolder(recorder)
+
+    def __len__(self):
+        return len(self._acops) + (self._voice is not None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.send()
+        else:
+            self.clear()
+
+    def add(self, flags, unit=1, wait=0, time=0):
+        """Merges ACOP <flags> into the pending command of <unit>.
+
+        Returns the index of the reply to the command in send().
+        """
+        wait = wait or self.wait
+        time = time or self.time
+        for i, acop in enumerate(self._acops):
+            if acop[:3] == [unit, wait, time]:
+                acop[3] = merge_flags(acop[3], flags)
+                return i
+        self._acops.append([unit, wait, time, flags])
+        return len(self._acops) - 1
+
+    def set_voice(self, flags):
+        """Replaces the pending SPOP <flags>.
+
+        Returns the index of the reply to the command in send(), which is
+        always the last one.
+        """
+        self._voice = flags
+        return -1
+
+    def apply(self, operation):
+        """Records <operation>, a dict named after the routes of keiko.app:
+
+            {'path': '/lamps/red/on', 'wait': 0, 'time': 5}
+            {'path': '/voices/3/play', 'times': 2}
+
+        Returns the index of the reply to its command in send(). Raises
+        ValueError if the operation is invalid.
+        """
+        if not isinstance(operation, dict):
+            raise ValueError('operation must be an object')
+        path = operation.get('path')
+        if not isinstance(path, basestring):
+            raise ValueError('path is required')
+        unknown = set(operation) - set(['path', 'wait', 'time', 'times'])
+        if unknown:
+            raise ValueError('unknown keys: ' + ', '.join(sorted(unknown)))
+        wait = _count(operation, 'wait', 0)
+        time = _count(operation, 'time', 0)
+        parts = path.strip('/').split('/')
+        if parts == ['lamps', 'off']:
+            return self.lamps.off(wait)
+        if parts == ['voices', 'stop']:
+            return self.voices.stop()
+        if len(parts) == 2 and parts[0] == 'buzzer':
+            return _set_state(self.buzzer, parts[1], wait, time,
+                              ['on', 'continuous', 'intermittent'])
+        if len(parts) != 3:
+            raise ValueError('unknown path: ' + path)
+        target, name, state = parts
+        if target == 'lamps' and name in ['red', 'yellow', 'green']:
+            return _set_state(getattr(self.lamps, name), state, wait, time,
+                              ['on', 'blink', 'quickblink'])
+        if target == 'do' and name in ['1', '2', '3', '4']:
+            return _set_state(self.do(int(name)), state, wait, time, ['on'])
+        if target == 'voices' and name.isdigit() and 1 <= int(name) <= 20:
+            voice = self.voices(int(name))
+            if state == 'play':
+                return voice.play(_count(operation, 'times', 1))
+            if state in ['repeat', 'stop']:
+                return getattr(voice, state)()
+            raise ValueError('unknown state: ' + state)
+        raise ValueError('unknown path: ' + path)
+
+    def clear(self):
+        """Discards the pending changes."""
+        self._acops = []
+        self._voice = None
+
+    def send(self, raise_on_error=True):
+        """Sends the pending changes and returns the replies.
+
+        CommandError is returned in place of the reply if <raise_on_error>
+        is False.
+        """
+        pipe = self.raw.pipeline()
+        for unit, wait, duration, flags in self._acops:
+            pipe.acop(flags, unit=unit, wait=wait, time=duration)
+        if self._voice is not None:
+            pipe.spop(self._voice)
+        self.clear()
+        return pipe.execute(raise_on_error)
+
+
+class _BatchRecorder(object):
+    """Takes the writes of the holders in place of the raw client."""
+
+    def __init__(self, batch):
+        self.batch = batch
+
+    def acop(self, flags=None, unit=1, wait=0, time=0):
+        if not flags:
+            return self.batch.raw.acop(unit=unit)
+        return self.batch.add(flags, unit, wait, time)
+
+    def spop(self, flags=None):
+        if not flags:
+            return self.batch.raw.spop()
+        return self.batch.set_voice(flags)
+
+    def rops(self):
+        return self.batch.raw.rops()
+
+
+def _count(operation, key, default):
+    value = operation.get(key, default)
+    if isinstance(value, bool) or not isinstance(value, int) or value < 0:
+        raise ValueError(key + ' must be a non-negative integer')
+    return value
+
+
+def _set_state(target, state, wait, time, states):
+    if state in states:
+        return getattr(target, state)(wait, time)
+    if state == 'off':
+        return target.off(wait)
+    raise ValueError('unknown state: ' + state)
+
+
+class Snapshot(object):
+    """The state of the lamps, buzzer, DOs, DIs and voice at <timestamp>.
+
+    <state> is the same state as a DeviceState, if known.
+    """
+
+    reads = ('ACOP -u 1', 'ACOP -u 2', 'ROPS', 'SPOP')
+
+    def __init__(self, timestamp, lamps, buzzer, do, di, voice, state=None):
+        self.timestamp = timestamp
+        self.lamps = lamps
+        self.buzzer = buzzer
+        self.do = do
+        self.di = di
+        self.voice = voice
+        self.state = state
+
+    @classmethod
+    def from_replies(cls, timestamp, replies):
+        """Builds a Snapshot from the replies of <reads>."""
+        state = parse_state(
+            replies['ACOP -u 1'], replies['ACOP -u 2'], replies['ROPS'],
+            replies['SPOP']
+        )
+        return cls(
+            timestamp, state.lamps, state.buzzer, state.do, state.di,
+            state.voice, state
+        )
+
+    def to_dict(self):
+        return {
+            'timestamp': self.timestamp,
+            'lamps': self.lamps,
+            'buzzer': self.buzzer,
+            'do': self.do,
+            'di': self.di,
+            'voice': self.voice
+        }
+
+    def __repr__(self):
+        return 'Snapshot({0!r})'.format(self.to_dict())
+
+
+def _cached_replies(cache):
+    if cache is None:
+        return {}
+    replies = {}
+    for read in Snapshot.reads:
+        reply = cache.get(read)
+        if reply is not None:
+            replies[read] = reply
+    return replies
+
 
 class LampHolder(object):
     """Holds the lamps."""
@@ -48,7 +382,7 @@ class LampHolder(object):
         flags = build_lamp_flags(
             {'lamps': {'red': 'off', 'yellow': 'off', 'green': 'off'}}
         )
-        self.raw.acop(flags, wait=wait)
+        return self.raw.acop(flags, wait=wait)
 
 
 class Lamp(object):
@@ -67,23 +401,23 @@ class Lamp(object):
 
     def _set(self, state, wait=0, time=0):
         flags = build_lamp_flags({'lamps': {self.color: state}})
-        self.raw.acop(flags, wait=wait, time=time)
+        return self.raw.acop(flags, wait=wait, time=time)
 
     def on(self, wait=0, time=0):
         """Turns on the lamp."""
-        self._set('on', wait, time)
+        return self._set('on', wait, time)
 
     def blink(self, wait=0, time=0):
         """Blinks the lamp on and off."""
-        self._set('blink', wait, time)
+        return self._set('blink', wait, time)
 
     def quickblink(self, wait=0, time=0):
         """Blinks the lamp on and off quickly."""
-        self._set('quickblink', wait, time)
+        return self._set('quickblink', wait, time)
 
     def off(self, wait=0):
         """Turns off the lamp."""
-        self._set('off', wait)
+        return self._set('off', wait)
 
 
 class Buzzer(object):
@@ -101,23 +435,23 @@ class Buzzer(object):
 
     def _set(self, state, wait=0, time=0):
         flags = build_buzzer_flags({'buzzer': state})
-        self.raw.acop(flags, wait=wait, time=time)
+        return self.raw.acop(flags, wait=wait, time=time)
 
     def on(self, wait=0, time=0):
         """Turns on the buzzer to beep continuously."""
-        self.continuous(wait, time)
+        return self.continuous(wait, time)
 
     def continuous(self, wait=0, time=0):
         """Turns on the buzzer to beep continuously."""
-        self._set('continuous', wait, time)
+        return self._set('continuous', wait, time)
 
     def intermittent(self, wait=0, time=0):
         """Turns on the buzzer to beep intermittently."""
-        self._set('intermittent', wait, time)
+        return self._set('intermittent', wait, time)
 
     def off(self, wait=0):
         """Turns off the buzzer."""
-        self._set('off', wait)
+        return self._set('off', wait)
 
 
 class DOHolder(object):
@@ -153,15 +487,15 @@ class DO(object):
 
     def _set(self, state, wait=0, time=0):
         flags = build_do_flags({'do': {self.term: state}})
-        self.raw.acop(flags, unit=2, wait=wait, time=time)
+        return self.raw.acop(flags, unit=2, wait=wait, time=time)
 
     def on(self, wait=0, time=0):
         """Turns on the DO."""
-        self._set('on', wait, time)
+        return self._set('on', wait, time)
 
     def off(self, wait=0):
         """Turns off the DO."""
-        self._set('off', wait)
+        return self._set('off', wait)
 
 
 class DIHolder(object):
@@ -215,7 +549,7 @@ class VoiceHolder(object):
     def stop(self):
         """Stops playing any voice."""
         flags = build_voice_flags({'voice': 'stop'})
-        self.raw.spop(flags)
+        return self.raw.spop(flags)
 
 
 class Voice(object):
@@ -239,59 +573,162 @@ class Voice(object):
 
     def _set(self, state):
         flags = build_voice_flags({'voice': state})
-        self.raw.spop(flags)
+        return self.raw.spop(flags)
 
     def play(self, times=1):
         """Plays the voice."""
-        self._set({'number': self.number, 'repeat': times})
+        return self._set({'number': self.number, 'repeat': times})
 
     def repeat(self):
         """Plays the voice repeatedly."""
-        self.play(0)
+        return self.play(0)
 
     def stop(self):
         """Stops playing the voice."""
-        self._set('stop')
+        return self._set('stop')
 
 
-class RawClient(object):
-    """Provides low level APIs to control Keiko-chan."""
+class ReplyError(Exception):
+    """Raised when a reply of Keiko-chan is not shaped as expected."""
 
-    def __init__(self, address, port=60000):
-        self.address = address
-        self.port = port
 
-    def _send(self, command):
-        ret = ''
-        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        with contextlib.closing(self._sock):
-            self._sock.connect((self.address, self.port))
-            self._sock.sendall(self._build_data(command))
-            ret = self._sock.recv(64)  # enough long
-        return self._strip_data(ret)
-
-    def _build_data(self, command):
-        data = ''.join([command, '\r'])
-        if sys.version_info[0] >= 3:  # py3
-            return bytes(data, 'ascii')  # str to bytes
-        else:  # py2
-            return data
+class CommandError(Exception):
+    """Raised when Keiko-chan replies with an error code."""
 
-    def _strip_data(self, data):
-        if sys.version_info[0] >= 3:  # py3
-            data = str(data, 'utf-8')  # bytes to str
-        return data.rstrip('\r')
+    def __init__(self, code):
+        Exception.__init__(self, _ERRORS[code])
+        self.code = code
+
+
+_ERRORS = {
+    'ER01': 'Invalid command',
+    'ER02': 'Wrong EOL code',
+    'ER03': 'Wrong arguments',
+    'ER04': 'Command failed'
+}
+
+_REPLY_SHAPES = [  # (command, reply) of the commands parsed by the holders
+    (re.compile(r'ACOP -u [12]$'), re.compile(r'[0-9]{8}$')),
+    (re.compile(r'ROPS$'), re.compile(r'[01]{4,}$')),
+    (re.compile(r'SPOP$'), re.compile(r'[0-9]{8}$'))
+]
+
+_IDEMPOTENT = re.compile(  # commands that only read the state
+    r'(ACOP -u \d+|CKDI|CKID|CKIP|CKST|HELP|PWST|RD(CD|CN|MN|PD|SN)|RLY[1-8]'
+    r'|ROPS|RYIN -n \d+|RYOT -n \d+|SPOP|UTID|VERN)$'
+)
+
+
+def _priority(commands):
+    if all(_IDEMPOTENT.match(command) for command in commands):
+        return READ
+    return WRITE
+
+
+class BaseRawClient(object):
+    """Builds the commands of Keiko-chan and passes them to _execute."""
+
+    cache = None
+    journal = None
 
     def _execute(self, command):
-        result = self._send(command)
-        errors = {
-            'ER01': 'Invalid command',
-            'ER02': 'Wrong EOL code',
-            'ER03': 'Wrong arguments',
-            'ER04': 'Command failed'
-        }
-        if result in errors:
-            raise Exception(errors[result])
+        raise NotImplementedError
+
+    def _build_data(self, commands):
+        return ''.join(command + '\r' for command in commands).encode('ascii')
+
+    def _strip_data(self, data):
+        return data.decode('utf-8').rstrip('\r')
+
+    def _init_metrics(self, metrics):
+        self.metrics = metrics
+        if metrics is None:
+            return
+        self._device = '{0}:{1}'.format(self.address, self.port)
+        self._commands_total = metrics.counter(
+            'keiko_commands_total',
+            'Commands sent to Keiko-chan.',
+            ('device', 'verb')
+        )
+        self._errors_total = metrics.counter(
+            'keiko_command_errors_total',
+            'Commands that failed, by error code or exception.',
+            ('device', 'verb', 'code')
+        )
+        self._duration = metrics.histogram(
+            'keiko_command_duration_seconds',
+            'Round trip time of commands, PIPELINE for execute_many.',
+            ('device', 'verb')
+        )
+
+    def _generations(self, commands):
+        """Returns the generations of the cache before <commands> are sent."""
+        if self.cache is None:
+            return [None] * len(commands)
+        return [self.cache.generation(command) for command in commands]
+
+    def _observe(self, commands, elapsed, outcomes, generations=None):
+        """Records the commands and their results or exceptions.
+
+        <generations> is the result of _generations() before the commands
+        were sent.
+        """
+        if self.cache is not None:
+            generations = generations or [None] * len(commands)
+            for command, outcome, generation in zip(
+                    commands, outcomes, generations):
+                if isinstance(outcome, Exception):
+                    outcome = None
+                self.cache.observe(command, outcome, generation)
+        if self.journal is not None:
+            self.journal.observe(
+                '{0}:{1}'.format(self.address, self.port), commands, outcomes
+            )
+        if self.metrics is None:
+            return
+        if len(commands) == 1:
+            verb = commands[0].split(' ', 1)[0]
+        else:
+            verb = 'PIPELINE'
+        self._duration.observe(elapsed, self._device, verb)
+        for command, outcome in zip(commands, outcomes):
+            verb = command.split(' ', 1)[0]
+            self._commands_total.inc(self._device, verb)
+            if isinstance(outcome, CommandError):
+                self._errors_total.inc(self._device, verb, outcome.code)
+            elif isinstance(outcome, Exception):
+                self._errors_total.inc(
+                    self._device, verb, type(outcome).__name__
+                )
+
+    def _deadline(self):
+        if self.deadline is None:
+            return None
+        return time.time() + self.deadline
+
+    def _retries(self, commands):
+        # writes are never retried, they may have been done already
+        if all(_IDEMPOTENT.match(command) for command in commands):
+            return self.retries
+        return 0
+
+    def _backoff(self, attempt, deadline):
+        """Returns the jittered delay before the retry, or None to give up."""
+        delay = random.uniform(
+            0, min(self.max_backoff, self.backoff * 2 ** attempt)
+        )
+        if deadline is not None and time.time() + delay >= deadline:
+            return None
+        return delay
+
+    def _check_result(self, command, result):
+        if result in _ERRORS:
+            raise CommandError(result)
+        for command_shape, reply_shape in _REPLY_SHAPES:
+            if command_shape.match(command) and not reply_shape.match(result):
+                raise ReplyError(
+                    'Unexpected reply to {0}: {1!r}'.format(command, result)
+                )
         return result
 
     def acop(self, flags=None, unit=1, wait=0, time=0):
@@ -433,3 +870,224 @@ class RawClient(object):
 
     def vern(self):
         return self._execute('VERN')
+
+
+class RawClient(BaseRawClient):
+    """Provides low level APIs to control Keiko-chan.
+
+    <connect_timeout> and <timeout> bound each connect and each socket
+    read or write, and <deadline> bounds a whole call including retries.
+    Read-only commands that fail on the network are retried up to
+    <retries> times with jittered exponential backoff; commands that
+    change the state are never retried.
+
+    If <scheduled> is True, the commands are sent one at a time, writes
+    first, by a keiko.scheduler.CommandScheduler. <deadline> then bounds
+    the wait in its queue as well.
+
+    The states seen are recorded in <journal>, a keiko.journal.Journal, if
+    given.
+    """
+
+    def __init__(self, address, port=60000, persistent=True, pool_size=4,
+                 idle_timeout=30.0, nodelay=True, keepalive=True,
+                 connect_timeout=3.0, timeout=5.0, deadline=None, retries=2,
+                 backoff=0.05, max_backoff=1.0, metrics=REGISTRY, cache=None,
+                 scheduled=False, journal=None):
+        self.address = address
+        self.port = port
+        self.cache = cache
+        self.journal = journal
+        self.persistent = persistent
+        self.deadline = deadline
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._options = {
+            'nodelay': nodelay, 'keepalive': keepalive,
+            'connect_timeout': connect_timeout, 'timeout': timeout
+        }
+        self._init_metrics(metrics)
+        self.scheduler = None
+        if scheduled:
+            self.scheduler = CommandScheduler(
+                self._execute_now, '{0}:{1}'.format(address, port), metrics
+            )
+        self.pool = None
+        if persistent:
+            self.pool = ConnectionPool(
+                address, port, size=pool_size, idle_timeout=idle_timeout,
+                **self._options
+            )
+
+    def close(self):
+        """Stops the thread of the scheduler, if any, and closes the idle
+        pooled connections.
+        """
+        if self.scheduler is not None:
+            self.scheduler.stop()
+        if self.pool is not None:
+            self.pool.clear()
+
+    def _send(self, command, deadline=None):
+        return self._send_many([command], deadline)[0]
+
+    def _send_many(self, commands, deadline=None):
+        """Sends the commands and returns the replies, within <deadline>
+        if given, or within self.deadline from now.
+        """
+        data = self._build_data(commands)
+        if deadline is None:
+            deadline = self._deadline()
+        retries = self._retries(commands)
+        attempt = 0
+        while True:
+            try:
+                replies = self._send_once(data, len(commands), deadline)
+            except DeadlineExceeded:
+                raise
+            except socket.error:
+                delay = self._backoff(attempt, deadline)
+                if attempt >= retries or delay is None:
+                    raise
+                time.sleep(delay)
+                attempt += 1
+                continue
+            return [self._strip_data(reply) for reply in replies]
+
+    def _send_once(self, data, count, deadline):
+        if not self.persistent:
+            conn = Connection(self.address, self.port, **self._options)
+            with contextlib.closing(conn):
+                conn.connect(deadline)
+                conn.send(data, deadline)
+                return [conn.recv(deadline) for _ in range(count)]
+        while True:
+            conn = self.pool.acquire(deadline)
+            reused = conn.connected
+            replies = []
+            try:
+                if not reused:
+                    conn.connect(deadline)
+                conn.send(data, deadline)
+                for _ in range(count):
+                    replies.append(conn.recv(deadline))
+            except socket.timeout:  # the command may have been done
+                self.pool.release(conn, discard=True)
+                raise
+            except socket.error:
+                self.pool.release(conn, discard=True)
+                if reused and not replies:
+                    continue  # stale connection, reconnect and try again
+                raise
+            except Exception:
+                self.pool.release(conn, discard=True)
+                raise
+            self.pool.release(conn)
+            return replies
+
+    def _execute(self, command):
+        if self.cache is not None:
+            cached = self.cache.get(command)
+            if cached is not None:
+                return cached
+        if self.scheduler is not None:
+            return self.scheduler.submit(
+                command, _priority([command]), self._deadline()
+            )
+        return self._execute_now(command)
+
+    def _execute_now(self, command, deadline=None):
+        start = time.time()
+        generations = self._generations([command])
+        try:
+            result = self._check_result(
+                command, self._send(command, deadline)
+            )
+        except Exception as e:
+            self._observe([command], time.time() - start, [e], generations)
+            raise
+        self._observe([command], time.time() - start, [result], generations)
+        return result
+
+    def execute_many(self, commands, raise_on_error=True):
+        """Sends the commands on a single connection and returns the results.
+
+        The results are in the same order as <commands>. If a command fails,
+        CommandError is raised after all the replies are read, or it is put
+        in place of the result if <raise_on_error> is False.
+        """
+        if self.scheduler is not None:
+            # one deadline for the wait in the queue and the send
+            deadline = self._deadline()
+            return self.scheduler.call(
+                lambda: self._execute_many_now(
+                    commands, raise_on_error, deadline
+                ),
+                _priority(commands), deadline
+            )
+        return self._execute_many_now(commands, raise_on_error)
+
+    def _execute_many_now(self, commands, raise_on_error, deadline=None):
+        start = time.time()
+        generations = self._generations(commands)
+        try:
+            replies = self._send_many(commands, deadline)
+        except Exception as e:
+            self._observe(commands, time.time() - start,
+                          [e] * len(commands), generations)
+            raise
+        results = []
+        for command, result in zip(commands, replies):
+            try:
+                results.append(self._check_result(command, result))
+            except (CommandError, ReplyError) as e:
+                results.append(e)
+        self._observe(commands, time.time() - start, results, generations)
+        if raise_on_error:
+            for result in results:
+                if isinstance(result, (CommandError, ReplyError)):
+                    raise result
+        return results
+
+    def pipeline(self):
+        """Returns a Pipeline that buffers commands to send them at once."""
+        return Pipeline(self)
+
+
+class Pipeline(BaseRawClient):
+    """Buffers commands and sends them at once on a single connection.
+
+    Every command method returns the pipeline itself, so calls can be
+    chained:
+
+        flags, dis = raw.pipeline().acop().rops().execute()
+    """
+
+    def __init__(self, rawclient):
+        self.raw = rawclient
+        self.commands = []
+
+    def __len__(self):
+        return len(self.commands)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.reset()
+
+    def _execute(self, command):
+        self.commands.append(command)
+        return self
+
+    def reset(self):
+        """Discards the buffered commands."""
+        self.commands = []
+
+    def execute(self, raise_on_error=True):
+        """Sends the buffered commands and returns their results."""
+        commands, self.commands = self.commands, []
+        if not commands:
+            return []
+        return self.raw.execute_many(commands, raise_on_error)
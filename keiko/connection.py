@@ -0,0 +1,172 @@
+"""
+Provides connection classes for Keiko-chan.
+"""
+
+import socket
+import threading
+import time
+
+
+class DeadlineExceeded(socket.timeout):
+    """Raised when a call does not complete before its deadline."""
+
+
+class Connection(object):
+    """A TCP connection to Keiko-chan."""
+
+    buffer_size = 256
+
+    def __init__(self, address, port=60000, nodelay=True, keepalive=True,
+                 connect_timeout=None, timeout=None):
+        self.address = address
+        self.port = port
+        self.nodelay = nodelay
+        self.keepalive = keepalive
+        self.connect_timeout = connect_timeout
+        self.timeout = timeout
+        self.sock = None
+        self.last_used = 0
+        self._buffer = bytearray(self.buffer_size)
+        self._view = memoryview(self._buffer)
+        self._start = self._end = 0  # unread bytes are in [_start:_end]
+
+    @property
+    def connected(self):
+        return self.sock is not None
+
+    def connect(self, deadline=None):
+        """Opens the socket and connects to Keiko-chan."""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            if self.nodelay:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if self.keepalive:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            sock.settimeout(_limit(self.connect_timeout, deadline))
+            sock.connect((self.address, self.port))
+            sock.settimeout(self.timeout)
+        except Exception:
+            sock.close()
+            raise
+        self.sock = sock
+        self.last_used = time.time()
+        self._start = self._end = 0
+
+    def close(self):
+        """Closes the socket."""
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            finally:
+                self.sock = None
+
+    def send(self, data, deadline=None):
+        if deadline is not None:
+            self.sock.settimeout(_limit(self.timeout, deadline))
+        self.sock.sendall(data)
+        self.last_used = time.time()
+
+    def recv(self, deadline=None):
+        """Reads one reply terminated by CR.
+
+        Replies split over several segments or coalesced into one are
+        framed in a receive buffer that is reused across calls.
+        """
+        while True:
+            index = self._buffer.find(b'\r', self._start, self._end)
+            if index >= 0:
+                reply = self._view[self._start:index + 1].tobytes()
+                self._start = index + 1
+                if self._start == self._end:
+                    self._start = self._end = 0
+                self.last_used = time.time()
+                return reply
+            if self._end == len(self._buffer):
+                self._compact()
+            if deadline is not None:
+                self.sock.settimeout(_limit(self.timeout, deadline))
+            size = self.sock.recv_into(self._view[self._end:])
+            if not size:
+                raise socket.error('Connection closed by Keiko-chan')
+            self._end += size
+
+    def _compact(self):
+        size = self._end - self._start
+        if size == len(self._buffer):  # full of a partial reply
+            buffer = bytearray(size * 2)
+            buffer[:size] = self._buffer
+            self._buffer, self._view = buffer, memoryview(buffer)
+        else:
+            self._buffer[:size] = self._buffer[self._start:self._end]
+        self._start, self._end = 0, size
+
+
+class ConnectionPool(object):
+    """A thread-safe pool of persistent connections to Keiko-chan.
+
+    At most <size> connections are opened at once; callers block until one
+    is released. Connections idle longer than <idle_timeout> seconds are
+    closed instead of being reused.
+    """
+
+    def __init__(self, address, port=60000, size=4, idle_timeout=30.0,
+                 **options):
+        self.address = address
+        self.port = port
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.options = options
+        self._idle = []  # LIFO, keeps the warmest connection on top
+        self._opened = 0
+        self._cond = threading.Condition(threading.Lock())
+
+    def _new_connection(self):
+        return Connection(self.address, self.port, **self.options)
+
+    def acquire(self, deadline=None):
+        """Takes a connection from the pool, waiting for one if needed.
+
+        The returned connection may not be connected yet.
+        """
+        with self._cond:
+            while True:
+                while self._idle:
+                    conn = self._idle.pop()
+                    if time.time() - conn.last_used <= self.idle_timeout:
+                        return conn
+                    conn.close()
+                    self._opened -= 1
+                if self._opened < self.size:
+                    self._opened += 1
+                    return self._new_connection()
+                self._cond.wait(_limit(None, deadline))
+
+    def release(self, conn, discard=False):
+        """Returns a connection to the pool, or closes it if <discard>."""
+        with self._cond:
+            if discard or not conn.connected:
+                conn.close()
+                self._opened -= 1
+            else:
+                self._idle.append(conn)
+            self._cond.notify()
+
+    def clear(self):
+        """Closes all the idle connections."""
+        with self._cond:
+            while self._idle:
+                self._idle.pop().close()
+                self._opened -= 1
+            self._cond.notify_all()
+
+
+def _limit(timeout, deadline):
+    """Returns <timeout> shortened to the time left until <deadline>."""
+    if deadline is None:
+        return timeout
+    remaining = deadline - time.time()
+    if remaining <= 0:
+        raise DeadlineExceeded('Deadline exceeded')
+    if timeout is None:
+        return remaining
+    return min(timeout, remaining)
@@ -1,7 +1,12 @@
 """
 Provides utilities for flags arguments of commands.
+
+The codecs look the flags up in tables built once at import, for every
+combination of the states.
 """
 
+import itertools
+
 # lamps
 _LAMP_DIGITS = {
     'red': 0,
@@ -30,20 +35,14 @@ def build_lamp_flags(states):
 
         {'lamps': {'red': 'on', 'green': 'off'}}
     """
-    flag_list = list('XXXXXXXX')
-    for color, state in states['lamps'].items():
-        flag_list[_LAMP_DIGITS[color]] = str(_LAMP_STATES[state])
-    return ''.join(flag_list)
+    lamps = states['lamps']
+    return _lookup(_LAMP_ENCODE, lamps, _LAMP_COLORS)
 
 
 def parse_lamp_flags(flags):
     """Parses flags and returns a dict that represents the lamp states."""
     # flags: [0123]{8}
-    values = _swap_key_and_value(_LAMP_STATES)  # {value: state}
-    states = dict([
-        (color, values[flags[digit]]) for color, digit in _LAMP_DIGITS.items()
-    ])
-    return {'lamps': states}
+    return {'lamps': dict(_LAMP_DECODE[flags[:3]])}
 
 
 # buzzer
@@ -66,22 +65,16 @@ def build_buzzer_flags(states):
 
         {'buzzer': 'continuous'}
     """
-    flag_list = list('XXXXXXXX')
-    state = states['buzzer']
-    if state == 'off':
-        for digit in _BUZZER_DIGITS.values():
-            flag_list[digit] = '0'
-    else:
-        flag_list[_BUZZER_DIGITS[state]] = '1'
-    return ''.join(flag_list)
+    return _BUZZER_ENCODE[states['buzzer']]
 
 
 def parse_buzzer_flags(flags):
     """Parses flags and returns a dict that represents the buzzer states."""
     # flags: [0123]{8}
-    for state, digit in _BUZZER_DIGITS.items():
-        if flags[digit] == '1':
-            return {'buzzer': state}
+    if flags[3] == '1':
+        return {'buzzer': 'continuous'}
+    if flags[4] == '1':
+        return {'buzzer': 'intermittent'}
     return {'buzzer': 'off'}
 
 
@@ -111,20 +104,13 @@ def build_do_flags(states):
 
         {'do': {1: 'on', 3: 'off'}}
     """
-    flag_list = list('XXXXXXXX')
-    for term, state in states['do'].items():
-        flag_list[_DO_DIGITS[term]] = str(_DO_STATES[state])
-    return ''.join(flag_list)
+    return _lookup(_DO_ENCODE, states['do'], _DO_TERMS)
 
 
 def parse_do_flags(flags):
     """Parses flags and returns a dict that represents the DOs states."""
     # flags: [01]{8}
-    values = _swap_key_and_value(_DO_STATES)  # {value: state}
-    states = dict([
-        (term, values[flags[digit]]) for term, digit in _DO_DIGITS.items()
-    ])
-    return {'do': states}
+    return {'do': dict(_DO_DECODE[flags[:4]])}
 
 
 # DIs
@@ -143,11 +129,7 @@ _DI_STATES = {
 def parse_di_flags(flags):
     """Parses flags and returns a dict that represents the DIs states."""
     # flags: [01]{4}
-    values = _swap_key_and_value(_DI_STATES)  # {value: state}
-    states = dict([
-        (term, values[flags[digit]]) for term, digit in _DI_DIGITS.items()
-    ])
-    return {'di': states}
+    return {'di': dict(_DI_DECODE[flags[:4]])}
 
 
 # voice
@@ -188,6 +170,270 @@ def parse_voice_flags(flags):
         }}
 
 
+# state
+def parse_state(unit1, unit2, di, voice):
+    """Parses the replies of ACOP -u 1, ACOP -u 2, ROPS and SPOP and returns
+    a DeviceState.
+    """
+    # unit1: [0123]{8}, unit2: [01]{8}, di: [01]{4}, voice: [0-9]{8}
+    if voice[0] == '0':
+        voice_bits = 0
+    else:
+        voice_bits = 0x4000 | int(voice[1:3]) << 7 | int(voice[4:6])
+    return DeviceState(
+        flags_to_bits(unit1[:5]) |
+        flags_to_bits(unit2[:4]) << _DO_SHIFT |
+        flags_to_bits(di[:4]) << _DI_SHIFT |
+        voice_bits << _VOICE_SHIFT
+    )
+
+
+class DeviceState(object):
+    """The state of the lamps, buzzer, DOs, DIs and voice packed into an int.
+
+    States are immutable, hashable and compared by value, so they are cheap
+    to keep as history. The dicts of the parse_*_flags functions are built
+    on demand by the properties, and diff() finds the changed outputs from
+    the xor of two states.
+
+    <bits> holds 2 bits per digit of the flags: the lamps and the buzzer
+    from bit 0, the DOs from bit 16 and the DIs from bit 24, and the voice
+    from bit 32 as 1 bit playing, 7 bits number and 7 bits repeat.
+    """
+
+    __slots__ = ('bits',)
+
+    def __init__(self, bits=0):
+        object.__setattr__(self, 'bits', bits)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('DeviceState is immutable')
+
+    def __eq__(self, other):
+        return isinstance(other, DeviceState) and self.bits == other.bits
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.bits)
+
+    def __reduce__(self):
+        return (DeviceState, (self.bits,))
+
+    def __repr__(self):
+        return 'DeviceState(0x{0:x})'.format(self.bits)
+
+    @classmethod
+    def from_dict(cls, states):
+        """Builds a state from a dict like the one of to_dict()."""
+        unit1 = merge_flags(
+            merge_flags('00000000', build_lamp_flags(states)),
+            build_buzzer_flags(states)
+        )
+        unit2 = merge_flags('00000000', build_do_flags(states))
+        di = ''.join(
+            str(_DI_STATES[states['di'][term]]) for term in _DI_TERMS
+        )
+        return parse_state(unit1, unit2, di, build_voice_flags(states))
+
+    @property
+    def lamps(self):
+        return dict(_LAMP_BITS_DECODE[self.bits & 0x3f])
+
+    @property
+    def buzzer(self):
+        if (self.bits >> 6) & 3 == 1:
+            return 'continuous'
+        if (self.bits >> 8) & 3 == 1:
+            return 'intermittent'
+        return 'off'
+
+    @property
+    def do(self):
+        return dict(_DO_BITS_DECODE[(self.bits >> _DO_SHIFT) & 0xff])
+
+    @property
+    def di(self):
+        return dict(_DI_BITS_DECODE[(self.bits >> _DI_SHIFT) & 0xff])
+
+    @property
+    def voice(self):
+        bits = self.bits >> _VOICE_SHIFT
+        if not bits:
+            return 'stop'
+        return {'number': (bits >> 7) & 0x7f, 'repeat': bits & 0x7f}
+
+    def to_dict(self):
+        return {
+            'lamps': self.lamps,
+            'buzzer': self.buzzer,
+            'do': self.do,
+            'di': self.di,
+            'voice': self.voice
+        }
+
+    def diff(self, other):
+        """Returns the states of the outputs and inputs that differ from
+        <other>, in the structure of to_dict().
+
+        Example:
+
+            state.diff(previous) == {'lamps': {'red': 'on'}, 'do': {2: 'off'}}
+        """
+        changed = self.bits ^ other.bits
+        if not changed:
+            return {}
+        diff = {}
+        values = {}
+        for group, name, mask in _DIFF_MASKS:
+            if changed & mask:
+                if group not in values:
+                    values[group] = getattr(self, group)
+                value = values[group]
+                if name is None:
+                    diff[group] = value
+                else:
+                    diff.setdefault(group, {})[name] = value[name]
+        return diff
+
+
+# utils
+def merge_flags(base, flags):
+    """Returns <base> overwritten by the digits of <flags> other than X.
+
+    Example:
+
+        merge_flags('10XXXXXX', 'X2X1XXXX') == '1201XXXX'
+    """
+    return ''.join(
+        b if f == 'X' else f for b, f in zip(base, flags)
+    )
+
+
+def flags_to_bits(flags):
+    """Returns <flags> of 0 - 3 digits, such as ACOP and ROPS replies, as an
+    int of 2 bits per digit, the first digit in the lowest bits.
+
+    Example:
+
+        flags_to_bits('12000000') == 0b1001
+    """
+    return int(flags[::-1], 4)  # base 4, the last digit the highest
+
+
+def bits_to_flags(bits, length=8):
+    """Returns the <length> digits of flags packed by flags_to_bits()."""
+    chunks = []
+    for _ in range(0, length, 4):
+        chunks.append(_BITS_TO_CHUNK[bits & 0xff])
+        bits >>= 8
+    return ''.join(chunks)[:length]
+
+
 # inner utils
 def _swap_key_and_value(dictionary):
     return dict((str(v), s) for s, v in dictionary.items())
+
+
+# tables
+def _encode_table(names, digits, states, length=8):
+    """Returns {frozenset([(<name>, <state>), ...]): <flags>} of all the
+    combinations of the states of any of <names>.
+    """
+    table = {}
+    choices = [None] + list(states)
+    for combination in itertools.product(choices, repeat=len(names)):
+        flag_list = ['X'] * length
+        items = []
+        for name, digit, state in zip(names, digits, combination):
+            if state is not None:
+                flag_list[digit] = str(states[state])
+                items.append((name, state))
+        table[frozenset(items)] = ''.join(flag_list)
+    return table
+
+
+def _decode_table(names, states):
+    """Returns {<digits>: {<name>: <state>}} of all the combinations.
+
+    <names> are in the order of their digits, from the first one.
+    """
+    values = _swap_key_and_value(states)  # {value: state}
+    table = {}
+    for combination in itertools.product(sorted(values), repeat=len(names)):
+        table[''.join(combination)] = dict(
+            (name, values[value]) for name, value in zip(names, combination)
+        )
+    return table
+
+
+def _lookup(table, states, names):
+    """Returns the flags of <states>, {<name>: <state>}, from <table>."""
+    try:
+        return table[frozenset(states.items())]
+    except (KeyError, TypeError):
+        for name, state in states.items():  # raises as by name and state
+            if name not in names:
+                raise KeyError(name)
+            if frozenset([(name, state)]) not in table:
+                raise KeyError(state)
+        raise
+
+
+def _chunks_table():
+    """Returns {<8 bits>: <4 digits>}."""
+    return dict(
+        (flags_to_bits(''.join(digits)), ''.join(digits))
+        for digits in itertools.product('0123', repeat=4)
+    )
+
+
+_LAMP_COLORS = sorted(_LAMP_DIGITS, key=_LAMP_DIGITS.get)
+_LAMP_ENCODE = _encode_table(
+    _LAMP_COLORS, [_LAMP_DIGITS[color] for color in _LAMP_COLORS],
+    _LAMP_STATES
+)
+_LAMP_DECODE = _decode_table(_LAMP_COLORS, _LAMP_STATES)
+
+_BUZZER_ENCODE = {
+    'continuous': 'XXX1XXXX',
+    'intermittent': 'XXXX1XXX',
+    'off': 'XXX00XXX'
+}
+
+_DO_TERMS = sorted(_DO_DIGITS)
+_DO_ENCODE = _encode_table(
+    _DO_TERMS, [_DO_DIGITS[term] for term in _DO_TERMS], _DO_STATES
+)
+_DO_DECODE = _decode_table(_DO_TERMS, _DO_STATES)
+
+_DI_TERMS = sorted(_DI_DIGITS)
+_DI_DECODE = _decode_table(_DI_TERMS, _DI_STATES)
+
+_BITS_TO_CHUNK = _chunks_table()
+
+_DO_SHIFT = 16
+_DI_SHIFT = 24
+_VOICE_SHIFT = 32
+
+_LAMP_BITS_DECODE = dict(
+    (flags_to_bits(digits), states) for digits, states in _LAMP_DECODE.items()
+)
+_DO_BITS_DECODE = dict(
+    (flags_to_bits(digits), states) for digits, states in _DO_DECODE.items()
+)
+_DI_BITS_DECODE = dict(
+    (flags_to_bits(digits), states) for digits, states in _DI_DECODE.items()
+)
+
+_DIFF_MASKS = (  # (group, name or None for the whole group, mask)
+    [('lamps', color, 3 << _LAMP_DIGITS[color] * 2)
+     for color in _LAMP_COLORS] +
+    [('buzzer', None, 0xf << 6)] +
+    [('do', term, 3 << (_DO_SHIFT + _DO_DIGITS[term] * 2))
+     for term in _DO_TERMS] +
+    [('di', term, 3 << (_DI_SHIFT + _DI_DIGITS[term] * 2))
+     for term in _DI_TERMS] +
+    [('voice', None, 0x7fff << _VOICE_SHIFT)]
+)
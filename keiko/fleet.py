@@ -0,0 +1,133 @@
+"""
+Provides a client to control many Keiko-chan units at once.
+"""
+
+import concurrent.futures
+import inspect
+
+from .clients import Client
+
+
+class FleetResult(dict):
+    """Results of an operation keyed by device.
+
+    The devices that failed are not in the dict itself; their exceptions
+    are in <errors> instead.
+    """
+
+    def __init__(self, results=(), errors=None):
+        dict.__init__(self, results)
+        self.errors = errors or {}
+
+    @property
+    def ok(self):
+        """True if the operation succeeded on every device."""
+        return not self.errors
+
+
+class FleetClient(object):
+    """Fans out the high level APIs of Client to many Keiko-chan units.
+
+    <devices> is a list of addresses, or a dict of {<id>: <address>}.
+    Any attribute path of Client can be used and the operation runs on
+    every device concurrently:
+
+        fleet = FleetClient(['192.168.1.2', '192.168.1.3'])
+        fleet.lamps.red.on()
+        fleet.do(2).off()
+        fleet.lamps.status  # {'192.168.1.2': {...}, '192.168.1.3': {...}}
+
+    The operations return a FleetResult. A device that fails or does not
+    answer within <timeout> seconds is reported in FleetResult.errors and
+    does not hold up the others.
+    """
+
+    def __init__(self, devices, port=60000, max_workers=16, timeout=None,
+                 **options):
+        if not isinstance(devices, dict):
+            devices = dict((address, address) for address in devices)
+        if not devices:
+            raise ValueError('No devices')
+        self.clients = dict(
+            (key, Client(address, port, **options))
+            for key, address in devices.items()
+        )
+        self.timeout = timeout
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return _FleetProxy(self, ()).__getattr__(name)
+
+    def close(self):
+        """Stops the workers and closes the connections."""
+        self._executor.shutdown(wait=False)
+        for client in self.clients.values():
+            client.raw.close()
+
+    def map(self, func, timeout=None):
+        """Calls func(<client>) for every client concurrently.
+
+        Returns a FleetResult of the return values.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        futures = dict(
+            (self._executor.submit(func, client), key)
+            for key, client in self.clients.items()
+        )
+        done, not_done = concurrent.futures.wait(futures, timeout)
+        result = FleetResult()
+        for future in done:
+            key = futures[future]
+            error = future.exception()
+            if error is None:
+                result[key] = future.result()
+            else:
+                result.errors[key] = error
+        for future in not_done:
+            future.cancel()
+            result.errors[futures[future]] = concurrent.futures.TimeoutError(
+                'No response within {0} seconds'.format(timeout)
+            )
+        return result
+
+
+class _FleetProxy(object):
+    """Records an attribute path of Client until it reaches an operation."""
+
+    def __init__(self, fleet, path):
+        self._fleet = fleet
+        self._path = path
+
+    def _resolve(self, client, path):
+        target = client
+        for step in path:
+            if isinstance(step, tuple):
+                args, kwargs = step
+                target = target(*args, **kwargs)
+            else:
+                target = getattr(target, step)
+        return target
+
+    def _template(self):
+        # holders do no I/O until an operation, so the path can be walked
+        # on any client to find out what it refers to
+        client = next(iter(self._fleet.clients.values()))
+        return self._resolve(client, self._path)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        target = self._template()
+        if isinstance(getattr(type(target), name, None), property):
+            path = self._path + (name,)
+            return self._fleet.map(lambda c: self._resolve(c, path))
+        return _FleetProxy(self._fleet, self._path + (name,))
+
+    def __call__(self, *args, **kwargs):
+        path = self._path + ((args, kwargs),)
+        if inspect.ismethod(self._template()):
+            return self._fleet.map(lambda c: self._resolve(c, path))
+        return _FleetProxy(self._fleet, path)
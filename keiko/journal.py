@@ -0,0 +1,234 @@
+"""
+Provides a journal of the states of Keiko-chan in a file of fixed-size
+records.
+
+    journal = Journal('keiko.journal', capacity=1000000)
+    client = Client(address, journal=journal)
+    ...
+    for entry in journal.query(start, end, device='192.168.1.2:60000'):
+        print(entry.timestamp, entry.state.lamps['red'])
+"""
+
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+
+from .flags import DeviceState, merge_flags, parse_state
+
+
+_MAGIC = b'KEIKOJ1\x00'
+_HEADER = struct.Struct('<8sI4xQQ')  # magic, record size, capacity, count
+_RECORD = struct.Struct('<dQ32s')  # timestamp, state, device
+_COUNT_OFFSET = 24
+
+_READS = ('ACOP -u 1', 'ACOP -u 2', 'ROPS', 'SPOP')
+_GROUPS = (('lamps', 'buzzer'), ('do',), ('di',), ('voice',))
+_KNOWN_SHIFT = 56  # the reads known are flagged above the DeviceState
+_STATE_MASK = (1 << _KNOWN_SHIFT) - 1
+
+_ACOP_WRITE = re.compile(r'(ACOP -u [12]) (\S{8}) -w (\d+) -t (\d+)$')
+_SPOP_WRITE = re.compile(r'SPOP ([0-9]{8})$')
+_FLAGS = re.compile(r'[0-9]{8}$')
+
+
+class JournalEntry(object):
+    """The state of <device> at <timestamp>.
+
+    <known> is the groups of <state> (lamps, buzzer, do, di and voice)
+    that had been read or written; the others are all off in <state>.
+    """
+
+    def __init__(self, timestamp, device, state, known):
+        self.timestamp = timestamp
+        self.device = device
+        self.state = state
+        self.known = known
+
+    def __eq__(self, other):
+        return (isinstance(other, JournalEntry) and
+                (self.timestamp, self.device, self.state, self.known) ==
+                (other.timestamp, other.device, other.state, other.known))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def to_dict(self):
+        states = self.state.to_dict()
+        entry = dict((group, states[group]) for group in self.known)
+        entry['timestamp'] = self.timestamp
+        entry['device'] = self.device
+        return entry
+
+    def __repr__(self):
+        return 'JournalEntry({0!r}, {1!r}, {2!r}, {3!r})'.format(
+            self.timestamp, self.device, self.state, self.known
+        )
+
+
+class Journal(object):
+    """Records the changes of the states seen by the clients in <path>.
+
+    Pass the journal to the clients with journal=<journal>. Every reply of
+    a status read and every write that takes effect at once update the
+    state of the device, and a record is appended when the state changes.
+
+    With <capacity>, the file keeps only the last <capacity> records as a
+    ring buffer. <capacity> is only used when the file is created. The
+    records are in time order, and query() binary searches them in a
+    memory map of the file, so it also works on the file of a journal in
+    another process.
+
+    Devices are named by their first 32 bytes.
+    """
+
+    def __init__(self, path, capacity=0):
+        self.path = path
+        self._lock = threading.Lock()
+        self._replies = {}  # {device: {read: reply}}
+        self._last = {}  # {device: state bits with the known reads}
+        self._timestamp = 0.0
+        if not os.path.exists(path) or not os.path.getsize(path):
+            with open(path, 'wb') as f:
+                f.write(_HEADER.pack(_MAGIC, _RECORD.size, capacity, 0))
+        self._file = open(path, 'r+b')
+        magic, size, self.capacity, self._count = _HEADER.unpack(
+            self._file.read(_HEADER.size)
+        )
+        if magic != _MAGIC or size != _RECORD.size:
+            self._file.close()
+            raise ValueError('Not a journal: ' + path)
+        if len(self):
+            last = (self._count - 1) % (self.capacity or self._count + 1)
+            self._file.seek(_HEADER.size + last * _RECORD.size)
+            self._timestamp = _RECORD.unpack(
+                self._file.read(_RECORD.size)
+            )[0]
+
+    def __len__(self):
+        if self.capacity:
+            return min(self._count, self.capacity)
+        return self._count
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def observe(self, device, commands, outcomes):
+        """Updates the state of <device> from commands and their results
+        or exceptions, and records it if it has changed.
+        """
+        with self._lock:
+            replies = self._replies.setdefault(device, {})
+            for command, outcome in zip(commands, outcomes):
+                if not isinstance(outcome, Exception):
+                    _update(replies, command, outcome)
+            known = 0
+            for i, read in enumerate(_READS):
+                if read in replies:
+                    known |= 1 << i
+            if not known:
+                return
+            bits = parse_state(
+                replies.get('ACOP -u 1', '00000000'),
+                replies.get('ACOP -u 2', '00000000'),
+                replies.get('ROPS', '0000'),
+                replies.get('SPOP', '00000000')
+            ).bits | known << _KNOWN_SHIFT
+            if self._last.get(device) == bits:
+                return
+            self._last[device] = bits
+            self._append(device, bits)
+
+    def _append(self, device, bits):
+        # time.time() may step back; the records have to stay in order
+        self._timestamp = max(time.time(), self._timestamp)
+        slot = self._count % self.capacity if self.capacity else self._count
+        self._file.seek(_HEADER.size + slot * _RECORD.size)
+        self._file.write(_RECORD.pack(
+            self._timestamp, bits, device.encode('utf-8')[:32]
+        ))
+        self._count += 1
+        self._file.seek(_COUNT_OFFSET)
+        self._file.write(struct.pack('<Q', self._count))
+        self._file.flush()
+
+    def query(self, start=None, end=None, device=None, limit=None):
+        """Returns the JournalEntries from <start> until before <end>.
+
+        Only the entries of <device> are returned if it is given, and only
+        the last <limit> if that is given.
+        """
+        with self._lock, open(self.path, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                return _query(data, start, end, device, limit)
+            finally:
+                data.close()
+
+
+def _update(replies, command, reply):
+    if command in _READS:
+        replies[command] = reply
+        return
+    match = _ACOP_WRITE.match(command)
+    if match:
+        read, flags, wait, time_ = match.groups()
+        if wait != '0' or time_ != '0':
+            replies.pop(read, None)  # unknown until the next read
+        elif _FLAGS.match(reply):  # the reply is the new state
+            replies[read] = reply
+        elif read in replies:
+            replies[read] = merge_flags(replies[read], flags)
+        return
+    match = _SPOP_WRITE.match(command)
+    if match:
+        replies['SPOP'] = match.group(1)
+    elif command == 'ALOF':  # all off
+        for read in ('ACOP -u 1', 'ACOP -u 2', 'SPOP'):
+            replies[read] = '00000000'
+
+
+def _query(data, start, end, device, limit):
+    _, _, capacity, count = _HEADER.unpack_from(data)
+    length = min(count, capacity) if capacity else count
+    first = count - length  # the oldest record kept
+
+    def offset(i):
+        slot = (first + i) % capacity if capacity else i
+        return _HEADER.size + slot * _RECORD.size
+
+    def bisect(timestamp):
+        # the first record at <timestamp> or later
+        lo, hi = 0, length
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if struct.unpack_from('<d', data, offset(mid))[0] < timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    lo = 0 if start is None else bisect(start)
+    hi = length if end is None else bisect(end)
+    name = None if device is None else device.encode('utf-8')[:32]
+    entries = []
+    for i in range(hi - 1, lo - 1, -1):
+        if limit is not None and len(entries) >= limit:
+            break
+        timestamp, bits, recorded = _RECORD.unpack_from(data, offset(i))
+        recorded = recorded.rstrip(b'\x00')
+        if name is not None and recorded != name:
+            continue
+        known = tuple(
+            group for j, groups in enumerate(_GROUPS)
+            if bits >> (_KNOWN_SHIFT + j) & 1 for group in groups
+        )
+        entries.append(JournalEntry(
+            timestamp, recorded.decode('utf-8'),
+            DeviceState(bits & _STATE_MASK), known
+        ))
+    entries.reverse()
+    return entries
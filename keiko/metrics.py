@@ -0,0 +1,166 @@
+"""
+Provides counters and histograms exported in the Prometheus text format.
+"""
+
+import threading
+
+
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+    10.0
+)
+
+
+class Counter(object):
+    """A counter of events per label values."""
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *values, **kwargs):
+        """Increments the counter of the label <values> by <amount>."""
+        amount = kwargs.get('amount', 1)
+        with self._lock:
+            self._values[values] = self._values.get(values, 0) + amount
+
+    def value(self, *values):
+        return self._values.get(values, 0)
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        for values, value in items:
+            yield self.name, self.labels, values, value
+
+
+class Gauge(Counter):
+    """A value that goes up and down per label values, such as a size."""
+
+    kind = 'gauge'
+
+    def set(self, value, *values):
+        """Sets the gauge of the label <values> to <value>."""
+        with self._lock:
+            self._values[values] = value
+
+    def dec(self, *values, **kwargs):
+        """Decrements the gauge of the label <values> by <amount>."""
+        self.inc(*values, amount=-kwargs.get('amount', 1))
+
+
+class Histogram(object):
+    """A histogram of observed values, such as durations, per label values."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(),
+                 buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}  # {values: [bucket counts..., sum, count]}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *values):
+        """Records <value> for the label <values>."""
+        with self._lock:
+            data = self._values.get(values)
+            if data is None:
+                data = self._values[values] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    data[i] += 1
+                    break
+            data[-2] += value
+            data[-1] += 1
+
+    def count(self, *values):
+        data = self._values.get(values)
+        return data[-1] if data else 0
+
+    def samples(self):
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._values.items())
+        labels = self.labels + ('le',)
+        for values, data in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, data):
+                cumulative += count
+                yield (self.name + '_bucket', labels,
+                       values + (_format_value(bound),), cumulative)
+            yield (self.name + '_bucket', labels, values + ('+Inf',),
+                   data[-1])
+            yield self.name + '_sum', self.labels, values, data[-2]
+            yield self.name + '_count', self.labels, values, data[-1]
+
+
+class Registry(object):
+    """A set of metrics rendered together."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, documentation, labels, **options):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = cls(name, documentation, labels, **options)
+                self._metrics[name] = metric
+            return metric
+
+    def counter(self, name, documentation, labels=()):
+        """Returns the counter <name>, creating it if needed."""
+        return self._get(Counter, name, documentation, labels)
+
+    def gauge(self, name, documentation, labels=()):
+        """Returns the gauge <name>, creating it if needed."""
+        return self._get(Gauge, name, documentation, labels)
+
+    def histogram(self, name, documentation, labels=(),
+                  buckets=DEFAULT_BUCKETS):
+        """Returns the histogram <name>, creating it if needed."""
+        return self._get(
+            Histogram, name, documentation, labels, buckets=buckets
+        )
+
+    def render(self):
+        """Returns all the metrics in the Prometheus text format."""
+        lines = []
+        with self._lock:
+            metrics = sorted(self._metrics.items())
+        for name, metric in metrics:
+            lines.append('# HELP {0} {1}'.format(name, metric.documentation))
+            lines.append('# TYPE {0} {1}'.format(name, metric.kind))
+            for sample, labels, values, value in metric.samples():
+                lines.append('{0}{1} {2}'.format(
+                    sample, _format_labels(labels, values),
+                    _format_value(value)
+                ))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def _format_labels(labels, values):
+    if not labels:
+        return ''
+    pairs = []
+    for label, value in zip(labels, values):
+        value = str(value).replace('\\', r'\\').replace('"', r'\"')
+        pairs.append('{0}="{1}"'.format(label, value.replace('\n', r'\n')))
+    return '{' + ','.join(pairs) + '}'
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
@@ -0,0 +1,314 @@
+"""
+Provides patterns that play timed lamp, buzzer, DO and voice changes.
+
+The timing is left to Keiko-chan wherever it can be, with the wait and time
+of ACOP, so that most patterns are sent at once and no thread sleeps between
+the steps:
+
+    pattern = Pattern()
+    pattern.then({'lamps': {'red': 'on'}, 'buzzer': 'intermittent'}, 5)
+    pattern.then({'lamps': {'yellow': 'blink'}}, 10)
+    client.play(pattern)  # ACOP -u 1 1XXX1XXX -w 0 -t 5 and
+                          # ACOP -u 1 X2XXXXXX -w 5 -t 10 in one round trip
+"""
+
+import collections
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+import concurrent.futures
+
+from .flags import (
+    merge_flags, build_lamp_flags, build_buzzer_flags, build_do_flags,
+    build_voice_flags
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+class Pattern(object):
+    """A timeline of changes of the lamps, the buzzer, the DOs and the voice.
+
+    Every step sets <states>, in the structure of Snapshot.to_dict(), <at>
+    seconds from the start for <duration> seconds, or keeps them if
+    <duration> is 0. After a whole number of seconds Keiko-chan restores
+    the previous states; a fractional <duration> ends by turning the
+    outputs of the step off, and the voice is stopped.
+    """
+
+    def __init__(self):
+        self.steps = []  # [(at, states, duration)]
+
+    def __len__(self):
+        return len(self.steps)
+
+    @property
+    def length(self):
+        """The time in seconds until the end of the last step."""
+        return max([at + duration for at, _, duration in self.steps] or [0])
+
+    def add(self, states, at=0, duration=0):
+        """Adds a step and returns the pattern.
+
+        Raises ValueError or KeyError if the step is invalid.
+        """
+        if at < 0 or duration < 0:
+            raise ValueError('at and duration must not be negative')
+        unknown = set(states) - set(['lamps', 'buzzer', 'do', 'voice'])
+        if unknown:
+            raise ValueError('unknown keys: ' + ', '.join(sorted(unknown)))
+        _unit_flags(states)
+        if 'voice' in states:
+            build_voice_flags(states)
+        self.steps.append((at, states, duration))
+        return self
+
+    def then(self, states, duration=0):
+        """Adds a step at the end of the pattern and returns the pattern."""
+        return self.add(states, self.length, duration)
+
+    def compile(self):
+        """Returns the commands of the pattern as [(<offset>, <command>)].
+
+        <offset> is the time in seconds from the start at which the host
+        has to send <command>, and is 0 for all the steps that start and
+        end at whole seconds. The ACOP commands of the steps with the same
+        start and duration are merged. The voice, and the fractions of a
+        second, are timed by the host; a step with a fractional duration
+        is ended by turning its outputs off.
+        """
+        acops = []  # [[offset, unit, wait, time, flags]]
+        commands = []  # [(offset, sequence, command)]
+        for at, states, duration in self.steps:
+            if at == int(at):
+                offset, wait = 0, int(at)
+            else:
+                offset, wait = at, 0
+            if duration == int(duration):
+                time_, end = int(duration), None
+            else:
+                time_, end = 0, at + duration
+            for unit, flags in _unit_flags(states):
+                _merge(acops, offset, unit, wait, time_, flags)
+            if end is not None:
+                for unit, flags in _unit_flags(_off(states)):
+                    _merge(acops, end, unit, 0, 0, flags)
+            if 'voice' in states:
+                commands.append(
+                    (at, len(commands), 'SPOP ' + build_voice_flags(states))
+                )
+                if duration:
+                    commands.append(
+                        (at + duration, len(commands), 'SPOP 00000000')
+                    )
+        for i, (offset, unit, wait, time_, flags) in enumerate(acops):
+            commands.append((
+                offset, -len(acops) + i,  # before the voice at the offset
+                'ACOP -u {0} {1} -w {2} -t {3}'.format(
+                    unit, flags, wait, time_
+                )
+            ))
+        return [(offset, command) for offset, _, command in sorted(commands)]
+
+
+class Playback(object):
+    """A pattern played by a PatternPlayer."""
+
+    def __init__(self, rawclient, pattern, loops):
+        self.raw = rawclient
+        self.pattern = pattern
+        self.loops = loops
+        self.cycles = 0  # the started cycles
+        self.cancelled = False
+        self.done = threading.Event()
+        self._pending = 0  # jobs in the queue and sends of the player
+        self._sends = collections.deque()  # [[command]] in order
+
+    def cancel(self):
+        """Stops sending the rest of the pattern.
+
+        The commands already sent run until their time is over on the
+        device.
+        """
+        self.cancelled = True
+        self.done.set()
+
+    def wait(self, timeout=None):
+        """Waits until the pattern has been sent; returns False on timeout."""
+        return self.done.wait(timeout)
+
+
+class PatternPlayer(object):
+    """Plays Patterns on any number of Keiko-chan with one timer thread.
+
+    The commands at offset 0 of the first cycle are sent by play(), so that
+    its errors are raised. The thread times the commands that the host has
+    to send and the next cycles of looped patterns, and hands the sends to
+    <max_workers> threads, so that a slow Keiko-chan does not delay the
+    other playbacks. The sends of a playback are made in order.
+    """
+
+    def __init__(self, max_workers=4):
+        self._queue = []  # heap of (due, sequence, playback, commands)
+        self._sequence = itertools.count()
+        self._cond = threading.Condition(threading.Lock())
+        self._thread = None
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+
+    def __len__(self):
+        return len(self._queue)
+
+    def play(self, rawclient, pattern, loops=1):
+        """Plays <pattern> <loops> times, or until cancelled if 0.
+
+        Returns a Playback.
+        """
+        if loops != 1 and pattern.length <= 0:
+            raise ValueError('only a pattern with a length can loop')
+        playback = Playback(rawclient, pattern, loops)
+        self._start(playback, time.time(), raise_on_error=True)
+        return playback
+
+    def _start(self, playback, start, raise_on_error=False):
+        playback.cycles += 1
+        groups = []  # [(offset, [command])]
+        for offset, command in playback.pattern.compile():
+            if groups and groups[-1][0] == offset:
+                groups[-1][1].append(command)
+            else:
+                groups.append((offset, [command]))
+        with self._cond:
+            for offset, commands in groups:
+                if offset:
+                    self._push(start + offset, playback, commands)
+            if not playback.loops or playback.cycles < playback.loops:
+                self._push(start + playback.pattern.length, playback, None)
+            if groups and not groups[0][0] and not raise_on_error:
+                self._send(playback, groups[0][1])
+        if groups and not groups[0][0] and raise_on_error:
+            try:
+                playback.raw.execute_many(groups[0][1])
+            except Exception:
+                playback.cancel()
+                raise
+        with self._cond:
+            if not playback._pending:
+                playback.done.set()
+
+    def _push(self, due, playback, commands):
+        playback._pending += 1
+        heapq.heappush(
+            self._queue, (due, next(self._sequence), playback, commands)
+        )
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+        self._cond.notify()
+
+    def _pop(self):
+        with self._cond:
+            while True:
+                if not self._queue:
+                    self._cond.wait()
+                    continue
+                due, _, playback, commands = self._queue[0]
+                delay = due - time.time()
+                if delay > 0 and not playback.cancelled:
+                    self._cond.wait(delay)
+                    continue
+                heapq.heappop(self._queue)
+                if not playback.cancelled:
+                    return due, playback, commands
+                playback._pending -= 1
+
+    def _run(self):
+        while True:
+            due, playback, commands = self._pop()
+            if commands is None:
+                self._start(playback, due)
+            with self._cond:
+                if commands is not None:
+                    self._send(playback, commands)
+                self._finish(playback)
+
+    def _send(self, playback, commands):
+        # with self._cond; one worker at a time sends for a playback
+        playback._pending += 1
+        playback._sends.append(commands)
+        if len(playback._sends) == 1:
+            self._executor.submit(self._send_all, playback)
+
+    def _send_all(self, playback):
+        while True:
+            with self._cond:
+                commands = playback._sends[0]
+            if not playback.cancelled:
+                try:
+                    playback.raw.execute_many(commands)
+                except Exception:
+                    logger.exception('Failed to play a pattern')
+            with self._cond:
+                playback._sends.popleft()
+                self._finish(playback)
+                if not playback._sends:
+                    return
+
+    def _finish(self, playback):
+        # with self._cond; a job or a send of <playback> is over
+        playback._pending -= 1
+        if not playback._pending:
+            playback.done.set()
+
+
+_player = None
+_player_lock = threading.Lock()
+
+
+def play(rawclient, pattern, loops=1):
+    """Plays <pattern> on the PatternPlayer shared by the process."""
+    global _player
+    with _player_lock:
+        if _player is None:
+            _player = PatternPlayer()
+    return _player.play(rawclient, pattern, loops)
+
+
+def _unit_flags(states):
+    """Returns [(unit, flags)] of the lamp, buzzer and DO <states>."""
+    units = []
+    flags = None
+    if 'lamps' in states:
+        flags = build_lamp_flags(states)
+    if 'buzzer' in states:
+        buzzer = build_buzzer_flags(states)
+        flags = buzzer if flags is None else merge_flags(flags, buzzer)
+    if flags is not None:
+        units.append((1, flags))
+    if 'do' in states:
+        units.append((2, build_do_flags(states)))
+    return units
+
+
+def _off(states):
+    """Returns the states that turn off the outputs of <states>."""
+    off = {}
+    if 'lamps' in states:
+        off['lamps'] = dict((color, 'off') for color in states['lamps'])
+    if 'buzzer' in states:
+        off['buzzer'] = 'off'
+    if 'do' in states:
+        off['do'] = dict((term, 'off') for term in states['do'])
+    return off
+
+
+def _merge(acops, offset, unit, wait, time_, flags):
+    for acop in acops:
+        if acop[:4] == [offset, unit, wait, time_]:
+            acop[4] = merge_flags(acop[4], flags)
+            return
+    acops.append([offset, unit, wait, time_, flags])
@@ -0,0 +1,226 @@
+"""
+Provides a scheduler that serializes the commands to Keiko-chan.
+"""
+
+import heapq
+import itertools
+import re
+import threading
+import time
+
+from .connection import DeadlineExceeded
+from .flags import merge_flags
+from .metrics import REGISTRY
+
+
+WRITE = 0
+READ = 1
+
+_ACOP_WRITE = re.compile(r'(ACOP -u \d+) (\S{8}) (-w \d+ -t \d+)$')
+
+
+class CommandScheduler(object):
+    """Runs the commands to one Keiko-chan one at a time in a worker thread.
+
+    Writes are run before reads, so a flood of status polls cannot hold up
+    an alarm. While a command waits in the queue:
+
+    - the next ACOP write to the same unit is merged into it if it has the
+      same wait and time, the later flags winning for the same output,
+    - the next SPOP write replaces it,
+    - the same read shares its result.
+
+    A write that cannot merge ends the merging into the writes queued
+    before it, so that the writes are still done in order.
+
+    execute(<command>, <deadline>) runs a command and returns its result.
+    """
+
+    def __init__(self, execute, device='', metrics=REGISTRY):
+        self.execute = execute
+        self.device = device
+        self.metrics = metrics
+        self._queue = []  # heap of (priority, sequence, job)
+        self._pending = {}  # {merge key: job} of the queued jobs
+        self._sequence = itertools.count()
+        self._cond = threading.Condition(threading.Lock())
+        self._thread = None
+        self._stopping = False
+        if metrics is not None:
+            self._depth = metrics.gauge(
+                'keiko_scheduler_queue_depth',
+                'Commands waiting in the queue of the scheduler.',
+                ('device',)
+            )
+            self._wait = metrics.histogram(
+                'keiko_scheduler_wait_seconds',
+                'Time commands wait in the queue, by WRITE or READ.',
+                ('device', 'priority')
+            )
+            self._merged = metrics.counter(
+                'keiko_scheduler_merged_total',
+                'Commands merged into a queued command.',
+                ('device', 'priority')
+            )
+
+    def __len__(self):
+        return len(self._queue)
+
+    def submit(self, command, priority=WRITE, deadline=None):
+        """Queues <command> and returns its result.
+
+        <priority> is WRITE, or READ for a command that only reads the
+        state. Raises DeadlineExceeded if the command is still queued at
+        <deadline>.
+        """
+        with self._cond:
+            job = self._merge(command, priority, deadline)
+            if job is None:
+                job = _Job(
+                    lambda: self.execute(job.command, job.deadline), command,
+                    deadline
+                )
+                self._push(job, priority, _merge_key(command, priority))
+        return self._wait_for(job, deadline)
+
+    def stop(self):
+        """Stops the worker thread once the queued commands are done.
+
+        The next command queued starts a new one.
+        """
+        with self._cond:
+            thread = self._thread
+            if thread is None:
+                return
+            self._stopping = True
+            self._cond.notify()
+        thread.join()
+
+    def call(self, func, priority=WRITE, deadline=None):
+        """Queues func() and returns its result, e.g. for a pipeline."""
+        job = _Job(func)
+        with self._cond:
+            self._push(job, priority, None)
+        return self._wait_for(job, deadline)
+
+    def _merge(self, command, priority, deadline):
+        key = _merge_key(command, priority)
+        job = self._pending.get(key)
+        if job is None:
+            return None
+        if key[0] == 'ACOP':
+            old = _ACOP_WRITE.match(job.command)
+            new = _ACOP_WRITE.match(command)
+            if old.group(3) != new.group(3):
+                return None  # another wait or time, keep the order
+            job.command = '{0} {1} {2}'.format(
+                old.group(1), merge_flags(old.group(2), new.group(2)),
+                old.group(3)
+            )
+        elif key[0] == 'SPOP':
+            job.command = command
+        if job.deadline is not None:  # the job is sent for the last waiter
+            job.deadline = None if deadline is None else max(
+                job.deadline, deadline
+            )
+        job.waiters += 1
+        if self.metrics is not None:
+            self._merged.inc(self.device, _PRIORITIES[priority])
+        return job
+
+    def _push(self, job, priority, key):
+        job.priority = priority
+        job.key = key
+        job.queued = time.time()
+        if key is not None:
+            self._pending[key] = job
+        elif priority == WRITE:
+            # later writes must not merge into and overtake this one
+            for pending in list(self._pending):
+                if pending[0] != 'READ':
+                    del self._pending[pending]
+        heapq.heappush(self._queue, (priority, next(self._sequence), job))
+        if self.metrics is not None:
+            self._depth.set(len(self._queue), self.device)
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+        self._cond.notify()
+
+    def _pop(self):
+        with self._cond:
+            while True:
+                while not self._queue:
+                    if self._stopping:
+                        self._thread = None
+                        self._stopping = False
+                        return None
+                    self._cond.wait()
+                job = heapq.heappop(self._queue)[2]
+                if self._pending.get(job.key) is job:
+                    del self._pending[job.key]
+                if self.metrics is not None:
+                    self._depth.set(len(self._queue), self.device)
+                if job.waiters:
+                    job.started = True
+                    return job
+
+    def _run(self):
+        while True:
+            job = self._pop()
+            if job is None:
+                return
+            if self.metrics is not None:
+                self._wait.observe(
+                    time.time() - job.queued, self.device,
+                    _PRIORITIES[job.priority]
+                )
+            try:
+                job.result = job.func()
+            except Exception as e:
+                job.error = e
+            job.done.set()
+
+    def _wait_for(self, job, deadline):
+        timeout = None if deadline is None else deadline - time.time()
+        if not job.done.wait(timeout):
+            with self._cond:
+                if not job.started:
+                    # give up our share; the worker skips jobs nobody waits
+                    # for, and later commands do not merge into them
+                    job.waiters -= 1
+                    if not job.waiters and self._pending.get(job.key) is job:
+                        del self._pending[job.key]
+                    raise DeadlineExceeded('Deadline exceeded in the queue')
+            job.done.wait()  # already sent, the reply is on its way
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+
+class _Job(object):
+
+    def __init__(self, func, command=None, deadline=None):
+        self.func = func
+        self.command = command
+        self.deadline = deadline
+        self.waiters = 1
+        self.started = False
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+_PRIORITIES = {WRITE: 'WRITE', READ: 'READ'}
+
+
+def _merge_key(command, priority):
+    if priority == READ:
+        return ('READ', command)
+    match = _ACOP_WRITE.match(command)
+    if match:
+        return ('ACOP', match.group(1))
+    if command.startswith('SPOP '):
+        return ('SPOP',)
+    return None
@@ -0,0 +1,335 @@
+"""
+Provides a simulator of Keiko-chan speaking its TCP protocol.
+
+Run it on a laptop to test or benchmark the clients and the API server
+without a real device:
+
+    $ python -m keiko.simulator --port 60000 --latency 0.005
+"""
+
+import re
+import socket
+import threading
+import time
+
+try:
+    import socketserver
+except ImportError:  # py2
+    import SocketServer as socketserver
+
+
+_ACOP = re.compile(
+    r'ACOP -u ([12])(?: ([0-3X]{8}) -w (\d+) -t (\d+))?$'
+)
+_SPOP = re.compile(r'SPOP(?: ([0-9]{8}))?$')
+_RLY = re.compile(r'RLY([1-8])(?: (TurnOff|TurnOn|Blink) -w (\d+) -t (\d+))?$')
+_RYOT = re.compile(
+    r'RYOT -n ([1-4])(?: (TurnOff|TurnOn|Pulse) -w (\d+) -t (\d+))?$'
+)
+_RYIN = re.compile(r'RY(IN|OF) -n ([1-4])$')
+_SETTING = re.compile(r'(CKDI|CKID|CKIP|LGPW|PWST)(?: (\S+))?$')
+
+_VERBS = set([
+    'ACOP', 'ALOF', 'CKDI', 'CKID', 'CKIP', 'CKST', 'HELP', 'LGPW', 'PWST',
+    'RDCD', 'RDCN', 'RDMN', 'RDPD', 'RDSN', 'RLY1', 'RLY2', 'RLY3', 'RLY4',
+    'RLY5', 'RLY6', 'RLY7', 'RLY8', 'ROPS', 'RYIN', 'RYOF', 'RYOT', 'SPOP',
+    'UTID', 'VERN'
+])
+
+_INFO = {
+    'RDCD': '20991231',
+    'RDCN': '0000000000',
+    'RDMN': 'DN-1510GL',
+    'RDPD': '20130426',
+    'RDSN': '0000000001',
+    'UTID': '000000000001',
+    'VERN': '1.00'
+}
+
+
+class Device(object):
+    """The state of a simulated Keiko-chan.
+
+    execute() takes a command line without CR and returns the reply.
+    """
+
+    def __init__(self):
+        self.units = {1: list('00000000'), 2: list('00000000')}
+        self.di = list('0000')
+        self.voice = '00000000'
+        self.relays = dict((n, 'TurnOff') for n in range(1, 9))
+        self.outputs = dict((n, 'TurnOff') for n in range(1, 5))
+        self.settings = {
+            'CKDI': 'DDDD', 'CKID': 'Disable', 'CKIP': 'D' * 20,
+            'LGPW': 'isa', 'PWST': 'Disable'
+        }
+        self._lock = threading.Lock()
+        self._timers = set()
+
+    def set_di(self, term, state):
+        """Sets the DI <term> on or off, as a wired input would."""
+        with self._lock:
+            self.di[term - 1] = '1' if state == 'on' else '0'
+
+    def cancel(self):
+        """Cancels the pending delayed and timed changes."""
+        with self._lock:
+            for timer in self._timers:
+                timer.cancel()
+            self._timers.clear()
+
+    def _later(self, delay, func, *args):
+        if delay <= 0:
+            func(*args)
+            return
+        timer = threading.Timer(delay, self._fire, (func, args))
+        timer.daemon = True
+        self._timers.add(timer)
+        timer.start()
+
+    def _fire(self, func, args):
+        with self._lock:
+            self._timers.discard(threading.current_thread())
+            func(*args)
+
+    def _set_digits(self, unit, flags, time):
+        digits = self.units[unit]
+        previous = dict(
+            (i, digits[i]) for i, flag in enumerate(flags) if flag != 'X'
+        )
+        for i in previous:
+            digits[i] = flags[i]
+        if time > 0:
+            self._later(time, self._restore_digits, unit, previous)
+
+    def _restore_digits(self, unit, previous):
+        for i, digit in previous.items():
+            self.units[unit][i] = digit
+
+    def _set_output(self, outputs, key, param, time):
+        previous = outputs[key]
+        outputs[key] = param
+        if time > 0:
+            self._later(time, outputs.__setitem__, key, previous)
+
+    def execute(self, command):
+        with self._lock:
+            return self._execute(command)
+
+    def _execute(self, command):
+        match = _ACOP.match(command)
+        if match:
+            unit, flags, wait, time = match.groups()
+            if not flags:
+                return ''.join(self.units[int(unit)])
+            if unit == '2' and re.search('[23]', flags):
+                return 'ER03'
+            self._later(
+                int(wait), self._set_digits, int(unit), flags, int(time)
+            )
+            return 'OK'
+        if command == 'ROPS':
+            return ''.join(self.di)
+        match = _SPOP.match(command)
+        if match:
+            if match.group(1) is None:
+                return self.voice
+            self.voice = match.group(1)
+            return 'OK'
+        if command == 'ALOF':
+            self.units = {1: list('00000000'), 2: list('00000000')}
+            self.voice = '00000000'
+            return 'OK'
+        match = _RLY.match(command)
+        if match:
+            number, param, wait, time = match.groups()
+            if not param:
+                return self.relays[int(number)]
+            self._later(
+                int(wait), self._set_output, self.relays, int(number), param,
+                int(time)
+            )
+            return 'OK'
+        match = _RYOT.match(command)
+        if match:
+            term, param, wait, time = match.groups()
+            if not param:
+                return self.outputs[int(term)]
+            self._later(
+                int(wait), self._set_output, self.outputs, int(term), param,
+                int(time)
+            )
+            return 'OK'
+        match = _RYIN.match(command)
+        if match:
+            kind, term = match.groups()
+            if kind == 'OF':
+                self.outputs[int(term)] = 'TurnOff'
+                return 'OK'
+            return self.di[int(term) - 1]
+        match = _SETTING.match(command)
+        if match:
+            name, value = match.groups()
+            if value is None:
+                return self.settings[name]
+            self.settings[name] = value
+            return 'OK'
+        if command in _INFO:
+            return _INFO[command]
+        if command == 'CKST':
+            return 'OK'
+        if command == 'HELP':
+            return ' '.join(sorted(_INFO))
+        if command.split(' ')[0] in _VERBS:
+            return 'ER03'
+        return 'ER01'
+
+
+class _Handler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        server = self.server
+        if not server.admit():
+            return
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            self._serve(server)
+        finally:
+            server.leave()
+
+    def _serve(self, server):
+        buffer = b''
+        while True:
+            try:
+                data = self.request.recv(1024)
+            except socket.error:
+                return
+            if not data:
+                return
+            buffer += data
+            replies = []
+            while b'\r' in buffer:
+                line, buffer = buffer.split(b'\r', 1)
+                if server.latency:
+                    time.sleep(server.latency)
+                command = line.decode('ascii', 'replace')
+                if '\n' in command:
+                    replies.append('ER02')
+                else:
+                    replies.append(server.device.execute(command))
+            if replies:  # pipelined commands are answered in one segment
+                data = ''.join(reply + '\r' for reply in replies)
+                self.request.sendall(data.encode('ascii'))
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.TCPServer):
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, device, latency, max_connections):
+        socketserver.TCPServer.__init__(self, address, _Handler)
+        self.device = device
+        self.latency = latency
+        self.max_connections = max_connections
+        self.connections = 0
+        self._lock = threading.Lock()
+
+    def admit(self):
+        with self._lock:
+            if (self.max_connections is not None and
+                    self.connections >= self.max_connections):
+                return False  # the connection is closed at once
+            self.connections += 1
+            return True
+
+    def leave(self):
+        with self._lock:
+            self.connections -= 1
+
+
+class Simulator(object):
+    """A local TCP server that behaves like Keiko-chan.
+
+    <latency> is the delay in seconds before each reply, and
+    <max_connections> limits the concurrent connections like the device
+    does; extra connections are closed as soon as they are accepted.
+    Port 0 picks a free port, see <port> after start().
+    """
+
+    def __init__(self, address='127.0.0.1', port=0, latency=0.0,
+                 max_connections=None):
+        self.device = Device()
+        self._server = _Server(
+            (address, port), self.device, latency, max_connections
+        )
+        self.address, self.port = self._server.server_address[:2]
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        """Starts serving in a background thread."""
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stops serving and closes the socket."""
+        self._server.shutdown()
+        self._server.server_close()
+        self.device.cancel()
+        self._thread.join()
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--address',
+        default='127.0.0.1',
+        help='address to listen on[127.0.0.1]'
+    )
+    parser.add_argument(
+        '--port',
+        type=int,
+        default=60000,
+        help='port to listen on[60000]'
+    )
+    parser.add_argument(
+        '--latency',
+        type=float,
+        default=0.0,
+        help='delay in seconds before each reply[0.0]'
+    )
+    parser.add_argument(
+        '--max-connections',
+        type=int,
+        default=None,
+        help='maximum concurrent connections[unlimited]'
+    )
+    args = parser.parse_args()
+
+    simulator = Simulator(
+        args.address, args.port, args.latency, args.max_connections
+    )
+    print('Keiko-chan simulator on {0}:{1}'.format(
+        simulator.address, simulator.port
+    ))
+    try:
+        simulator.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+"""
+Provides a poller that shares the state of Keiko-chan with subscribers.
+"""
+
+import logging
+import threading
+
+try:
+    import queue
+except ImportError:  # py2
+    import Queue as queue
+
+
+logger = logging.getLogger(__name__)
+
+
+class StatePoller(object):
+    """Polls Client.snapshot() in one thread for any number of subscribers.
+
+    The poller runs only while someone is subscribed, and publishes a
+    snapshot to every subscriber when the state changes, so the load on
+    the device does not depend on the number of subscribers.
+    """
+
+    def __init__(self, client, interval=1.0, max_queue=16):
+        self.client = client
+        self.interval = interval
+        self.max_queue = max_queue
+        self.snapshot = None  # the last published snapshot
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def subscribe(self, heartbeat=15.0):
+        """Returns a Subscription that receives the snapshots.
+
+        The last snapshot, if any, is received first.
+        """
+        subscription = Subscription(self, self.max_queue, heartbeat)
+        with self._lock:
+            if self.snapshot is not None:
+                subscription.put(('state', self.snapshot))
+            self._subscribers.add(subscription)
+            if self._thread is None:
+                self._stopped = threading.Event()  # one per thread
+                self._thread = threading.Thread(
+                    target=self._run, args=(self._stopped,)
+                )
+                self._thread.daemon = True
+                self._thread.start()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+            if not self._subscribers and self._thread is not None:
+                self._stopped.set()
+                self._thread = None
+
+    @property
+    def subscribers(self):
+        return len(self._subscribers)
+
+    def _publish(self, event):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscription in subscribers:
+            subscription.put(event)
+
+    def poll(self):
+        """Reads the state once and publishes it if it has changed."""
+        snapshot = self.client.snapshot()
+        previous = self.snapshot
+        if previous is not None and _same_state(previous, snapshot):
+            return False
+        self.snapshot = snapshot
+        self._publish(('state', snapshot))
+        return True
+
+    def _run(self, stopped):
+        while not stopped.is_set():
+            try:
+                self.poll()
+            except Exception as e:
+                logger.exception('Failed to poll Keiko-chan')
+                self._publish(('error', e))
+            stopped.wait(self.interval)
+
+
+class Subscription(object):
+    """Iterates the events of a StatePoller as (<kind>, <value>).
+
+    <kind> is state with a Snapshot, or error with an exception. When no
+    event arrives for <heartbeat> seconds, (heartbeat, None) is yielded
+    so that a server can find out whether its client is still there.
+    """
+
+    def __init__(self, poller, max_queue, heartbeat):
+        self.poller = poller
+        self.heartbeat = heartbeat
+        self._queue = queue.Queue(max_queue)
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.closed:
+            raise StopIteration
+        try:
+            return self._queue.get(timeout=self.heartbeat)
+        except queue.Empty:
+            return ('heartbeat', None)
+
+    next = __next__  # py2
+
+    def put(self, event):
+        # a slow subscriber only misses the oldest states
+        while True:
+            try:
+                self._queue.put_nowait(event)
+                return
+            except queue.Full:
+                try:
+                    self._queue.get_nowait()
+                except queue.Empty:
+                    pass
+
+    def close(self):
+        self.closed = True
+        self.poller.unsubscribe(self)
+
+
+def _same_state(a, b):
+    if a.state is not None and b.state is not None:
+        return a.state == b.state
+    return (a.lamps, a.buzzer, a.do, a.di, a.voice) == \
+        (b.lamps, b.buzzer, b.do, b.di, b.voice)
@@ -0,0 +1,177 @@
+"""
+Provides a watcher of the DIs that reports their edges.
+"""
+
+import logging
+import threading
+import time
+
+try:
+    import queue
+except ImportError:  # py2
+    import Queue as queue
+
+
+logger = logging.getLogger(__name__)
+
+
+class DIEvent(object):
+    """A change of the DI <term> to <state> (on or off) at <timestamp>."""
+
+    def __init__(self, term, state, timestamp):
+        self.term = term
+        self.state = state
+        self.timestamp = timestamp
+
+    @property
+    def edge(self):
+        """rising or falling."""
+        return 'rising' if self.state == 'on' else 'falling'
+
+    def __eq__(self, other):
+        return (isinstance(other, DIEvent) and
+                (self.term, self.state, self.timestamp) ==
+                (other.term, other.state, other.timestamp))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'DIEvent({0!r}, {1!r}, {2!r})'.format(
+            self.term, self.state, self.timestamp
+        )
+
+
+class EdgeDetector(object):
+    """Turns ROPS replies into debounced DIEvents.
+
+    A DI has to keep its new value for <debounce> seconds before its edge
+    is reported. The first reply only sets the initial state.
+    """
+
+    def __init__(self, debounce=0.0):
+        self.debounce = debounce
+        self.flags = None  # the debounced state
+        self._pending = {}  # {index: (value, first seen)}
+
+    @property
+    def pending(self):
+        """True while a change is waiting for the debounce period."""
+        return bool(self._pending)
+
+    def feed(self, flags, now=None):
+        """Returns the events of the ROPS reply <flags> read at <now>."""
+        if now is None:
+            now = time.time()
+        if self.flags is None:
+            self.flags = flags
+            return []
+        if flags == self.flags and not self._pending:
+            return []  # nothing changed, the common case
+        events = []
+        stable = list(self.flags)
+        for i, (old, new) in enumerate(zip(self.flags, flags)):
+            if old == new:
+                self._pending.pop(i, None)
+                continue
+            value, first_seen = self._pending.get(i, (new, now))
+            if value != new:
+                first_seen = now
+            if now - first_seen >= self.debounce:
+                self._pending.pop(i, None)
+                stable[i] = new
+                events.append(
+                    DIEvent(i + 1, 'on' if new == '1' else 'off', now)
+                )
+            else:
+                self._pending[i] = (new, first_seen)
+        self.flags = ''.join(stable)
+        return events
+
+
+class DIWatcher(object):
+    """Samples ROPS in a background thread and reports the DI edges.
+
+    Events are passed to the callbacks, and can also be iterated:
+
+        with DIWatcher(client.raw, interval=0.05) as watcher:
+            for event in watcher:
+                print(event.term, event.edge)
+
+    The polling interval grows by <backoff> times up to <max_interval>
+    while the inputs are idle, and returns to <interval> on any change.
+    """
+
+    def __init__(self, rawclient, interval=0.1, max_interval=1.0,
+                 backoff=1.5, debounce=0.0, callbacks=()):
+        self.raw = rawclient
+        self.interval = interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.detector = EdgeDetector(debounce)
+        self.callbacks = list(callbacks)
+        self.current_interval = interval
+        self._events = queue.Queue()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def __iter__(self):
+        """Yields the events until the watcher is stopped."""
+        events = self._events  # of this run, or of the next if stopped
+        while True:
+            event = events.get()
+            if event is None:
+                return
+            yield event
+
+    def add_callback(self, func):
+        """Calls func(<event>) on every edge."""
+        self.callbacks.append(func)
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._events.put(None)  # ends the iterators of this run
+        self._events = queue.Queue()  # for the next start()
+
+    def poll(self):
+        """Samples ROPS once and reports the events."""
+        events = self.detector.feed(self.raw.rops())
+        for event in events:
+            for func in self.callbacks:
+                try:
+                    func(event)
+                except Exception:
+                    logger.exception('DI callback failed')
+            self._events.put(event)
+        if events or self.detector.pending:
+            self.current_interval = self.interval
+        else:
+            self.current_interval = min(
+                self.current_interval * self.backoff, self.max_interval
+            )
+        return events
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self.poll()
+            except Exception:
+                logger.exception('Failed to read the DIs')
+                self.current_interval = self.max_interval
+            self._stopped.wait(self.current_interval)
@@ -22,8 +22,12 @@ class PyTest(TestCommand):
 install_requires = ['flask']
 
 
-if sys.version_info < (2, 7):
-    install_requires.append('argparse')
+if sys.version_info < (3, 2):
+    install_requires.append('futures')
+
+console_scripts = ['keiko = keiko.cli:main']
+if sys.version_info >= (3, 6):  # keiko.aio, see also tests/conftest.py
+    console_scripts.append('keiko-asgi = keiko.asgi:main')
 
 
 setup(
@@ -38,11 +42,10 @@ setup(
     include_package_data=True,
     zip_safe=False,
     entry_points={
-        'console_scripts': [
-            'keiko = keiko.app:main',
-        ],
+        'console_scripts': console_scripts,
     },
     install_requires=install_requires,
+    extras_require={'asgi': ['uvicorn']},
     license=open('LICENSE').read(),
     classifiers=(
         'Development Status :: 3 - Alpha',
@@ -51,7 +54,6 @@ setup(
         'Natural Language :: Japanese',
         'Programming Language :: Python',
         'Programming Language :: Python :: 2',
-        'Programming Language :: Python :: 2.6',
         'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
         'Programming Language :: Python :: 3.3'
@@ -0,0 +1,6 @@
+import sys
+
+
+collect_ignore = []
+if sys.version_info < (3, 6):  # keiko.aio and keiko.asgi, as in setup.py
+    collect_ignore += ['test_aio.py', 'test_asgi.py']
@@ -0,0 +1,275 @@
+import asyncio
+import socket
+
+import mock
+import pytest
+
+import keiko.aio
+import keiko.clients
+
+
+def run(coroutine):
+    return asyncio.get_event_loop().run_until_complete(coroutine)
+
+
+class TestAsyncClient(object):
+
+    def setup(self):
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        self.client = keiko.aio.AsyncClient('127.0.0.1')  # dummy address
+        self.client.raw._send = mock.Mock(side_effect=self.send)
+        self.message = 'OK'
+
+    def teardown(self):
+        asyncio.get_event_loop().close()
+        del self.client
+
+    async def send(self, command):
+        self.command = command
+        return self.message
+
+    def test_get_lamps_with_state(self):
+        self.message = '10100000'
+        assert run(self.client.lamps.status) == {
+            'red': 'on', 'yellow': 'off', 'green': 'on'
+        }
+        assert self.command == 'ACOP -u 1'
+
+    def test_get_lamp_with_mode(self):
+        self.message = '02300000'
+        assert run(self.client.lamps.yellow.status) == 'blink'
+        assert run(self.client.lamps.green.status) == 'quickblink'
+
+    def test_turn_on_lamp_with_wait_and_time(self):
+        run(self.client.lamps.green.on(wait=2, time=3))
+        assert self.command == 'ACOP -u 1 XX1XXXXX -w 2 -t 3'
+
+    def test_turn_off_all_lamps(self):
+        run(self.client.lamps.off())
+        assert self.command == 'ACOP -u 1 000XXXXX -w 0 -t 0'
+
+    def test_buzzer(self):
+        self.message = '00001000'
+        assert run(self.client.buzzer.status) == 'intermittent'
+        run(self.client.buzzer.on())
+        assert self.command == 'ACOP -u 1 XXX1XXXX -w 0 -t 0'
+
+    def test_do(self):
+        self.message = '10100000'
+        assert run(self.client.do.status)[3] == 'on'
+        assert run(self.client.do(2).status) == 'off'
+        assert self.command == 'ACOP -u 2'
+        run(self.client.do(2).on())
+        assert self.command == 'ACOP -u 2 X1XXXXXX -w 0 -t 0'
+
+    def test_di(self):
+        self.message = '0101'
+        assert run(self.client.di.status)[2] == 'on'
+        assert run(self.client.di(1).status) == 'off'
+        assert self.command == 'ROPS'
+
+    def test_voices(self):
+        self.message = '10911010'
+        assert run(self.client.voices.status) == {'number': 9, 'repeat': 10}
+        assert run(self.client.voices(9).status) == 'play'
+        run(self.client.voices(10).play(times=20))
+        assert self.command == 'SPOP 11012000'
+
+    def test_snapshot(self):
+        self.client.raw._send_many = mock.Mock(side_effect=self.send_many)
+        snapshot = run(self.client.snapshot())
+        assert self.commands == ['ACOP -u 1', 'ACOP -u 2', 'ROPS', 'SPOP']
+        assert snapshot.lamps['red'] == 'on'
+        assert snapshot.di[4] == 'on'
+
+    async def send_many(self, commands):
+        self.commands = commands
+        return ['10000000', '00000000', '0001', '00000000']
+
+    def test_apply(self):
+        self.client.raw._send_many = mock.Mock(side_effect=self.send_many)
+        changes = run(self.client.apply({'lamps': {'red': 'on'}}))
+        assert changes == {}
+        changes = run(self.client.apply({'lamps': {'red': 'off'}}))
+        assert changes == {'lamps': {'red': 'off'}}
+        assert self.commands == ['ACOP -u 1 0XXXXXXX -w 0 -t 0']
+
+    def test_batch(self):
+        self.client.raw._send_many = mock.Mock(side_effect=self.send_many)
+
+        async def send():
+            async with self.client.batch() as batch:
+                batch.lamps.red.on()
+        run(send())
+        assert self.commands == ['ACOP -u 1 1XXXXXXX -w 0 -t 0']
+        with pytest.raises(TypeError):
+            with self.client.batch():
+                pass
+
+    def test_batch_status(self):
+        self.message = '10100000'
+        self.client.raw._send_many = mock.Mock(side_effect=self.send_many)
+
+        async def read_and_write():
+            async with self.client.batch() as batch:
+                states = (
+                    await batch.lamps.status, await batch.lamps.red.status,
+                    await batch.buzzer.status, await batch.do(3).status
+                )
+                batch.lamps.green.on()
+                assert len(batch) == 1
+            return states
+        assert run(read_and_write()) == (
+            {'red': 'on', 'yellow': 'off', 'green': 'on'}, 'on', 'off', 'on'
+        )
+        assert self.commands == ['ACOP -u 1 XX1XXXXX -w 0 -t 0']
+
+    def test_watch_di(self):
+        replies = ['0000', '0000', '1000']
+
+        async def send(command):
+            return replies.pop(0)
+        self.client.raw._send = send
+
+        async def first_event():
+            async for event in keiko.aio.watch_di(
+                    self.client.raw, interval=0.001):
+                return event
+        event = run(first_event())
+        assert (event.term, event.edge) == (1, 'rising')
+
+    def test_error(self):
+        self.message = 'ER01'
+        with pytest.raises(keiko.clients.CommandError):
+            run(self.client.raw.help())
+
+
+class TestAsyncRawClient(object):
+
+    def setup(self):
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        self.received = []
+        self.connections = 0
+        self.server = run(asyncio.start_server(self.handle, '127.0.0.1', 0))
+        port = self.server.sockets[0].getsockname()[1]
+        self.client = keiko.aio.AsyncRawClient('127.0.0.1', port)
+
+    def teardown(self):
+        self.client.close()
+        run(asyncio.sleep(0.01))  # let the handlers see EOF
+        self.server.close()
+        run(self.server.wait_closed())
+        asyncio.get_event_loop().close()
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        while True:
+            try:
+                command = await reader.readuntil(b'\r')
+            except asyncio.IncompleteReadError:
+                break
+            self.received.append(command)
+            if command == b'HANG\r':
+                continue
+            reply = b'ER01\r' if command == b'FOO\r' else b'00000000\r'
+            for byte in reply:  # split into small segments
+                writer.write(bytes([byte]))
+                await writer.drain()
+        writer.close()
+
+    def test_command(self):
+        assert run(self.client.acop(unit=2)) == '00000000'
+        assert self.received == [b'ACOP -u 2\r']
+
+    def test_reuse_connection(self):
+        run(self.client.vern())
+        run(self.client.vern())
+        assert self.connections == 1
+
+    def test_pipeline(self):
+        pipe = self.client.pipeline().acop().rops().spop()
+        assert run(pipe.execute()) == ['00000000'] * 3
+        assert self.connections == 1
+
+    def test_execute_many_with_error(self):
+        results = run(self.client.execute_many(
+            ['FOO', 'VERN'], raise_on_error=False
+        ))
+        assert isinstance(results[0], keiko.clients.CommandError)
+        assert results[1] == '00000000'
+
+    def test_timeout(self):
+        self.client.pool.options['timeout'] = 0.05
+        with pytest.raises(socket.timeout):
+            run(self.client._execute('HANG'))
+        assert self.received == [b'HANG\r']  # writes are not retried
+
+    def test_deadline(self):
+        self.client.deadline = 0.05
+        with pytest.raises(keiko.clients.DeadlineExceeded):
+            run(self.client._execute('HANG'))
+
+
+class TestAsyncSharedReads(object):
+
+    def setup(self):
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        self.reads = keiko.aio.AsyncSharedReads(stale=10, patience=0.01)
+        self.calls = 0
+
+    def teardown(self):
+        asyncio.get_event_loop().close()
+
+    async def slow_read(self, value, delay=0.0):
+        self.calls += 1
+        await asyncio.sleep(delay)
+        return value
+
+    def test_collapse(self):
+        results = run(asyncio.gather(*[
+            self.reads.read('lamps', lambda: self.slow_read('10000000'))
+            for _ in range(5)
+        ]))
+        assert results == [('10000000', None)] * 5
+        assert self.calls == 1
+
+    def test_stale_while_revalidate(self):
+        run(self.reads.read('lamps', lambda: self.slow_read('old')))
+        value, age = run(self.reads.read(
+            'lamps', lambda: self.slow_read('new', 0.05)
+        ))
+        assert value == 'old'
+        assert age is not None
+        run(asyncio.sleep(0.06))  # the read goes on
+        failed = mock.Mock(side_effect=IOError)
+        assert run(self.reads.read('lamps', failed))[0] == 'new'
+
+    def test_cancel_one_caller(self):
+        async def cancel_one():
+            reads = [
+                asyncio.ensure_future(self.reads.read(
+                    'lamps', lambda: self.slow_read('10000000', 0.02)
+                ))
+                for _ in range(3)
+            ]
+            await asyncio.sleep(0)
+            reads[0].cancel()
+            return await asyncio.gather(*reads, return_exceptions=True)
+        results = run(cancel_one())
+        assert isinstance(results[0], asyncio.CancelledError)
+        assert results[1:] == [('10000000', None)] * 2
+        assert self.calls == 1
+
+    def test_cancel_all_callers(self):
+        async def cancel_all():
+            read = asyncio.ensure_future(self.reads.read(
+                'lamps', lambda: self.slow_read('10000000', 1)
+            ))
+            await asyncio.sleep(0)
+            task = self.reads._calls['lamps']
+            read.cancel()
+            await asyncio.sleep(0)
+            return task
+        task = run(cancel_all())
+        assert task.cancelled()
+        assert self.reads._calls == {}
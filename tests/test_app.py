@@ -1,8 +1,18 @@
+import json
+import os
+import shutil
+import socket
 import sys
+import tempfile
+import time
 
+import flask
 import mock
 
 import keiko.app
+import keiko.clients
+import keiko.fleet
+import keiko.journal
 
 
 class TestApp(object):
@@ -16,9 +26,39 @@ class TestApp(object):
     def test_index(self):
         assert self.app.get('/').status_code == 200
 
+    def test_get_metrics(self):
+        self.app.get('/lamps')
+        response = self.app.get('/metrics')
+        assert response.status_code == 200
+        assert b'route="/lamps"' in response.data
+
+    def test_get_snapshot(self):
+        assert self.app.get('/snapshot').status_code == 200
+
+    def test_get_stream(self):
+        keiko.app.app.keiko.snapshot.return_value = keiko.clients.Snapshot(
+            0, {'red': 'on'}, 'off', {}, {}, 'stop'
+        )
+        response = self.app.get('/stream')
+        assert response.status_code == 200
+        assert response.mimetype == 'text/event-stream'
+        chunk = next(response.response)
+        assert chunk.startswith(b'event: state\ndata: {')
+        response.close()
+
     def test_get_all_lamps(self):
         assert self.app.get('/lamps').status_code == 200
 
+    def test_get_stale_lamps(self):
+        self.app.get('/lamps')
+        type(keiko.app.app.keiko.lamps).status = mock.PropertyMock(
+            side_effect=IOError()
+        )
+        response = self.app.get('/lamps')
+        assert response.status_code == 200
+        assert response.headers['Age'] == '0'
+        assert 'Age' not in self.app.get('/buzzer').headers
+
     def test_get_lamp(self):
         assert self.app.get('/lamps/red').status_code == 200
         assert self.app.get('/lamps/yellow').status_code == 200
@@ -93,6 +133,30 @@ class TestApp(object):
     def test_set_all_voices_stop(self):
         assert self.app.get('/voices/stop').status_code == 200
 
+    def test_post_batch(self):
+        client = keiko.clients.Client('127.0.0.1')
+        client.raw.execute_many = mock.Mock(return_value=['OK', 'OK'])
+        keiko.app.app.keiko = client
+        response = self.app.post('/batch', json=[
+            {'path': '/lamps/red/on'},
+            {'path': '/buzzer/intermittent'},
+            {'path': '/voices/3/play', 'times': 2}
+        ])
+        assert response.status_code == 200
+        args, kwargs = client.raw.execute_many.call_args
+        assert args[0] == ['ACOP -u 1 1XXX1XXX -w 0 -t 0', 'SPOP 10310200']
+
+    def test_post_invalid_batch(self):
+        client = keiko.clients.Client('127.0.0.1')
+        client.raw.execute_many = mock.Mock()
+        keiko.app.app.keiko = client
+        assert self.app.post('/batch', json=[
+            {'path': '/lamps/red/on'}, {'path': '/lamps/blue/on'}
+        ]).status_code == 400
+        assert self.app.post('/batch', json={}).status_code == 400
+        assert self.app.post('/batch', data='[').status_code == 400
+        assert not client.raw.execute_many.called
+
     def test_get_contract(self):
         assert self.app.get('/contract').status_code == 200
 
@@ -129,3 +193,161 @@ class TestMain(object):
             assert keiko.app.app.debug is False
             kwargs = m.call_args[1]
             assert kwargs == {'host': '127.0.0.1', 'port': 8080}
+
+
+class TestDevices(object):
+
+    def setup(self):
+        keiko.app.jsonify = flask.jsonify
+        keiko.app.app.keiko = None
+        self.fleet = keiko.fleet.FleetClient(
+            {'a': '127.0.0.1', 'b': '127.0.0.2'}
+        )
+        keiko.app.app.fleet = self.fleet
+        self.commands = []
+        for key, client in self.fleet.clients.items():
+            client.raw._send_many = mock.Mock(
+                side_effect=lambda commands, deadline=None, key=key: [
+                    self.send(key, command) for command in commands
+                ]
+            )
+        self.app = keiko.app.app.test_client()
+
+    def teardown(self):
+        self.fleet.close()
+        keiko.app.app.fleet = None
+
+    def send(self, key, command):
+        self.commands.append((key, command))
+        if key == 'b' and command.startswith('RDMN'):
+            raise socket.error('No route to host')
+        return '10000000' if command.startswith('ACOP -u 1') else 'OK'
+
+    def test_get_devices(self):
+        assert self.app.get('/devices').get_json() == {'devices': ['a', 'b']}
+
+    def test_device(self):
+        response = self.app.get('/devices/a/lamps/red')
+        assert response.get_json() == {'lamps': {'red': 'on'}}
+        assert self.app.get('/devices/b/do/1/on').status_code == 200
+        assert self.commands == [
+            ('a', 'ACOP -u 1'), ('b', 'ACOP -u 2 1XXXXXXX -w 0 -t 0')
+        ]
+
+    def test_unknown_device(self):
+        assert self.app.get('/devices/c/lamps').status_code == 404
+        keiko.app.app.fleet = None
+        assert self.app.get('/devices/a/lamps').status_code == 404
+
+    def test_fan_out(self):
+        response = self.app.get('/devices/*/lamps/yellow/blink')
+        assert response.status_code == 200
+        assert response.get_json() == {
+            'devices': {
+                'a': {'result': 'success'}, 'b': {'result': 'success'}
+            },
+            'errors': {}
+        }
+        assert sorted(key for key, command in self.commands) == ['a', 'b']
+
+    def test_fan_out_errors(self):
+        response = self.app.get('/devices/*/model')
+        data = response.get_json()
+        assert response.status_code == 200
+        assert data['devices'] == {'a': {'model': 'OK'}}
+        assert data['errors']['b']['status'] == 502
+        assert self.app.get('/devices/*/lamps/blue').status_code == 400
+
+    def test_fan_out_without_get_json(self):
+        # Werkzeug<2, the only one on Python 2.7, has no Response.get_json
+        with mock.patch('werkzeug.wrappers.Response.get_json',
+                        side_effect=AttributeError):
+            response = self.app.get('/devices/*/model')
+            assert self.app.get('/devices/*/lamps/blue').status_code == 400
+        data = json.loads(response.get_data(as_text=True))
+        assert data['devices'] == {'a': {'model': 'OK'}}
+
+    def test_fan_out_batch(self):
+        response = self.app.post('/devices/*/batch', json=[
+            {'path': '/lamps/red/on'}, {'path': '/do/2/on'}
+        ])
+        assert response.status_code == 200
+        assert len(self.commands) == 4
+
+    def test_fan_out_batch_to_many_devices(self):
+        self.fleet.close()
+        self.fleet = keiko.fleet.FleetClient(
+            dict((str(i), '127.0.0.{0}'.format(i)) for i in range(1, 9)),
+            max_workers=3
+        )
+        keiko.app.app.fleet = self.fleet
+        for client in self.fleet.clients.values():
+            client.raw._send_many = mock.Mock(
+                side_effect=lambda commands, deadline=None: ['OK'] * len(
+                    commands
+                )
+            )
+
+        def slow_dict(*args, **kwargs):
+            time.sleep(0.01)  # lets the other workers run before the copy
+            return dict(*args, **kwargs)
+        with mock.patch('keiko.app.dict', side_effect=slow_dict, create=True):
+            response = self.app.post('/devices/*/batch', json=[
+                {'path': '/lamps/red/on'}, {'path': '/do/2/on'}
+            ])
+        assert response.status_code == 200
+        assert response.get_json()['errors'] == {}
+        assert len(response.get_json()['devices']) == 8
+
+    def test_no_fan_out_stream(self):
+        assert self.app.get('/devices/*/stream').status_code == 404
+
+
+class TestHistory(object):
+
+    def setup(self):
+        keiko.app.jsonify = flask.jsonify
+        self.directory = tempfile.mkdtemp()
+        self.journal = keiko.journal.Journal(
+            os.path.join(self.directory, 'keiko.journal')
+        )
+        keiko.app.app.journal = self.journal
+        self.fleet = keiko.fleet.FleetClient(
+            {'a': '127.0.0.1', 'b': '127.0.0.2'}, journal=self.journal
+        )
+        keiko.app.app.fleet = self.fleet
+        keiko.app.app.keiko = self.fleet.clients['a']
+        for client in self.fleet.clients.values():
+            client.raw._send_many = mock.Mock(return_value=['10000000'])
+        self.app = keiko.app.app.test_client()
+
+    def teardown(self):
+        self.fleet.close()
+        keiko.app.app.fleet = None
+        keiko.app.app.journal = None
+        self.journal.close()
+        shutil.rmtree(self.directory)
+
+    def test_get_history(self):
+        self.app.get('/devices/a/lamps')
+        self.app.get('/devices/b/lamps')
+        history = self.app.get('/history').get_json()['history']
+        assert [entry['device'] for entry in history] == [
+            '127.0.0.1:60000', '127.0.0.2:60000'
+        ]
+        assert history[0]['lamps']['red'] == 'on'
+        response = self.app.get('/history?device=127.0.0.2:60000&limit=5')
+        assert len(response.get_json()['history']) == 1
+        start = history[1]['timestamp'] + 1
+        response = self.app.get('/history?start={0}'.format(start))
+        assert response.get_json() == {'history': []}
+        assert self.app.get('/history?end=yesterday').status_code == 400
+
+    def test_get_device_history(self):
+        self.app.get('/devices/*/lamps')
+        history = self.app.get('/devices/b/history').get_json()['history']
+        assert [entry['device'] for entry in history] == ['127.0.0.2:60000']
+
+    def test_no_journal(self):
+        keiko.app.app.journal = None
+        assert self.app.get('/history').status_code == 404
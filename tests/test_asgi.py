@@ -0,0 +1,200 @@
+import asyncio
+import json
+
+import mock
+
+import keiko.aio
+import keiko.asgi
+
+
+def run(coroutine):
+    return asyncio.get_event_loop().run_until_complete(coroutine)
+
+
+class TestApp(object):
+
+    def setup(self):
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        client = keiko.aio.AsyncClient('127.0.0.1')  # dummy address
+        client.raw._send = mock.Mock(side_effect=self.send)
+        client.raw._send_many = mock.Mock(side_effect=self.send_many)
+        self.app = keiko.asgi.App(client, patience=0.05)
+        self.commands = []
+        self.message = 'OK'
+
+    def teardown(self):
+        asyncio.get_event_loop().close()
+
+    async def send(self, command):
+        self.commands.append(command)
+        if isinstance(self.message, Exception):
+            raise self.message
+        return self.message
+
+    async def send_many(self, commands):
+        return [await self.send(command) for command in commands]
+
+    def request(self, method, path, query=b'', body=b''):
+        messages = []
+        chunks = [
+            {'type': 'http.request', 'body': body[:1], 'more_body': True},
+            {'type': 'http.request', 'body': body[1:]}
+        ]
+
+        async def receive():
+            return chunks.pop(0)
+
+        async def send(message):
+            messages.append(message)
+        scope = {
+            'type': 'http', 'method': method, 'path': path,
+            'query_string': query
+        }
+        run(self.app(scope, receive, send))
+        start, body = messages
+        return start['status'], dict(start['headers']), body['body']
+
+    def get(self, path, query=b''):
+        return self.request('GET', path, query)
+
+    def test_index(self):
+        assert self.get('/')[0] == 200
+
+    def test_get_lamps(self):
+        self.message = '12000000'
+        status, headers, body = self.get('/lamps')
+        assert status == 200
+        assert headers[b'content-type'] == b'application/json'
+        assert json.loads(body.decode('utf-8')) == {
+            'lamps': {'red': 'on', 'yellow': 'blink', 'green': 'off'}
+        }
+        assert json.loads(self.get('/lamps/red')[2].decode('utf-8')) == {
+            'lamps': {'red': 'on'}
+        }
+
+    def test_set_lamp(self):
+        assert self.get('/lamps/green/on', b'wait=2&time=3')[0] == 200
+        assert self.commands[-1] == 'ACOP -u 1 XX1XXXXX -w 2 -t 3'
+        assert self.get('/lamps/off')[0] == 200
+        assert self.commands[-1] == 'ACOP -u 1 000XXXXX -w 0 -t 0'
+        assert self.get('/lamps/blue/on')[0] == 400
+        assert self.get('/lamps/red/light')[0] == 400
+
+    def test_buzzer_do_di_and_voices(self):
+        assert self.get('/buzzer/intermittent')[0] == 200
+        assert self.get('/do/1/on')[0] == 200
+        assert self.get('/do/5/on')[0] == 400
+        assert self.get('/voices/3/play', b'times=2')[0] == 200
+        assert self.commands[-1] == 'SPOP 10310200'
+        assert self.get('/voices/stop')[0] == 200
+        self.message = '0101'
+        assert json.loads(self.get('/di/2')[2].decode('utf-8')) == {
+            'di': {'2': 'on'}
+        }
+
+    def test_info(self):
+        self.message = '1.00'
+        assert json.loads(self.get('/version')[2].decode('utf-8')) == {
+            'version': '1.00'
+        }
+        assert self.get('/contract')[0] == 200
+
+    def test_post_batch(self):
+        body = json.dumps([
+            {'path': '/lamps/red/on'},
+            {'path': '/do/1/on'},
+            {'path': '/voices/3/play', 'times': 2}
+        ]).encode('utf-8')
+        self.message = 'ER03'
+        status, headers, body = self.request('POST', '/batch', body=body)
+        assert status == 200
+        results = json.loads(body.decode('utf-8'))['results']
+        assert [result['code'] for result in results] == ['ER03'] * 3
+        assert self.commands == [
+            'ACOP -u 1 1XXXXXXX -w 0 -t 0',
+            'ACOP -u 2 1XXXXXXX -w 0 -t 0',
+            'SPOP 10310200'
+        ]
+
+    def test_post_invalid_batch(self):
+        body = json.dumps([{'path': '/lamps/blue/on'}]).encode('utf-8')
+        status, headers, body = self.request('POST', '/batch', body=body)
+        assert status == 400
+        assert json.loads(body.decode('utf-8'))['errors'][0]['index'] == 0
+        assert self.request('POST', '/batch', body=b'[')[0] == 400
+        assert self.get('/batch')[0] == 405
+        assert self.request('POST', '/lamps')[0] == 405
+        assert self.commands == []
+
+    def test_not_found(self):
+        assert self.get('/foo')[0] == 404
+        assert self.get('/lamps/red/on/now')[0] == 404
+
+    def test_error(self):
+        self.message = IOError()
+        assert self.get('/model')[0] == 500
+
+    def test_shared_reads(self):
+        self.message = '10000000'
+
+        async def get_all():
+            scope = {'type': 'http', 'method': 'GET', 'path': '/lamps'}
+
+            async def send(message):
+                pass
+            await asyncio.gather(*[
+                self.app(scope, None, send) for _ in range(10)
+            ])
+        run(get_all())
+        assert self.commands == ['ACOP -u 1']
+
+    def test_stale(self):
+        self.message = '10000000'
+        self.get('/lamps')
+        self.message = IOError()
+        status, headers, body = self.get('/lamps')
+        assert status == 200
+        assert headers[b'age'] == b'0'
+        assert b'"red": "on"' in body
+
+    def test_metrics(self):
+        self.get('/')
+        status, headers, body = self.get('/metrics')
+        assert b'route="/"' in body
+
+    async def snapshot(self, commands):
+        self.commands.extend(commands)
+        return ['10000000', '00000000', '0001', '00000000']
+
+    def test_stream(self):
+        self.app.keiko.raw._send_many = mock.Mock(side_effect=self.snapshot)
+        disconnect = asyncio.Event()
+        messages = []
+
+        async def receive():
+            await disconnect.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            messages.append(message)
+            if message.get('more_body'):
+                disconnect.set()
+        scope = {'type': 'http', 'method': 'GET', 'path': '/stream'}
+        run(asyncio.gather(*[self.app(scope, receive, send)
+                             for _ in range(2)]))
+        assert self.commands == ['ACOP -u 1', 'ACOP -u 2', 'ROPS', 'SPOP']
+        starts = [m for m in messages if m['type'] == 'http.response.start']
+        bodies = [m['body'] for m in messages if m not in starts]
+        assert [start['status'] for start in starts] == [200, 200]
+        headers = dict(starts[0]['headers'])
+        assert headers[b'content-type'] == b'text/event-stream'
+        assert b'content-length' not in headers
+        assert len(bodies) == 2
+        event = bodies[0].decode('utf-8')
+        assert event.startswith('event: state\ndata: ')
+        assert json.loads(event.split('data: ')[1])['lamps']['red'] == 'on'
+        assert self.app.poller.subscribers == 0
+        run(asyncio.sleep(0))  # the poller stops
+        status, headers, body = self.request('HEAD', '/stream')
+        assert (status, body) == (200, b'')
+        assert self.app.poller.subscribers == 0
@@ -0,0 +1,204 @@
+import threading
+import time
+
+import mock
+import pytest
+
+import keiko.cache
+import keiko.clients
+
+
+class TestStateCache(object):
+
+    def setup(self):
+        self.cache = keiko.cache.StateCache(ttl=10)
+
+    def test_put_and_get(self):
+        self.cache.put('ACOP -u 1', '10000000')
+        assert self.cache.get('ACOP -u 1') == '10000000'
+        assert self.cache.get('ACOP -u 2') is None
+
+    def test_not_cacheable(self):
+        self.cache.put('ROPS', '0000')
+        assert self.cache.get('ROPS') is None
+
+    def test_expire(self):
+        self.cache.ttl = 0.01
+        self.cache.put('SPOP', '00000000')
+        time.sleep(0.02)
+        assert self.cache.get('SPOP') is None
+
+    def test_merge_write(self):
+        self.cache.put('ACOP -u 1', '10000000')
+        self.cache.observe('ACOP -u 1 X2X1XXXX -w 0 -t 0', 'OK')
+        assert self.cache.get('ACOP -u 1') == '12010000'
+
+    def test_write_reply(self):
+        self.cache.observe('ACOP -u 2 1XXXXXXX -w 0 -t 0', '10100000')
+        assert self.cache.get('ACOP -u 2') == '10100000'
+
+    def test_invalidate_on_timed_write(self):
+        self.cache.put('ACOP -u 1', '10000000')
+        self.cache.observe('ACOP -u 1 X1XXXXXX -w 2 -t 0', 'OK')
+        assert self.cache.get('ACOP -u 1') is None
+        self.cache.put('ACOP -u 1', '10000000')
+        self.cache.observe('ACOP -u 1 X1XXXXXX -w 0 -t 3', 'OK')
+        assert self.cache.get('ACOP -u 1') is None
+
+    def test_invalidate_on_failed_write(self):
+        self.cache.put('ACOP -u 1', '10000000')
+        self.cache.observe('ACOP -u 1 X1XXXXXX -w 0 -t 0', None)
+        assert self.cache.get('ACOP -u 1') is None
+
+    def test_invalidate_on_spop_and_alof(self):
+        self.cache.put('SPOP', '00000000')
+        self.cache.put('ACOP -u 1', '10000000')
+        self.cache.observe('SPOP 10100000', 'OK')
+        assert self.cache.get('SPOP') is None
+        self.cache.observe('ALOF', 'OK')
+        assert self.cache.get('ACOP -u 1') is None
+        self.cache.put('ACOP -u 2', '10000000')
+        self.cache.observe('RYOT -n 1 TurnOff -w 0 -t 0', 'OK')
+        assert self.cache.get('ACOP -u 2') is None
+
+    def test_read_from_before_write(self):
+        generation = self.cache.generation('ACOP -u 1')
+        self.cache.observe('ACOP -u 1 1XXXXXXX -w 0 -t 0', '10000000')
+        self.cache.observe('ACOP -u 1', '00000000', generation)
+        assert self.cache.get('ACOP -u 1') == '10000000'
+        self.cache.observe('ACOP -u 1', '00000000',
+                           self.cache.generation('ACOP -u 1'))
+        assert self.cache.get('ACOP -u 1') == '00000000'
+
+
+class TestCachedClient(object):
+
+    def setup(self):
+        self.client = keiko.clients.Client('127.0.0.1', cache_ttl=10)
+        self.client.raw._send = mock.Mock(return_value='10001000')
+
+    def test_status_reads_once(self):
+        assert self.client.lamps.red.status == 'on'
+        assert self.client.lamps.yellow.status == 'off'
+        assert self.client.lamps.status['green'] == 'off'
+        assert self.client.buzzer.status == 'intermittent'
+        assert self.client.raw._send.call_count == 1
+
+    def test_write_through(self):
+        self.client.lamps.status
+        self.client.raw._send.return_value = 'OK'
+        self.client.lamps.yellow.blink()
+        assert self.client.lamps.yellow.status == 'blink'
+        assert self.client.lamps.red.status == 'on'
+        assert self.client.raw._send.call_count == 2
+
+    def test_slow_read_and_write(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def send(command, deadline=None):
+            if command == 'ACOP -u 1':
+                started.set()
+                release.wait(1)
+                return '00000000'  # the state before the write
+            return '10000000'
+        self.client.raw._send = mock.Mock(side_effect=send)
+        reader = threading.Thread(target=lambda: self.client.lamps.status)
+        reader.start()
+        assert started.wait(1)
+        self.client.lamps.red.on()
+        release.set()
+        reader.join()
+        assert self.client.lamps.red.status == 'on'
+        assert self.client.raw._send.call_count == 2
+
+    def test_di_not_cached(self):
+        self.client.raw._send.return_value = '0101'
+        self.client.di.status
+        self.client.di.status
+        assert self.client.raw._send.call_count == 2
+
+    def test_no_cache_by_default(self):
+        client = keiko.clients.Client('127.0.0.1')
+        assert client.cache is None
+        client.raw._send = mock.Mock(return_value='10000000')
+        client.lamps.status
+        client.lamps.status
+        assert client.raw._send.call_count == 2
+
+
+class TestSharedReads(object):
+
+    def setup(self):
+        self.reads = keiko.cache.SharedReads(stale=10, patience=0.05)
+
+    def wait_idle(self):
+        # until the calls that go on in the background are done
+        for _ in range(100):
+            if not self.reads._calls:
+                return
+            time.sleep(0.01)
+
+    def test_collapse(self):
+        release = threading.Event()
+        func = mock.Mock(side_effect=lambda: release.wait() and '10000000')
+        results = []
+
+        def read():
+            results.append(self.reads.read('lamps', func))
+        threads = [threading.Thread(target=read) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.02)
+        release.set()
+        for thread in threads:
+            thread.join()
+        assert func.call_count == 1
+        assert results == [('10000000', None)] * 8
+
+    def test_keys(self):
+        assert self.reads.read('lamps', lambda: 1) == (1, None)
+        assert self.reads.read('buzzer', lambda: 2) == (2, None)
+
+    def test_stale_on_error(self):
+        self.reads.read('lamps', lambda: '10000000')
+        value, age = self.reads.read('lamps', mock.Mock(side_effect=IOError))
+        assert value == '10000000'
+        assert 0 <= age < 1
+
+    def test_raise_without_stale(self):
+        with pytest.raises(IOError):
+            self.reads.read('lamps', mock.Mock(side_effect=IOError))
+        self.reads.read('lamps', lambda: '10000000')
+        self.reads.stale = 0
+        with pytest.raises(IOError):
+            self.reads.read('lamps', mock.Mock(side_effect=IOError))
+
+    def test_stale_on_slow_read(self):
+        self.reads.read('lamps', lambda: 'old')
+        release = threading.Event()
+        thread = threading.Thread(target=self.reads.read, args=(
+            'lamps', lambda: release.wait() and 'new'
+        ))
+        thread.start()
+        time.sleep(0.01)
+        value, age = self.reads.read('lamps', lambda: 'unused')
+        assert value == 'old'
+        assert age is not None
+        release.set()
+        thread.join()
+        self.wait_idle()
+        assert self.reads.read('lamps', lambda: 'newer') == ('newer', None)
+
+    def test_stale_for_single_caller(self):
+        self.reads.read('lamps', lambda: 'old')
+        release = threading.Event()
+        value, age = self.reads.read(
+            'lamps', lambda: release.wait(1) and 'new'
+        )
+        assert value == 'old'
+        assert age is not None
+        release.set()  # the call goes on and refreshes the value
+        self.wait_idle()
+        assert self.reads.read('lamps', mock.Mock(side_effect=IOError))[0] \
+            == 'new'
@@ -0,0 +1,92 @@
+import io
+import json
+import subprocess
+import sys
+
+import mock
+import pytest
+
+import keiko.cli
+import keiko.clients
+
+
+class TestCLI(object):
+
+    def setup(self):
+        self.client = keiko.clients.Client('127.0.0.1', metrics=None)
+        self.commands = []
+        self.client.raw._send_many = mock.Mock(side_effect=self.send_many)
+
+    def send_many(self, commands, deadline=None):
+        self.commands.extend(commands)
+        return [
+            '10000000' if command == 'ACOP -u 1' else 'OK'
+            for command in commands
+        ]
+
+    def test_write(self):
+        result = keiko.cli.run(self.client, ['lamps', 'red', 'on', 'time=5'])
+        assert result == {'result': 'success'}
+        assert self.commands == ['ACOP -u 1 1XXXXXXX -w 0 -t 5']
+        keiko.cli.run(self.client, ['voices', '3', 'play', 'times=2'])
+        assert self.commands[-1] == 'SPOP 10310200'
+
+    def test_read(self):
+        assert keiko.cli.run(self.client, ['lamps', 'red']) == {
+            'lamps': {'red': 'on'}
+        }
+        assert keiko.cli.run(self.client, ['buzzer']) == {'buzzer': 'off'}
+        assert keiko.cli.run(self.client, ['raw', 'ACOP', '-u', '1']) == {
+            'reply': '10000000'
+        }
+
+    def test_invalid(self):
+        for words in [['lamps', 'blue', 'on'], ['lamps', 'red', 'on', 'w=x'],
+                      ['lamps', 'wait=2'], ['alarm'], ['raw']]:
+            with pytest.raises(ValueError):
+                keiko.cli.run(self.client, words)
+        assert self.commands == []
+
+    def test_stream(self):
+        lines = ['lamps red on\n', '\n', '# comment\n', 'lamps purple\n',
+                 'lamps\n']
+        output = io.StringIO() if sys.version_info[0] > 2 else io.BytesIO()
+        failed = keiko.cli.stream(self.client, lines, output)
+        records = [json.loads(line) for line in output.getvalue().split('\n')
+                   if line]
+        assert failed == 1
+        assert [record['command'] for record in records] == [
+            'lamps red on', 'lamps purple', 'lamps'
+        ]
+        assert records[0]['result'] == {'result': 'success'}
+        assert 'error' in records[1]
+        assert records[2]['result']['lamps']['red'] == 'on'
+        assert all(record['seconds'] >= 0 for record in records)
+
+    def test_serve_without_command(self):
+        with mock.patch('keiko.app.main') as serve:
+            keiko.cli.main(['192.168.1.2', '--port', '60001'])
+            serve.assert_called_once_with(['192.168.1.2', '--port', '60001'])
+            keiko.cli.main(['192.168.1.2', '--journal', 'keiko.journal'])
+            assert serve.call_count == 2
+
+    def test_main_raw_with_options(self):
+        client = mock.Mock()
+        client.raw.execute_many.return_value = ['0']
+        output = io.StringIO() if sys.version_info[0] > 2 else io.BytesIO()
+        with mock.patch('keiko.app.main') as serve, \
+                mock.patch('keiko.cli.Client', return_value=client), \
+                mock.patch('sys.stdout', output):
+            keiko.cli.main(['--port', '60001', '10.0.0.5', 'raw', 'RYIN',
+                            '-n', '1'])
+            keiko.cli.main(['10.0.0.5', 'raw', 'ACOP', '-u', '1'])
+            assert not serve.called
+        assert client.raw.execute_many.call_args_list == [
+            mock.call(['RYIN -n 1']), mock.call(['ACOP -u 1'])
+        ]
+        assert output.getvalue() == '{"reply": "0"}\n' * 2
+
+    def test_no_flask(self):
+        code = 'import sys, keiko.cli; print("flask" in sys.modules)'
+        output = subprocess.check_output([sys.executable, '-c', code])
+        assert output.strip() == b'False'
@@ -1,4 +1,6 @@
+import socket
 import sys
+import threading
 
 import mock
 import pytest
@@ -217,6 +219,214 @@ class TestClient(object):
         assert self.get_sent_command() == 'SPOP 00000000'
 
 
+class TestSnapshot(object):
+
+    def setup(self):
+        self.client = keiko.clients.Client('127.0.0.1')
+        self.client.raw.execute_many = mock.MagicMock(
+            return_value=['10010000', '01000000', '0011', '10310100']
+        )
+
+    def test_snapshot(self):
+        snapshot = self.client.snapshot()
+        self.client.raw.execute_many.assert_called_once_with(
+            ['ACOP -u 1', 'ACOP -u 2', 'ROPS', 'SPOP']
+        )
+        assert snapshot.lamps == {'red': 'on', 'yellow': 'off', 'green': 'off'}
+        assert snapshot.buzzer == 'continuous'
+        assert snapshot.do == {1: 'off', 2: 'on', 3: 'off', 4: 'off'}
+        assert snapshot.di == {1: 'off', 2: 'off', 3: 'on', 4: 'on'}
+        assert snapshot.voice == {'number': 3, 'repeat': 1}
+        assert snapshot.timestamp > 0
+        assert snapshot.to_dict()['buzzer'] == 'continuous'
+        assert snapshot.state.do == snapshot.do
+
+    def test_snapshot_with_cache(self):
+        client = keiko.clients.Client('127.0.0.1', cache_ttl=10)
+        client.cache.put('ACOP -u 1', '10010000')
+        client.cache.put('SPOP', '00000000')
+        client.raw.execute_many = mock.MagicMock(
+            return_value=['01000000', '0011']
+        )
+        snapshot = client.snapshot()
+        client.raw.execute_many.assert_called_once_with(['ACOP -u 2', 'ROPS'])
+        assert snapshot.voice == 'stop'
+
+
+class TestBatch(object):
+
+    def setup(self):
+        self.client = keiko.clients.Client('127.0.0.1')
+        self.client.raw.execute_many = mock.MagicMock(return_value=['OK'])
+
+    def get_sent_commands(self):
+        args, kwargs = self.client.raw.execute_many.call_args
+        return args[0]
+
+    def test_merge(self):
+        with self.client.batch() as batch:
+            batch.lamps.red.on()
+            batch.lamps.yellow.blink()
+            batch.buzzer.intermittent()
+            batch.do(1).on()
+            batch.do(3).off()
+            assert len(batch) == 2
+        assert self.get_sent_commands() == [
+            'ACOP -u 1 12XX1XXX -w 0 -t 0',
+            'ACOP -u 2 1X0XXXXX -w 0 -t 0'
+        ]
+        assert self.client.raw.execute_many.call_count == 1
+
+    def test_override(self):
+        with self.client.batch() as batch:
+            batch.lamps.off()
+            batch.lamps.green.quickblink()
+        assert self.get_sent_commands() == ['ACOP -u 1 003XXXXX -w 0 -t 0']
+
+    def test_shared_wait_and_time(self):
+        with self.client.batch(wait=2, time=5) as batch:
+            batch.lamps.red.on()
+            batch.buzzer.on()
+            batch.lamps.green.on(wait=1)
+            batch.voices(3).play()
+        assert self.get_sent_commands() == [
+            'ACOP -u 1 1XX1XXXX -w 2 -t 5',
+            'ACOP -u 1 XX1XXXXX -w 1 -t 5',
+            'SPOP 10310100'
+        ]
+
+    def test_reads_pass_through(self):
+        batch = self.client.batch()
+        recorder = batch.lamps.raw
+        self.client.raw._execute = mock.Mock(return_value='0101')
+        assert keiko.clients.DIHolder(recorder).status == {
+            1: 'off', 2: 'on', 3: 'off', 4: 'on'
+        }
+        self.client.raw._execute.assert_called_once_with('ROPS')
+        self.client.raw._execute.return_value = '10000000'
+        assert batch.lamps.red.status == 'on'
+        assert len(batch) == 0
+
+    def test_discard_on_error(self):
+        with pytest.raises(ValueError):
+            with self.client.batch() as batch:
+                batch.lamps.red.on()
+                raise ValueError()
+        assert not self.client.raw.execute_many.called
+
+    def test_send(self):
+        batch = self.client.batch()
+        batch.do(2).on()
+        assert batch.send() == ['OK']
+        assert len(batch) == 0
+
+    def test_apply(self):
+        batch = self.client.batch()
+        assert batch.apply({'path': '/lamps/red/on'}) == 0
+        assert batch.apply({'path': 'buzzer/intermittent', 'time': 3}) == 1
+        assert batch.apply({'path': '/do/2/on'}) == 2
+        assert batch.apply({'path': '/lamps/yellow/blink'}) == 0
+        assert batch.apply({'path': '/voices/3/play', 'times': 2}) == -1
+        assert batch.apply({'path': '/lamps/off'}) == 0
+        batch.send()
+        assert self.get_sent_commands() == [
+            'ACOP -u 1 000XXXXX -w 0 -t 0',
+            'ACOP -u 1 XXXX1XXX -w 0 -t 3',
+            'ACOP -u 2 X1XXXXXX -w 0 -t 0',
+            'SPOP 10310200'
+        ]
+
+    def test_apply_invalid(self):
+        batch = self.client.batch()
+        for operation in [
+            'lamps/red/on',
+            {},
+            {'path': '/lamps/blue/on'},
+            {'path': '/lamps/red/light'},
+            {'path': '/buzzer/beep'},
+            {'path': '/do/5/on'},
+            {'path': '/do/1/blink'},
+            {'path': '/voices/21/play'},
+            {'path': '/di/1/on'},
+            {'path': '/lamps/red/on', 'wait': -1},
+            {'path': '/lamps/red/on', 'time': '1'},
+            {'path': '/lamps/red/on', 'color': 'red'}
+        ]:
+            with pytest.raises(ValueError):
+                batch.apply(operation)
+        assert len(batch) == 0
+
+    def test_send_without_raise(self):
+        error = keiko.clients.CommandError('ER03')
+        self.client.raw.execute_many.return_value = ['OK', error]
+        batch = self.client.batch()
+        batch.do(1).on()
+        batch.voices(1).play()
+        assert batch.send(raise_on_error=False) == ['OK', error]
+        args, kwargs = self.client.raw.execute_many.call_args
+        assert args[1] is False
+
+
+class TestApply(object):
+
+    def setup(self):
+        self.client = keiko.clients.Client('127.0.0.1')
+        self.replies = {
+            'ACOP -u 1': '10010000', 'ACOP -u 2': '01000000',
+            'SPOP': '00000000'
+        }
+        self.sent = []
+        self.client.raw.execute_many = mock.Mock(side_effect=self.execute)
+
+    def execute(self, commands, *args):
+        self.sent.append(commands)
+        return [self.replies.get(command, 'OK') for command in commands]
+
+    def test_minimal_commands(self):
+        changes = self.client.apply({
+            'lamps': {'red': 'on', 'green': 'blink'},
+            'buzzer': 'off',
+            'do': {2: 'on', 4: 'on'},
+            'voice': {'number': 3, 'repeat': 2}
+        })
+        assert self.sent == [
+            ['ACOP -u 1', 'ACOP -u 2', 'SPOP'],
+            ['ACOP -u 1 XX200XXX -w 0 -t 0',
+             'ACOP -u 2 XXX1XXXX -w 0 -t 0',
+             'SPOP 10310200']
+        ]
+        assert changes == {
+            'lamps': {'green': 'blink'},
+            'buzzer': 'off',
+            'do': {4: 'on'},
+            'voice': {'number': 3, 'repeat': 2}
+        }
+
+    def test_no_change(self):
+        changes = self.client.apply({
+            'timestamp': 0,
+            'lamps': {'red': 'on'},
+            'buzzer': 'continuous',
+            'di': {1: 'on'}
+        })
+        assert self.sent == [['ACOP -u 1']]
+        assert changes == {}
+
+    def test_with_cache(self):
+        client = keiko.clients.Client('127.0.0.1', cache_ttl=10)
+        client.raw._send_many = mock.Mock(side_effect=self.execute)
+        client.cache.put('ACOP -u 2', '00000000')
+        client.apply({'do': {1: 'on'}})
+        assert self.sent == [['ACOP -u 2 1XXXXXXX -w 0 -t 0']]
+        client.apply({'do': {1: 'on'}})
+        assert len(self.sent) == 1  # the cache has learned the write
+
+    def test_unknown_key(self):
+        with pytest.raises(ValueError):
+            self.client.apply({'lamp': {'red': 'on'}})
+        assert self.sent == []
+
+
 class TestRawClient(object):
 
     address = '127.0.0.1'
@@ -224,16 +434,28 @@ class TestRawClient(object):
 
     def setup(self):
         self.patcher = mock.patch('socket.socket')
-        self.patcher.start()
+        self.socket = self.patcher.start()
+        self.sock = self.socket.return_value
+        self.sock.recv_into.side_effect = self.recv_into
+        self.chunks = None  # replies OK forever
         self.client = keiko.clients.RawClient(self.address, self.port)
-        self.client._strip_data = mock.Mock()  # has trouble on py3
 
     def teardown(self):
         del self.client
         self.patcher.stop()
 
+    def recv_into(self, view):
+        chunk = self.chunks.pop(0) if self.chunks is not None else b'OK\r'
+        if isinstance(chunk, Exception):
+            raise chunk
+        view[:len(chunk)] = chunk
+        return len(chunk)
+
+    def set_received_chunks(self, *chunks):
+        self.chunks = list(chunks)
+
     def get_sent_data(self):
-        args, kwargs = self.client._sock.sendall.call_args
+        args, kwargs = self.sock.sendall.call_args
         data = args[0]
         if sys.version_info[0] >= 3:  # py3
             return str(data, 'utf-8')  # bytes to str
@@ -242,16 +464,149 @@ class TestRawClient(object):
 
     def test_connect(self):
         self.client.help()
-        self.client._sock.connect.assert_called_with(
+        self.sock.connect.assert_called_with(
             (self.address, self.port)
         )
 
+    def test_reuse_connection(self):
+        self.client.help()
+        self.client.help()
+        assert self.sock.connect.call_count == 1
+        assert self.sock.close.call_count == 0
+
+    def test_reconnect_on_failure(self):
+        self.client.help()
+        self.set_received_chunks(b'', b'OK\r')  # closed by peer
+        self.client.help()
+        assert self.sock.connect.call_count == 2
+        assert self.sock.close.call_count == 1
+
+    def test_not_persistent(self):
+        client = keiko.clients.RawClient(
+            self.address, self.port, persistent=False
+        )
+        client.help()
+        client.help()
+        assert self.sock.connect.call_count == 2
+        assert self.sock.close.call_count == 2
+
+    def test_pool_size(self):
+        client = keiko.clients.RawClient(
+            self.address, self.port, pool_size=1
+        )
+        conn = client.pool.acquire()
+        conn.connect()
+        released = []
+
+        def release():
+            released.append(True)
+            client.pool.release(conn)
+        timer = threading.Timer(0.05, release)
+        timer.start()
+        assert client.pool.acquire() is conn
+        assert released
+        timer.join()
+
     def test_error(self):
         self.client._send = mock.Mock(return_value='ER01')  # error code
         with pytest.raises(Exception):
             self.client.help()
 
+    def test_error_code(self):
+        self.client._send = mock.Mock(return_value='ER03')
+        with pytest.raises(keiko.clients.CommandError) as e:
+            self.client.acop('X')
+        assert e.value.code == 'ER03'
+
+    def test_execute_many(self):
+        self.set_received_chunks(b'10000000\r01', b'01\r00', b'000000\r')
+        results = self.client.execute_many(['ACOP -u 1', 'ROPS', 'SPOP'])
+        assert results == ['10000000', '0101', '00000000']
+        args, kwargs = self.sock.sendall.call_args
+        assert args[0] == b'ACOP -u 1\rROPS\rSPOP\r'
+        assert self.sock.sendall.call_count == 1
+
+    def test_execute_many_with_error(self):
+        self.set_received_chunks(b'ER01\rOK\r')
+        with pytest.raises(keiko.clients.CommandError):
+            self.client.execute_many(['FOO', 'ALOF'])
+        self.set_received_chunks(b'ER01\rOK\r')
+        results = self.client.execute_many(
+            ['FOO', 'ALOF'], raise_on_error=False
+        )
+        assert isinstance(results[0], keiko.clients.CommandError)
+        assert results[1] == 'OK'
+
+    def test_timeouts(self):
+        client = keiko.clients.RawClient(
+            self.address, self.port, connect_timeout=1, timeout=2
+        )
+        client.help()
+        assert self.sock.settimeout.call_args_list == [
+            mock.call(1), mock.call(2)
+        ]
+
+    def test_retry_read(self):
+        self.client.backoff = 0
+        self.set_received_chunks(socket.timeout(), socket.timeout(), b'OK\r')
+        assert self.client.vern() == 'OK'
+        assert self.sock.sendall.call_count == 3
+
+    def test_retry_exhausted(self):
+        self.client.backoff = 0
+        self.set_received_chunks(*[socket.timeout()] * 3)
+        with pytest.raises(socket.timeout):
+            self.client.vern()
+        assert self.sock.sendall.call_count == 3
+
+    def test_no_retry_write(self):
+        self.set_received_chunks(socket.timeout(), b'OK\r')
+        with pytest.raises(socket.timeout):
+            self.client.acop('1XXXXXXX')
+        assert self.sock.sendall.call_count == 1
+
+    def test_deadline(self):
+        self.client.deadline = 0.05
+        self.client.backoff = 10  # longer than the deadline
+        self.set_received_chunks(socket.timeout(), b'OK\r')
+        with pytest.raises(socket.timeout):
+            self.client.vern()
+        assert self.sock.sendall.call_count == 1
+        self.client.pool.size = 0  # no connection will be free in time
+        with pytest.raises(keiko.clients.DeadlineExceeded):
+            self.client.vern()
+
+    def test_split_reply(self):
+        self.set_received_chunks(b'10', b'000', b'000\r')
+        assert self.client.acop() == '10000000'
+
+    def test_long_reply(self):
+        reply = b'x' * 1000
+        chunks = [reply[i:i + 64] for i in range(0, 1000, 64)]
+        self.set_received_chunks(*chunks + [b'\r'])
+        assert self.client.help() == reply.decode('ascii')
+
+    def test_unexpected_reply(self):
+        self.set_received_chunks(b'OK\r')
+        with pytest.raises(keiko.clients.ReplyError):
+            self.client.acop()
+        self.set_received_chunks(b'01\r')
+        with pytest.raises(keiko.clients.ReplyError):
+            self.client.rops()
+
+    def test_pipeline(self):
+        self.client.execute_many = mock.Mock(return_value=['0', '1'])
+        with self.client.pipeline() as pipe:
+            pipe.acop(unit=2).rly1('TurnOn')
+            assert len(pipe) == 2
+            assert pipe.execute() == ['0', '1']
+            assert len(pipe) == 0
+        self.client.execute_many.assert_called_with(
+            ['ACOP -u 2', 'RLY1 TurnOn -w 0 -t 0'], True
+        )
+
     def test_acop_read(self):
+        self.set_received_chunks(b'00000000\r')
         self.client.acop()
         assert self.get_sent_data() == 'ACOP -u 1\r'
 
@@ -376,6 +731,7 @@ class TestRawClient(object):
         assert self.get_sent_data() == 'RLY2 Blink -w 10 -t 30\r'
 
     def test_rops_read(self):
+        self.set_received_chunks(b'0000\r')
         self.client.rops()
         assert self.get_sent_data() == 'ROPS\r'
 
@@ -400,6 +756,7 @@ class TestRawClient(object):
         assert self.get_sent_data() == 'RYOT -n 2 TurnOn -w 10 -t 20\r'
 
     def test_spop_read(self):
+        self.set_received_chunks(b'00000000\r')
         self.client.spop()
         assert self.get_sent_data() == 'SPOP\r'
 
@@ -1,3 +1,7 @@
+import itertools
+
+import pytest
+
 import keiko.flags
 
 
@@ -87,3 +91,94 @@ class TestFlags(object):
         state = keiko.flags.parse_voice_flags(org)
         flags = keiko.flags.build_voice_flags(state)
         assert flags == org
+
+    def test_parse_returns_new_dicts(self):
+        states = keiko.flags.parse_lamp_flags('10000000')
+        states['lamps']['red'] = 'off'
+        assert keiko.flags.parse_lamp_flags('10000000')['lamps']['red'] == 'on'
+
+    def test_build_invalid_states(self):
+        with pytest.raises(KeyError):
+            keiko.flags.build_lamp_flags({'lamps': {'blue': 'on'}})
+        with pytest.raises(KeyError):
+            keiko.flags.build_lamp_flags({'lamps': {'red': 'light'}})
+        with pytest.raises(KeyError):
+            keiko.flags.build_do_flags({'do': {5: 'on'}})
+        with pytest.raises(KeyError):
+            keiko.flags.build_buzzer_flags({'buzzer': 'beep'})
+
+    def test_all_lamp_combinations(self):
+        for digits in itertools.product('0123', repeat=3):
+            org = ''.join(digits) + '00000'
+            state = keiko.flags.parse_lamp_flags(org)
+            assert keiko.flags.build_lamp_flags(state) == org[:3] + 'XXXXX'
+
+    def test_bits(self):
+        assert keiko.flags.flags_to_bits('12000000') == 0b1001
+        assert keiko.flags.flags_to_bits('0101') == 0b01000100
+        for flags in ['00000000', '12301011', '33333333', '0110']:
+            bits = keiko.flags.flags_to_bits(flags)
+            assert keiko.flags.bits_to_flags(bits, len(flags)) == flags
+
+
+class TestDeviceState(object):
+
+    def setup(self):
+        self.state = keiko.flags.parse_state(
+            '12010000', '10100000', '0101', '10310200'
+        )
+
+    def test_views(self):
+        assert self.state.lamps == {
+            'red': 'on', 'yellow': 'blink', 'green': 'off'
+        }
+        assert self.state.buzzer == 'continuous'
+        assert self.state.do == {1: 'on', 2: 'off', 3: 'on', 4: 'off'}
+        assert self.state.di == {1: 'off', 2: 'on', 3: 'off', 4: 'on'}
+        assert self.state.voice == {'number': 3, 'repeat': 2}
+
+    def test_stopped_voice(self):
+        state = keiko.flags.parse_state(
+            '00001000', '00000000', '0000', '00000000'
+        )
+        assert state.buzzer == 'intermittent'
+        assert state.voice == 'stop'
+
+    def test_value(self):
+        same = keiko.flags.parse_state(
+            '12010000', '10100000', '0101', '10310200'
+        )
+        other = keiko.flags.parse_state(
+            '12010000', '10100000', '0111', '10310200'
+        )
+        assert self.state == same
+        assert self.state != other
+        assert len(set([self.state, same, other])) == 2
+        with pytest.raises(AttributeError):
+            self.state.bits = 0
+
+    def test_dict(self):
+        states = self.state.to_dict()
+        assert keiko.flags.DeviceState.from_dict(states) == self.state
+
+    def test_pickle(self):
+        import pickle
+        assert pickle.loads(pickle.dumps(self.state)) == self.state
+
+    def test_diff(self):
+        other = keiko.flags.parse_state(
+            '10000000', '10000000', '0101', '00000000'
+        )
+        assert self.state.diff(self.state) == {}
+        assert self.state.diff(other) == {
+            'lamps': {'yellow': 'blink'},
+            'buzzer': 'continuous',
+            'do': {3: 'on'},
+            'voice': {'number': 3, 'repeat': 2}
+        }
+        assert other.diff(self.state) == {
+            'lamps': {'yellow': 'off'},
+            'buzzer': 'off',
+            'do': {3: 'off'},
+            'voice': 'stop'
+        }
@@ -0,0 +1,86 @@
+import threading
+
+import mock
+
+import keiko.fleet
+
+
+class TestFleetClient(object):
+
+    def setup(self):
+        self.fleet = keiko.fleet.FleetClient(
+            {'a': '127.0.0.1', 'b': '127.0.0.2'}, timeout=1
+        )
+        for client in self.fleet.clients.values():
+            client.raw._execute = mock.MagicMock(return_value='10100000')
+
+    def teardown(self):
+        self.fleet.close()
+
+    def get_sent_commands(self):
+        return dict(
+            (key, client.raw._execute.call_args[0][0])
+            for key, client in self.fleet.clients.items()
+        )
+
+    def test_addresses(self):
+        fleet = keiko.fleet.FleetClient(['127.0.0.1', '127.0.0.2'])
+        assert sorted(fleet.clients) == ['127.0.0.1', '127.0.0.2']
+        fleet.close()
+
+    def test_status(self):
+        result = self.fleet.lamps.status
+        assert result.ok
+        assert result['a'] == {'red': 'on', 'yellow': 'off', 'green': 'on'}
+        assert result['b'] == result['a']
+
+    def test_nested_status(self):
+        assert self.fleet.do(3).status == {'a': 'on', 'b': 'on'}
+
+    def test_set(self):
+        self.fleet.lamps.red.on(wait=1)
+        assert self.get_sent_commands() == {
+            'a': 'ACOP -u 1 1XXXXXXX -w 1 -t 0',
+            'b': 'ACOP -u 1 1XXXXXXX -w 1 -t 0'
+        }
+        self.fleet.do(2).off()
+        assert self.get_sent_commands()['b'] == 'ACOP -u 2 X0XXXXXX -w 0 -t 0'
+
+    def test_raw(self):
+        result = self.fleet.raw.vern()
+        assert result == {'a': '10100000', 'b': '10100000'}
+
+    def test_error(self):
+        error = Exception('Command failed')
+        self.fleet.clients['b'].raw._execute.side_effect = error
+        result = self.fleet.buzzer.status
+        assert not result.ok
+        assert result == {'a': 'off'}
+        assert result.errors == {'b': error}
+
+    def test_concurrent(self):
+        cond = threading.Condition()
+        arrived = []
+
+        def execute(command):
+            with cond:  # both devices must be in flight at once
+                arrived.append(command)
+                cond.notify_all()
+                if len(arrived) < 2:
+                    cond.wait(1)  # until the other device arrives
+                if len(arrived) < 2:
+                    raise RuntimeError('not concurrent')
+            return 'OK'
+        for client in self.fleet.clients.values():
+            client.raw._execute.side_effect = execute
+        assert self.fleet.buzzer.off().ok
+
+    def test_timeout(self):
+        event = threading.Event()
+        self.fleet.clients['b'].raw._execute.side_effect = (
+            lambda command: event.wait()
+        )
+        result = self.fleet.map(lambda c: c.raw.vern(), timeout=0.05)
+        event.set()
+        assert result == {'a': '10100000'}
+        assert list(result.errors) == ['b']
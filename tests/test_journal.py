@@ -0,0 +1,111 @@
+import os
+import shutil
+import tempfile
+
+import mock
+import pytest
+
+import keiko.clients
+import keiko.flags
+import keiko.journal
+
+
+class TestJournal(object):
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'keiko.journal')
+        self.journal = keiko.journal.Journal(self.path)
+
+    def teardown(self):
+        self.journal.close()
+        shutil.rmtree(self.directory)
+
+    def observe(self, command, reply, device='a'):
+        self.journal.observe(device, [command], [reply])
+
+    def test_record_changes(self):
+        self.observe('ACOP -u 1', '10000000')
+        self.observe('ACOP -u 1', '10000000')
+        self.observe('ACOP -u 1 X1XXXXXX -w 0 -t 0', 'OK')
+        self.observe('ROPS', IOError())
+        entries = self.journal.query()
+        assert len(entries) == 2
+        assert entries[0].known == ('lamps', 'buzzer')
+        assert entries[0].to_dict() == {
+            'timestamp': entries[0].timestamp, 'device': 'a',
+            'lamps': {'red': 'on', 'yellow': 'off', 'green': 'off'},
+            'buzzer': 'off'
+        }
+        assert entries[1].state.lamps['yellow'] == 'on'
+        assert entries[1].timestamp >= entries[0].timestamp
+
+    def test_snapshot(self):
+        self.journal.observe(
+            'a', ['ACOP -u 1', 'ACOP -u 2', 'ROPS', 'SPOP'],
+            ['12010000', '10100000', '0101', '10310200']
+        )
+        entry = self.journal.query()[0]
+        assert entry.state == keiko.flags.parse_state(
+            '12010000', '10100000', '0101', '10310200'
+        )
+        assert entry.known == ('lamps', 'buzzer', 'do', 'di', 'voice')
+
+    def test_unknown_after_timed_write(self):
+        self.observe('ACOP -u 2', '00000000')
+        self.observe('ACOP -u 2 1XXXXXXX -w 2 -t 0', 'OK')
+        self.observe('SPOP 10310200', 'OK')
+        entry = self.journal.query()[-1]
+        assert entry.known == ('voice',)
+        self.observe('ALOF', 'OK')
+        entry = self.journal.query()[-1]
+        assert entry.known == ('lamps', 'buzzer', 'do', 'voice')
+        assert entry.state.voice == 'stop'
+
+    def test_query(self):
+        with mock.patch('time.time', side_effect=[10, 20, 30, 40]):
+            for device, reply in [('a', '0001'), ('b', '0001'),
+                                  ('a', '0010'), ('b', '0010')]:
+                self.observe('ROPS', reply, device)
+        assert [e.timestamp for e in self.journal.query(20, 40)] == [20, 30]
+        assert [e.timestamp for e in self.journal.query(start=25)] == [30, 40]
+        entries = self.journal.query(device='b')
+        assert [e.timestamp for e in entries] == [20, 40]
+        assert [e.timestamp for e in self.journal.query(limit=1)] == [40]
+        assert self.journal.query(50) == []
+
+    def test_reopen(self):
+        self.observe('ROPS', '0001')
+        self.journal.close()
+        self.journal = keiko.journal.Journal(self.path)
+        self.observe('ROPS', '0011')
+        assert len(self.journal) == 2
+        assert len(self.journal.query()) == 2
+
+    def test_ring_buffer(self):
+        self.journal.close()
+        os.remove(self.path)
+        self.journal = keiko.journal.Journal(self.path, capacity=3)
+        with mock.patch('time.time', side_effect=range(5)):
+            for i in range(5):
+                self.observe('ROPS', '000{0}'.format(i % 2))
+        assert len(self.journal) == 3
+        assert os.path.getsize(self.path) == 32 + 3 * 48
+        entries = self.journal.query()
+        assert [e.timestamp for e in entries] == [2, 3, 4]
+        assert [e.timestamp for e in self.journal.query(3)] == [3, 4]
+
+    def test_not_a_journal(self):
+        path = os.path.join(self.directory, 'other')
+        with open(path, 'wb') as f:
+            f.write(b'x' * 64)
+        with pytest.raises(ValueError):
+            keiko.journal.Journal(path)
+
+    def test_client(self):
+        client = keiko.clients.Client('127.0.0.1', journal=self.journal)
+        client.raw._send_many = mock.Mock(return_value=['10000000'])
+        client.lamps.red.status
+        entry = self.journal.query()[0]
+        assert entry.device == '127.0.0.1:60000'
+        assert entry.state.lamps['red'] == 'on'
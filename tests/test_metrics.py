@@ -0,0 +1,116 @@
+import mock
+import pytest
+
+import keiko.clients
+import keiko.metrics
+
+
+class TestRegistry(object):
+
+    def setup(self):
+        self.registry = keiko.metrics.Registry()
+
+    def test_counter(self):
+        counter = self.registry.counter('hits_total', 'Hits.', ('path',))
+        counter.inc('/')
+        counter.inc('/', amount=2)
+        assert counter.value('/') == 3
+        assert self.registry.counter('hits_total', 'Hits.') is counter
+        assert self.registry.render() == (
+            '# HELP hits_total Hits.\n'
+            '# TYPE hits_total counter\n'
+            'hits_total{path="/"} 3\n'
+        )
+
+    def test_gauge(self):
+        gauge = self.registry.gauge('depth', 'Depth.', ('queue',))
+        gauge.inc('a', amount=3)
+        gauge.dec('a')
+        assert gauge.value('a') == 2
+        gauge.set(0, 'a')
+        assert self.registry.render() == (
+            '# HELP depth Depth.\n'
+            '# TYPE depth gauge\n'
+            'depth{queue="a"} 0\n'
+        )
+
+    def test_histogram(self):
+        histogram = self.registry.histogram(
+            'duration_seconds', 'Durations.', buckets=(0.1, 1.0)
+        )
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(5)
+        assert histogram.count() == 3
+        lines = self.registry.render().splitlines()
+        assert lines[2:] == [
+            'duration_seconds_bucket{le="0.1"} 1',
+            'duration_seconds_bucket{le="1.0"} 2',
+            'duration_seconds_bucket{le="+Inf"} 3',
+            'duration_seconds_sum 5.55',
+            'duration_seconds_count 3'
+        ]
+
+    def test_escape_labels(self):
+        counter = self.registry.counter('c', 'C.', ('name',))
+        counter.inc('a"b')
+        assert 'c{name="a\\"b"} 1' in self.registry.render()
+
+
+class TestRawClientMetrics(object):
+
+    def setup(self):
+        self.registry = keiko.metrics.Registry()
+        self.client = keiko.clients.RawClient(
+            '127.0.0.1', metrics=self.registry
+        )
+        self.client._send = mock.Mock(return_value='OK')
+
+    def value(self, name, *labels):
+        metric = self.registry._metrics[name]
+        if isinstance(metric, keiko.metrics.Histogram):
+            return metric.count(*labels)
+        return metric.value(*labels)
+
+    def test_command(self):
+        self.client.acop('1XXXXXXX')
+        assert self.value(
+            'keiko_commands_total', '127.0.0.1:60000', 'ACOP'
+        ) == 1
+        assert self.value(
+            'keiko_command_duration_seconds', '127.0.0.1:60000', 'ACOP'
+        ) == 1
+
+    def test_error(self):
+        self.client._send.return_value = 'ER04'
+        with pytest.raises(keiko.clients.CommandError):
+            self.client.vern()
+        assert self.value(
+            'keiko_command_errors_total', '127.0.0.1:60000', 'VERN', 'ER04'
+        ) == 1
+        self.client._send.side_effect = error = IOError()
+        with pytest.raises(IOError):
+            self.client.vern()
+        assert self.value(  # OSError on py3, IOError on py2
+            'keiko_command_errors_total', '127.0.0.1:60000', 'VERN',
+            type(error).__name__
+        ) == 1
+
+    def test_execute_many(self):
+        self.client._send_many = mock.Mock(return_value=['OK', 'ER01'])
+        self.client.execute_many(['ALOF', 'FOO'], raise_on_error=False)
+        assert self.value(
+            'keiko_command_duration_seconds', '127.0.0.1:60000', 'PIPELINE'
+        ) == 1
+        assert self.value(
+            'keiko_commands_total', '127.0.0.1:60000', 'ALOF'
+        ) == 1
+        assert self.value(
+            'keiko_command_errors_total', '127.0.0.1:60000', 'FOO', 'ER01'
+        ) == 1
+
+    def test_disabled(self):
+        client = keiko.clients.RawClient('127.0.0.1', metrics=None)
+        client._send = mock.Mock(return_value='OK')
+        client.vern()
+        assert 'keiko_commands_total{' not in self.registry.render()
@@ -0,0 +1,143 @@
+import threading
+
+import mock
+import pytest
+
+import keiko.clients
+import keiko.pattern
+
+
+class TestPattern(object):
+
+    def setup(self):
+        self.pattern = keiko.pattern.Pattern()
+
+    def test_then(self):
+        self.pattern.then({'lamps': {'red': 'on'}, 'buzzer': 'intermittent'},
+                          5)
+        self.pattern.then({'lamps': {'yellow': 'blink'}}, 10)
+        assert self.pattern.length == 15
+        assert self.pattern.compile() == [
+            (0, 'ACOP -u 1 1XXX1XXX -w 0 -t 5'),
+            (0, 'ACOP -u 1 X2XXXXXX -w 5 -t 10')
+        ]
+
+    def test_merge(self):
+        self.pattern.add({'lamps': {'red': 'on'}}, at=2, duration=3)
+        self.pattern.add({'do': {1: 'on'}}, at=2, duration=3)
+        self.pattern.add({'lamps': {'green': 'blink'}}, at=2, duration=3)
+        assert self.pattern.compile() == [
+            (0, 'ACOP -u 1 1X2XXXXX -w 2 -t 3'),
+            (0, 'ACOP -u 2 1XXXXXXX -w 2 -t 3')
+        ]
+
+    def test_host_timed(self):
+        self.pattern.add(
+            {'do': {1: 'on'}, 'voice': {'number': 2, 'repeat': 1}},
+            at=1.5, duration=0.5
+        )
+        self.pattern.add({'lamps': {'red': 'on'}}, at=1, duration=0.5)
+        assert self.pattern.compile() == [
+            (0, 'ACOP -u 1 1XXXXXXX -w 1 -t 0'),
+            (1.5, 'ACOP -u 2 1XXXXXXX -w 0 -t 0'),
+            (1.5, 'ACOP -u 1 0XXXXXXX -w 0 -t 0'),
+            (1.5, 'SPOP 10210100'),
+            (2.0, 'ACOP -u 2 0XXXXXXX -w 0 -t 0'),
+            (2.0, 'SPOP 00000000')
+        ]
+
+    def test_invalid_step(self):
+        with pytest.raises(ValueError):
+            self.pattern.add({'lamps': {'red': 'on'}}, at=-1)
+        with pytest.raises(ValueError):
+            self.pattern.add({'lamp': {'red': 'on'}})
+        with pytest.raises(KeyError):
+            self.pattern.add({'lamps': {'red': 'light'}})
+        assert len(self.pattern) == 0
+
+
+class TestPatternPlayer(object):
+
+    def setup(self):
+        self.player = keiko.pattern.PatternPlayer()
+        self.client = keiko.clients.Client('127.0.0.1')
+        self.sent = []
+        self.sent_event = threading.Event()
+        self.client.raw.execute_many = mock.Mock(side_effect=self.execute)
+        self.pattern = keiko.pattern.Pattern()
+
+    def execute(self, commands):
+        self.sent.append(commands)
+        self.sent_event.set()
+        return ['OK'] * len(commands)
+
+    def test_play_at_once(self):
+        self.pattern.then({'lamps': {'red': 'on'}}, 1)
+        self.pattern.then({'lamps': {'green': 'on'}}, 1)
+        playback = self.player.play(self.client.raw, self.pattern)
+        assert playback.wait(0)
+        assert self.sent == [[
+            'ACOP -u 1 1XXXXXXX -w 0 -t 1', 'ACOP -u 1 XX1XXXXX -w 1 -t 1'
+        ]]
+        assert len(self.player) == 0
+
+    def test_play_host_timed(self):
+        self.pattern.add({'lamps': {'red': 'on'}})
+        self.pattern.add({'lamps': {'red': 'off'}}, at=0.05)
+        playback = self.player.play(self.client.raw, self.pattern)
+        assert not playback.done.is_set()
+        assert playback.wait(1)
+        assert self.sent == [
+            ['ACOP -u 1 1XXXXXXX -w 0 -t 0'],
+            ['ACOP -u 1 0XXXXXXX -w 0 -t 0']
+        ]
+
+    def test_loops(self):
+        self.pattern.add({'lamps': {'red': 'on'}}, duration=0.02)
+        playback = self.player.play(self.client.raw, self.pattern, loops=3)
+        assert playback.wait(1)
+        assert playback.cycles == 3
+        assert self.sent.count(['ACOP -u 1 1XXXXXXX -w 0 -t 0']) == 3
+        with pytest.raises(ValueError):
+            self.player.play(self.client.raw, keiko.pattern.Pattern(), 0)
+
+    def test_cancel(self):
+        self.pattern.add({'lamps': {'red': 'on'}}, duration=0.02)
+        playback = self.player.play(self.client.raw, self.pattern, loops=0)
+        playback.cancel()
+        assert playback.wait(0)
+        sent = len(self.sent)
+        self.sent_event.clear()
+        assert not self.sent_event.wait(0.1)
+        assert len(self.sent) == sent
+
+    def test_error(self):
+        self.client.raw.execute_many.side_effect = keiko.clients.CommandError(
+            'ER01'
+        )
+        self.pattern.add({'lamps': {'red': 'on'}})
+        with pytest.raises(keiko.clients.CommandError):
+            self.player.play(self.client.raw, self.pattern)
+
+    def test_client_play(self):
+        self.pattern.add({'buzzer': 'continuous'}, duration=3)
+        playback = self.client.play(self.pattern)
+        assert playback.wait(0)
+        assert self.sent == [['ACOP -u 1 XXX1XXXX -w 0 -t 3']]
+
+    def test_slow_client(self):
+        release = threading.Event()
+        slow = keiko.clients.Client('127.0.0.2')
+        slow.raw.execute_many = mock.Mock(
+            side_effect=lambda commands: release.wait(5)
+        )
+        self.pattern.add({'lamps': {'red': 'on'}}, at=0.01)
+        slow_playback = self.player.play(slow.raw, self.pattern)
+        playback = self.player.play(self.client.raw, self.pattern)
+        try:
+            assert playback.wait(1)
+            assert self.sent == [['ACOP -u 1 1XXXXXXX -w 0 -t 0']]
+            assert not slow_playback.done.is_set()
+        finally:
+            release.set()
+        assert slow_playback.wait(1)
@@ -0,0 +1,225 @@
+import threading
+import time
+
+import mock
+import pytest
+
+import keiko.clients
+import keiko.metrics
+import keiko.scheduler
+import keiko.simulator
+from keiko.scheduler import READ, WRITE
+
+
+class TestCommandScheduler(object):
+
+    def setup(self):
+        self.executed = []
+        self.deadlines = []
+        self.registry = keiko.metrics.Registry()
+        self.scheduler = keiko.scheduler.CommandScheduler(
+            self.execute, 'dev', self.registry
+        )
+        self.release = threading.Event()
+        self.results = {}
+        self.threads = []
+
+    def teardown(self):
+        self.release.set()
+        for thread in self.threads:
+            thread.join()
+
+    def execute(self, command, deadline=None):
+        self.executed.append(command)
+        self.deadlines.append(deadline)
+        if command.startswith('SPOP ') or ' -w ' in command:
+            return 'OK'
+        return 'reply to ' + command
+
+    def block(self):
+        """Keeps the worker busy until self.release is set."""
+        self.submit_in_thread('block', lambda: self.scheduler.call(
+            self.release.wait
+        ))
+        while not self.scheduler._thread or self.scheduler._queue:
+            time.sleep(0.001)
+
+    def submit_in_thread(self, name, func):
+        def run():
+            self.results[name] = func()
+        thread = threading.Thread(target=run)
+        thread.start()
+        self.threads.append(thread)
+        time.sleep(0.01)  # keeps the order of submission
+
+    def submit(self, name, command, priority=WRITE):
+        self.submit_in_thread(
+            name, lambda: self.scheduler.submit(command, priority)
+        )
+
+    def finish(self):
+        self.release.set()
+        for thread in self.threads:
+            thread.join()
+
+    def test_submit(self):
+        assert self.scheduler.submit('VERN', READ) == 'reply to VERN'
+        assert self.executed == ['VERN']
+
+    def test_writes_first(self):
+        self.block()
+        self.submit('read', 'ROPS', READ)
+        self.submit('write', 'ACOP -u 1 1XXXXXXX -w 0 -t 0')
+        assert len(self.scheduler) == 2
+        self.finish()
+        assert self.executed == ['ACOP -u 1 1XXXXXXX -w 0 -t 0', 'ROPS']
+
+    def test_merge_acop_writes(self):
+        self.block()
+        self.submit('red', 'ACOP -u 1 1XXXXXXX -w 0 -t 0')
+        self.submit('do', 'ACOP -u 2 1XXXXXXX -w 0 -t 0')
+        self.submit('red_blink', 'ACOP -u 1 2XXXXXXX -w 0 -t 0')
+        self.submit('green', 'ACOP -u 1 XX1XXXXX -w 0 -t 0')
+        self.finish()
+        assert self.executed == [
+            'ACOP -u 1 2X1XXXXX -w 0 -t 0', 'ACOP -u 2 1XXXXXXX -w 0 -t 0'
+        ]
+        assert self.results['red'] == self.results['green'] == 'OK'
+        assert self.registry.counter(
+            'keiko_scheduler_merged_total', ''
+        ).value('dev', 'WRITE') == 2
+
+    def test_keep_order_of_timed_writes(self):
+        self.block()
+        self.submit('on', 'ACOP -u 1 1XXXXXXX -w 0 -t 0')
+        self.submit('timed', 'ACOP -u 1 2XXXXXXX -w 0 -t 5')
+        self.submit('off', 'ACOP -u 1 0XXXXXXX -w 0 -t 0')
+        self.finish()
+        assert self.executed == [
+            'ACOP -u 1 1XXXXXXX -w 0 -t 0',
+            'ACOP -u 1 2XXXXXXX -w 0 -t 5',
+            'ACOP -u 1 0XXXXXXX -w 0 -t 0'
+        ]
+
+    def test_keep_order_around_other_writes(self):
+        self.block()
+        self.submit('red', 'ACOP -u 1 1XXXXXXX -w 0 -t 0')
+        self.submit('alof', 'ALOF')
+        self.submit('red_again', 'ACOP -u 1 1XXXXXXX -w 0 -t 0')
+        self.submit_in_thread('batch', lambda: self.scheduler.call(
+            lambda: self.executed.append('batch')
+        ))
+        self.submit('voice', 'SPOP 10100000')
+        self.submit('green', 'ACOP -u 1 XX1XXXXX -w 0 -t 0')
+        self.finish()
+        assert self.executed == [
+            'ACOP -u 1 1XXXXXXX -w 0 -t 0', 'ALOF',
+            'ACOP -u 1 1XXXXXXX -w 0 -t 0', 'batch', 'SPOP 10100000',
+            'ACOP -u 1 XX1XXXXX -w 0 -t 0'
+        ]
+
+    def test_reads_do_not_end_merging(self):
+        self.block()
+        self.submit('red', 'ACOP -u 1 1XXXXXXX -w 0 -t 0')
+        self.submit_in_thread('poll', lambda: self.scheduler.call(
+            lambda: self.executed.append('poll'), READ
+        ))
+        self.submit('green', 'ACOP -u 1 XX1XXXXX -w 0 -t 0')
+        self.finish()
+        assert self.executed == ['ACOP -u 1 1X1XXXXX -w 0 -t 0', 'poll']
+
+    def test_deadline_of_execute(self):
+        deadline = time.time() + 5
+        self.scheduler.submit('VERN', READ, deadline)
+        assert self.deadlines == [deadline]
+        self.block()
+        self.submit_in_thread('first', lambda: self.scheduler.submit(
+            'SPOP 10100000', WRITE, deadline
+        ))
+        self.submit_in_thread('second', lambda: self.scheduler.submit(
+            'SPOP 00000000', WRITE, deadline + 1
+        ))
+        self.finish()
+        assert self.deadlines[-1] == deadline + 1  # the last waiter's
+
+    def test_replace_spop_write(self):
+        self.block()
+        self.submit('first', 'SPOP 10100000')
+        self.submit('second', 'SPOP 00000000')
+        self.finish()
+        assert self.executed == ['SPOP 00000000']
+
+    def test_share_reads(self):
+        self.block()
+        for i in range(5):
+            self.submit(i, 'ACOP -u 1', READ)
+        self.submit('other', 'ROPS', READ)
+        self.finish()
+        assert self.executed == ['ACOP -u 1', 'ROPS']
+        assert set(self.results[i] for i in range(5)) == set([
+            'reply to ACOP -u 1'
+        ])
+
+    def test_errors(self):
+        def fail(command, deadline):
+            raise keiko.clients.CommandError('ER03')
+        self.scheduler.execute = fail
+        with pytest.raises(keiko.clients.CommandError):
+            self.scheduler.submit('ACOP -u 1 1XXXXXXX -w 0 -t 0')
+
+    def test_deadline_in_queue(self):
+        self.block()
+        with pytest.raises(keiko.clients.DeadlineExceeded):
+            self.scheduler.submit('VERN', READ, time.time() + 0.01)
+        self.finish()
+        assert self.executed == []
+
+    def test_metrics(self):
+        self.block()
+        self.submit('read', 'ROPS', READ)
+        assert self.registry.gauge(
+            'keiko_scheduler_queue_depth', ''
+        ).value('dev') == 1
+        self.finish()
+        histogram = self.registry.histogram('keiko_scheduler_wait_seconds', '')
+        assert histogram.count('dev', 'READ') == 1
+        assert histogram.count('dev', 'WRITE') == 1  # the blocking call
+
+
+class TestScheduledClient(object):
+
+    def test_simulator(self):
+        with keiko.simulator.Simulator() as simulator:
+            client = keiko.clients.Client(
+                '127.0.0.1', simulator.port, scheduled=True
+            )
+            client.lamps.red.on()
+            assert client.lamps.status['red'] == 'on'
+            with client.batch() as batch:
+                batch.do(1).on()
+                batch.voices(2).play()
+            assert client.snapshot().do[1] == 'on'
+            client.raw.close()
+
+    def test_one_deadline(self):
+        client = keiko.clients.Client(
+            '127.0.0.1', scheduled=True, deadline=5
+        )
+        client.raw._send_many = mock.Mock(return_value=['OK'])
+        start = time.time()
+        client.raw.vern()
+        client.raw.execute_many(['VERN'])
+        for args, kwargs in client.raw._send_many.call_args_list:
+            assert start < args[1] <= time.time() + 5
+
+    def test_close(self):
+        client = keiko.clients.Client('127.0.0.1', scheduled=True)
+        client.raw._send_many = mock.Mock(return_value=['OK'])
+        client.raw.vern()
+        thread = client.raw.scheduler._thread
+        assert thread.is_alive()
+        client.raw.close()
+        assert not thread.is_alive()
+        assert client.raw.vern() == 'OK'  # starts a new thread
+        client.raw.close()
+        assert client.raw.scheduler._thread is None
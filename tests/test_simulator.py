@@ -0,0 +1,97 @@
+import socket
+import time
+
+import pytest
+
+import keiko.clients
+import keiko.simulator
+
+
+class TestSimulator(object):
+
+    def setup(self):
+        self.simulator = keiko.simulator.Simulator()
+        self.simulator.start()
+        self.client = keiko.clients.Client('127.0.0.1', self.simulator.port)
+
+    def teardown(self):
+        self.client.raw.close()
+        self.simulator.stop()
+
+    def test_lamps(self):
+        assert self.client.lamps.status == {
+            'red': 'off', 'yellow': 'off', 'green': 'off'
+        }
+        self.client.lamps.red.on()
+        self.client.lamps.yellow.blink()
+        assert self.client.lamps.status == {
+            'red': 'on', 'yellow': 'blink', 'green': 'off'
+        }
+        self.client.lamps.off()
+        assert self.client.lamps.red.status == 'off'
+
+    def test_buzzer(self):
+        self.client.buzzer.intermittent()
+        assert self.client.buzzer.status == 'intermittent'
+        self.client.buzzer.off()
+        assert self.client.buzzer.status == 'off'
+
+    def test_do_and_di(self):
+        self.client.do(2).on()
+        assert self.client.do.status == {1: 'off', 2: 'on', 3: 'off', 4: 'off'}
+        self.simulator.device.set_di(3, 'on')
+        assert self.client.di(3).status == 'on'
+
+    def test_voices(self):
+        self.client.voices(5).play(3)
+        assert self.client.voices.status == {'number': 5, 'repeat': 3}
+        self.client.voices.stop()
+        assert self.client.voices.status == 'stop'
+
+    def test_wait_and_time(self):
+        self.client.lamps.green.on(wait=1, time=1)
+        assert self.client.lamps.green.status == 'off'
+        time.sleep(1.2)
+        assert self.client.lamps.green.status == 'on'
+        time.sleep(1.0)
+        assert self.client.lamps.green.status == 'off'
+
+    def test_info(self):
+        assert self.client.raw.rdmn() == 'DN-1510GL'
+        assert self.client.raw.vern()
+
+    def test_errors(self):
+        with pytest.raises(keiko.clients.CommandError) as e:
+            self.client.raw._execute('FOO')
+        assert e.value.code == 'ER01'
+        with pytest.raises(keiko.clients.CommandError) as e:
+            self.client.raw.acop('2XXXXXXX', unit=2)
+        assert e.value.code == 'ER03'
+        with pytest.raises(keiko.clients.CommandError) as e:
+            self.client.raw._execute('VERN\n')
+        assert e.value.code == 'ER02'
+
+    def test_pipeline(self):
+        results = self.client.raw.pipeline().acop('1XXXXXXX').acop().execute()
+        assert results == ['OK', '10000000']
+
+
+class TestSimulatorOptions(object):
+
+    def test_latency(self):
+        with keiko.simulator.Simulator(latency=0.05) as simulator:
+            raw = keiko.clients.RawClient('127.0.0.1', simulator.port)
+            start = time.time()
+            raw.vern()
+            assert time.time() - start >= 0.05
+            raw.close()
+
+    def test_max_connections(self):
+        with keiko.simulator.Simulator(max_connections=1) as simulator:
+            first = socket.create_connection(('127.0.0.1', simulator.port))
+            first.sendall(b'VERN\r')
+            assert first.recv(64) == b'1.00\r'
+            second = socket.create_connection(('127.0.0.1', simulator.port))
+            assert second.recv(64) == b''  # closed by the simulator
+            first.close()
+            second.close()
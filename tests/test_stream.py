@@ -0,0 +1,76 @@
+import threading
+
+import mock
+
+import keiko.clients
+import keiko.stream
+
+
+def make_snapshot(red='off'):
+    return keiko.clients.Snapshot(
+        0, {'red': red, 'yellow': 'off', 'green': 'off'}, 'off',
+        {1: 'off', 2: 'off', 3: 'off', 4: 'off'},
+        {1: 'off', 2: 'off', 3: 'off', 4: 'off'}, 'stop'
+    )
+
+
+class TestStatePoller(object):
+
+    def setup(self):
+        self.client = mock.Mock()
+        self.client.snapshot.return_value = make_snapshot()
+        self.poller = keiko.stream.StatePoller(self.client, interval=0.01)
+
+    def teardown(self):
+        self.poller._stopped.set()
+
+    def test_publish_changes_only(self):
+        subscription = self.poller.subscribe(heartbeat=1)
+        assert next(subscription)[0] == 'state'
+        self.client.snapshot.return_value = make_snapshot('on')
+        kind, snapshot = next(subscription)
+        assert snapshot.lamps['red'] == 'on'
+        subscription.close()
+
+    def test_shared_polling(self):
+        subscriptions = [self.poller.subscribe() for _ in range(10)]
+        for subscription in subscriptions:
+            assert next(subscription)[0] == 'state'
+        threading.Event().wait(0.1)
+        assert self.client.snapshot.call_count < 20  # not 10 per round
+        for subscription in subscriptions:
+            subscription.close()
+        assert self.poller.subscribers == 0
+
+    def test_stop_without_subscribers(self):
+        self.poller.subscribe().close()
+        threading.Event().wait(0.05)
+        count = self.client.snapshot.call_count
+        threading.Event().wait(0.05)
+        assert self.client.snapshot.call_count == count
+
+    def test_last_state_first(self):
+        self.poller.poll()
+        subscription = self.poller.subscribe()
+        kind, snapshot = subscription._queue.get_nowait()
+        assert snapshot is self.poller.snapshot
+        subscription.close()
+
+    def test_heartbeat(self):
+        subscription = self.poller.subscribe(heartbeat=0.01)
+        next(subscription)
+        assert next(subscription) == ('heartbeat', None)
+        subscription.close()
+
+    def test_error(self):
+        self.client.snapshot.side_effect = IOError()
+        subscription = self.poller.subscribe(heartbeat=1)
+        assert next(subscription)[0] == 'error'
+        subscription.close()
+
+    def test_slow_subscriber(self):
+        subscription = keiko.stream.Subscription(self.poller, 2, 1)
+        for i in range(5):
+            subscription.put(('state', i))
+        assert next(subscription) == ('state', 3)
+        assert next(subscription) == ('state', 4)
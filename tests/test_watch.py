@@ -0,0 +1,99 @@
+import threading
+
+import mock
+
+import keiko.watch
+from keiko.watch import DIEvent
+
+
+class TestEdgeDetector(object):
+
+    def test_edges(self):
+        detector = keiko.watch.EdgeDetector()
+        assert detector.feed('0000', 1) == []
+        assert detector.feed('0000', 2) == []
+        assert detector.feed('0101', 3) == [
+            DIEvent(2, 'on', 3), DIEvent(4, 'on', 3)
+        ]
+        events = detector.feed('0001', 4)
+        assert events == [DIEvent(2, 'off', 4)]
+        assert events[0].edge == 'falling'
+
+    def test_debounce(self):
+        detector = keiko.watch.EdgeDetector(debounce=1.0)
+        detector.feed('0000', 0)
+        assert detector.feed('1000', 1) == []
+        assert detector.pending
+        assert detector.feed('0000', 1.5) == []  # a glitch
+        assert not detector.pending
+        assert detector.feed('1000', 2) == []
+        assert detector.feed('1000', 3) == [DIEvent(1, 'on', 3)]
+        assert detector.flags == '1000'
+
+
+class TestDIWatcher(object):
+
+    def setup(self):
+        self.raw = mock.Mock()
+        self.raw.rops.return_value = '0000'
+        self.watcher = keiko.watch.DIWatcher(
+            self.raw, interval=0.01, max_interval=0.04, backoff=2
+        )
+
+    def test_poll(self):
+        received = []
+        self.watcher.add_callback(received.append)
+        self.watcher.poll()
+        self.raw.rops.return_value = '0010'
+        events = self.watcher.poll()
+        assert received == events
+        assert events[0].term == 3
+        assert events[0].state == 'on'
+
+    def test_adaptive_interval(self):
+        self.watcher.poll()
+        assert self.watcher.current_interval == 0.02
+        self.watcher.poll()
+        self.watcher.poll()
+        assert self.watcher.current_interval == 0.04  # max_interval
+        self.raw.rops.return_value = '1000'
+        self.watcher.poll()
+        assert self.watcher.current_interval == 0.01
+
+    def test_iterate(self):
+        received = []
+
+        def consume():
+            for event in self.watcher:
+                received.append(event)
+        consumer = threading.Thread(target=consume)
+        consumer.start()
+        with self.watcher:
+            threading.Event().wait(0.05)
+            self.raw.rops.return_value = '0001'
+            threading.Event().wait(0.1)
+        consumer.join(1)
+        assert [(e.term, e.edge) for e in received] == [(4, 'rising')]
+
+    def test_restart(self):
+        with self.watcher:
+            pass
+        received = []
+
+        def consume():
+            for event in self.watcher:
+                received.append(event)
+        with self.watcher:
+            consumer = threading.Thread(target=consume)
+            consumer.start()
+            threading.Event().wait(0.05)
+            self.raw.rops.return_value = '0001'
+            threading.Event().wait(0.1)
+        consumer.join(1)
+        assert [(e.term, e.edge) for e in received] == [(4, 'rising')]
+
+    def test_callback_error(self):
+        self.watcher.add_callback(mock.Mock(side_effect=Exception()))
+        self.watcher.poll()
+        self.raw.rops.return_value = '0001'
+        assert len(self.watcher.poll()) == 1